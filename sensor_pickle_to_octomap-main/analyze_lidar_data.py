@@ -1,16 +1,59 @@
-import sqlite3
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime
-import numpy as np
 import os
+from db_utils import LiDARDatabase
+from instrumentation import span
+
+# Saved plots and the data version they were built from, kept in the output directory
+CACHE_MANIFEST = "analysis_cache.json"
+
+# Tables the queries read that are filled in after ingestion, and the command that fills them in;
+# databases from before these tables existed lack them or have them empty
+DERIVED_TABLES = {
+    "scan_stats": "python migrate_point_storage.py {db} --no-blobs --rebuild-scan-stats",
+    "point_density": "python migrate_point_storage.py {db} --no-blobs --rebuild-scan-stats",
+    "scan_changes": "python change_detection.py --db {db}",
+    # Created empty by any read-write open, and filled in as maps are built
+    "octomap_scans": "python migrate_point_storage.py {db} --no-blobs",
+}
+
+# Analyzer of the current worker process, set by _init_worker
+_worker_analyzer = None
+
+def _init_worker(db_path, queries_path):
+    global _worker_analyzer
+    # Each worker has its own read-only connection; its query listing is not worth repeating
+    plt.switch_backend("Agg")
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker_analyzer = LiDARDataAnalyzer(db_path, queries_path)
+
+def _analyze_in_worker(task):
+    return _worker_analyzer.analyze_query(*task)
 
 class LiDARDataAnalyzer:
     def __init__(self, db_path="lidar_data.db", queries_path="lidar_analysis_queries.sql"):
+        if not os.path.exists(db_path):
+            # A read-only connection cannot create it, and an empty database has nothing to analyze
+            raise FileNotFoundError(f"No database at {db_path}; create one with ingest.py or "
+                                    f"sensor_pickle_to_xyz_csv.py first")
         self.db_path = db_path
         self.queries_path = queries_path
+        # Read-only connection kept open across queries; WAL mode lets it
+        # read while an ingestion process is writing
+        self.db = LiDARDatabase(db_path, readonly=True)
         self.queries = self._load_queries()
+        # Query results by query number, with the data version they were read at
+        self._results = {}
         
     def _load_queries(self):
         """Load SQL queries from file"""
@@ -59,23 +102,70 @@ class LiDARDataAnalyzer:
             print(f"Loaded {len(queries)} queries from file")
             return queries
 
+    def _query_tables(self, query_number):
+        """DERIVED_TABLES the query reads"""
+        query = self.queries[query_number]['query']
+        return [table for table in DERIVED_TABLES if re.search(rf"\b{table}\b", query)]
+
+    def missing_tables(self):
+        """{table: "missing" or "empty"} for the DERIVED_TABLES that are not filled in yet"""
+        tables = self.db.table_names()
+        c = self.db.connect().cursor()
+
+        def has_rows(table, where=""):
+            return table in tables and c.execute(f"SELECT EXISTS (SELECT 1 FROM {table} {where})").fetchone()[0]
+
+        problems = {table: "missing" for table in DERIVED_TABLES if table not in tables}
+        if "scan_stats" not in problems and not has_rows("scan_stats") and (
+                has_rows("point_clouds") or has_rows("point_blobs")):
+            problems["scan_stats"] = "empty"
+        if "point_density" not in problems and not has_rows("point_density") and has_rows(
+                "scan_stats", "WHERE point_count > 0"):
+            problems["point_density"] = "empty"
+        if "scan_changes" not in problems and not has_rows("scan_changes") and has_rows("raw_scans"):
+            problems["scan_changes"] = "empty"
+        return problems
+
+    def report_missing_tables(self):
+        """Print which queries lack data and the command that fills it in"""
+        for table, state in self.missing_tables().items():
+            queries = [str(number) for number in self.queries if table in self._query_tables(number)]
+            if not queries:
+                continue
+            print(f"Table {table} is {state} in {self.db_path}, so {'query' if len(queries) == 1 else 'queries'} "
+                  f"{', '.join(queries)} {'cannot run' if state == 'missing' else 'lack its data'}; run: "
+                  f"{DERIVED_TABLES[table].format(db=self.db_path)}")
+
     def run_query(self, query_number):
-        """Run a specific query and return results as a pandas DataFrame"""
+        """Run a specific query and return results as a pandas DataFrame
+
+        Results are reused until the database's data version changes (never
+        for a database without one, see LiDARDatabase.data_version).
+        """
         if query_number not in self.queries:
             raise ValueError(f"Query number {query_number} not found")
         
-        conn = sqlite3.connect(self.db_path)
+        version = self.db.data_version()
+        cached = self._results.get(query_number)
+        if version is not None and cached is not None and cached[0] == version:
+            return cached[1]
         query = self.queries[query_number]['query']
+        missing = [table for table in self._query_tables(query_number) if table not in self.db.table_names()]
+        if missing:
+            print(f"Skipping query {query_number}: {self.db_path} has no {', '.join(missing)} "
+                  f"table{'s' if len(missing) > 1 else ''} yet")
+            return pd.DataFrame()
         try:
-            df = pd.read_sql_query(query, conn)
+            with span("analysis_query", query=query_number) as timing:
+                df = pd.read_sql_query(query, self.db.connect())
+                timing.add("rows", len(df))
             print(f"Query returned {len(df)} rows")
+            self._results[query_number] = (version, df)
             return df
         except Exception as e:
             print(f"Error executing query: {str(e)}")
             print(f"Query was: {query}")
             return pd.DataFrame()
-        finally:
-            conn.close()
 
     def visualize_query_results(self, query_number):
         """Create appropriate visualizations for query results"""
@@ -117,16 +207,12 @@ class LiDARDataAnalyzer:
             latest_scan = df['scan_id'].max()
             df_latest = df[df['scan_id'] == latest_scan]
             
-            # Create a 2D matrix for the heatmap
-            x_buckets = sorted(df_latest['x_bucket'].unique())
-            y_buckets = sorted(df_latest['y_bucket'].unique())
-            density_matrix = np.zeros((len(x_buckets), len(y_buckets)))
-            
-            # Fill the matrix
-            for _, row in df_latest.iterrows():
-                x_idx = x_buckets.index(row['x_bucket'])
-                y_idx = y_buckets.index(row['y_bucket'])
-                density_matrix[x_idx, y_idx] = row['point_density']
+            # Create a 2D matrix for the heatmap, buckets sorted, empty buckets 0
+            density = df_latest.pivot_table(index='x_bucket', columns='y_bucket', values='point_density',
+                                            aggfunc='last', fill_value=0).sort_index().sort_index(axis=1)
+            x_buckets = density.index.tolist()
+            y_buckets = density.columns.tolist()
+            density_matrix = density.to_numpy(dtype=float)
             
             fig, ax = plt.subplots(figsize=(12, 10))
             im = ax.imshow(density_matrix, cmap='viridis', origin='lower')
@@ -189,34 +275,107 @@ class LiDARDataAnalyzer:
         plt.tight_layout()
         return plt.gcf()
 
-    def run_all_analyses(self, save_plots=True):
-        """Run all analyses and optionally save plots"""
-        # Create output directory if it doesn't exist
-        if save_plots:
-            output_dir = "analysis_output"
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-        
-        for query_number in self.queries.keys():
-            print(f"\nRunning Query {query_number}: {self.queries[query_number]['description']}")
+    def cache_key(self, query_number, version=None):
+        """Key of a query's result: its SQL and the data version"""
+        version = self.db.data_version() if version is None else version
+        text = f"{version}\n{self.queries[query_number]['query']}"
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def analyze_query(self, query_number, output_path=None):
+        """Run one query, render its plot and save it to output_path if given
+
+        Returns a dict with the row count, the seconds taken, whether the
+        plot was saved and the printed report.
+        """
+        start = time.perf_counter()
+        report = io.StringIO()
+        saved = False
+        rows = 0
+        with contextlib.redirect_stdout(report):
             try:
                 df = self.run_query(query_number)
+                rows = len(df)
                 print("\nSample Results:")
                 print(df.head())
-                
+
                 fig = self.visualize_query_results(query_number)
-                if save_plots:
-                    output_path = os.path.join(output_dir, f'query_{query_number}_visualization.png')
+                if output_path:
                     fig.savefig(output_path)
+                    saved = True
                     print(f"Saved visualization to: {output_path}")
-                plt.close(fig)
-                
             except Exception as e:
                 print(f"Error analyzing query {query_number}: {str(e)}")
+            finally:
+                # Some plots open a second figure; close them all
+                plt.close('all')
+        return {"rows": rows, "seconds": time.perf_counter() - start, "saved": saved, "report": report.getvalue()}
+
+    def run_all_analyses(self, save_plots=True, workers=4, force=False, output_dir="analysis_output"):
+        """Run all analyses and optionally save plots
+
+        Queries run and render concurrently in worker processes with their own
+        read-only connections (workers=0 runs them here one by one). Saved
+        plots are listed in output_dir/analysis_cache.json with the data
+        version they show; a plot whose SQL and data are unchanged is kept
+        as it is unless force is set.
+        """
+        manifest_path = os.path.join(output_dir, CACHE_MANIFEST)
+        manifest = {}
+        if save_plots:
+            os.makedirs(output_dir, exist_ok=True)
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+
+        self.report_missing_tables()
+        version = self.db.data_version()
+        if version is None:
+            print(f"{self.db_path} predates write counting, so every plot is redrawn; open it read-write "
+                  f"once (python migrate_point_storage.py {self.db_path} --no-blobs) to cache them")
+        pending = []
+        for query_number in self.queries.keys():
+            key = None if version is None else self.cache_key(query_number, version)
+            output_path = None
+            if save_plots:
+                output_path = os.path.join(output_dir, f'query_{query_number}_visualization.png')
+                entry = manifest.get(str(query_number))
+                if not force and key and entry and entry["key"] == key and os.path.exists(output_path):
+                    print(f"\nQuery {query_number}: data unchanged, keeping {output_path}")
+                    continue
+            pending.append((query_number, key, output_path))
+
+        tasks = [(query_number, output_path) for query_number, _, output_path in pending]
+        if workers and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                                     initargs=(self.db_path, self.queries_path)) as executor:
+                results = list(executor.map(_analyze_in_worker, tasks))
+        else:
+            results = [self.analyze_query(*task) for task in tasks]
+
+        for (query_number, key, output_path), result in zip(pending, results):
+            print(f"\nRunning Query {query_number}: {self.queries[query_number]['description']}")
+            print(result["report"], end="")
+            if result["saved"] and key:
+                manifest[str(query_number)] = {"key": key, "path": output_path, "rows": result["rows"],
+                                               "seconds": result["seconds"]}
+        if save_plots:
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+        return results
 
 def main():
+    parser = argparse.ArgumentParser(description="Run the SQL analyses and save their plots")
+    parser.add_argument("--db", default="lidar_data.db", help="Database to analyze")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Worker processes running queries and plots (0 runs them in this process)")
+    parser.add_argument("--force", action="store_true", help="Regenerate plots even if their data is unchanged")
+    parser.add_argument("--output-dir", default="analysis_output", help="Directory for the plots")
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} does not exist; create it with ingest.py or sensor_pickle_to_xyz_csv.py first")
+
     # Create analyzer instance
-    analyzer = LiDARDataAnalyzer()
+    analyzer = LiDARDataAnalyzer(args.db)
     
     print("=== LiDAR Data Analysis ===")
     print("\nAvailable analyses:")
@@ -225,7 +384,7 @@ def main():
     
     # Run all analyses
     print("\nRunning all analyses...")
-    analyzer.run_all_analyses()
+    analyzer.run_all_analyses(workers=args.workers, force=args.force, output_dir=args.output_dir)
     
     print("\nAnalysis complete! Visualization files have been saved.")
 
@@ -0,0 +1,287 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import pickle
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from db_utils import LiDARDatabase
+from octomap_builder import READER, build_octomaps
+from point_io import CsvPointWriter, XyzBinWriter
+from sensor_pickle_to_xyz_csv import sensor_data_to_cartesian_coordinates
+from synthetic_data_generator import generate_dataset
+from voxel_map import VoxelMap
+
+QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lidar_analysis_queries.sql")
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+class StageTimes:
+    """Wall-clock time, call count and work done per pipeline stage"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def measure(self, name, items=1, points=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0, "points": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+            stage["items"] += items
+            stage["points"] += points
+            stage["peak_rss_mb"] = peak_rss_mb()
+
+    def skip(self, name, reason):
+        self.stages[name] = {"skipped": reason}
+
+    def report(self):
+        """Stages with derived throughput, in the order they first ran"""
+        result = {}
+        for name, stage in self.stages.items():
+            stage = dict(stage)
+            if "skipped" not in stage:
+                seconds = stage["seconds"]
+                stage["ms_per_item"] = seconds / stage["items"] * 1e3 if stage["items"] else None
+                stage["items_per_s"] = stage["items"] / seconds if seconds else None
+                stage["mpoints_per_s"] = stage["points"] / seconds / 1e6 if seconds and stage["points"] else None
+            result[name] = stage
+        return result
+
+def run_benchmark(workdir, scan_count, scene="raycast", seed=0, batch_size=50, read_sample=200,
+                  point_storage="blob", resolution=0.5, build_reader=True, log=sys.stderr):
+    """Run every pipeline stage on scan_count synthetic scans in workdir and return the results dict"""
+    times = StageTimes()
+    rng = random.Random(seed)
+
+    def progress(message):
+        if log is not None:
+            print(message, file=log)
+
+    progress(f"Generating {scan_count} {scene} scans")
+    with times.measure("generate", items=scan_count):
+        paths, poses, _ = generate_dataset(os.path.join(workdir, "scans"), scan_count, seed=seed, scene=scene,
+                                           fmt="pickle")
+    ordered_poses = [poses.get(path) for path in paths]
+
+    # Ingest one scan at a time, as sensor_pickle_to_xyz_csv does, so memory stays bounded
+    progress("Converting and storing")
+    db_path = os.path.join(workdir, "benchmark.db")
+    db = LiDARDatabase(db_path, point_storage=point_storage)
+    scan_ids = []
+    points_per_scan = 0
+    for batch_start in range(0, len(paths), batch_size):
+        with db.transaction():
+            for path, pose in zip(paths[batch_start:batch_start + batch_size],
+                                  ordered_poses[batch_start:batch_start + batch_size]):
+                with times.measure("pickle_load"):
+                    with open(path, "rb") as f:
+                        scan = pickle.load(f)
+                points_per_scan = scan.size
+                with times.measure("convert", points=scan.size):
+                    coordinates = sensor_data_to_cartesian_coordinates(scan)
+                with times.measure("store_raw_scan", points=scan.size):
+                    scan_id = db.store_raw_scan(scan, scan.shape[0], scan.shape[1])
+                if pose is not None:
+                    db.store_pose(scan_id, pose)
+                with times.measure("store_point_cloud", points=scan.size):
+                    db.store_point_cloud(scan_id, np.asarray(coordinates).T)
+                scan_ids.append(scan_id)
+    db.close()
+
+    progress("Reading back")
+    db = LiDARDatabase(db_path, readonly=True)
+    sample = rng.sample(scan_ids, min(read_sample, len(scan_ids)))
+    for scan_id in sample:
+        with times.measure("get_raw_scan_data", points=points_per_scan):
+            db.get_raw_scan_data(scan_id)
+        with times.measure("get_point_array", points=points_per_scan):
+            db.get_point_array(scan_id)
+        with times.measure("get_point_cloud_by_scan_id", points=points_per_scan):
+            db.get_point_cloud_by_scan_id(scan_id)
+        with times.measure("get_scan_stats"):
+            db.get_scan_stats(scan_id)
+        with times.measure("get_sensor_model"):
+            db.get_sensor_model(scan_id)
+    with times.measure("get_poses", items=len(scan_ids)):
+        db.get_poses(scan_ids)
+    with times.measure("get_latest_scans"):
+        db.get_latest_scans(limit=100)
+    for _ in range(20):
+        center = np.array([rng.uniform(-10, 10), rng.uniform(-10, 10), 1.0])
+        with times.measure("query_box"):
+            db.query_box(center - 2.0, center + 2.0)
+        with times.measure("query_radius"):
+            db.query_radius(center, 2.0)
+
+    try:
+        from analyze_lidar_data import LiDARDataAnalyzer
+    except ImportError as e:
+        times.skip("analysis", f"analyze_lidar_data unavailable: {e}")
+    else:
+        progress("Running analysis queries")
+        # The analyzer reports on stdout; keep it out of the JSON
+        with contextlib.redirect_stdout(io.StringIO()):
+            analyzer = LiDARDataAnalyzer(db_path, QUERIES_PATH)
+            for number in sorted(analyzer.queries):
+                with times.measure(f"analysis_query_{number}"):
+                    analyzer.run_query(number)
+            analyzer.db.close()
+
+    progress("Exporting points")
+    csv_path = os.path.join(workdir, "points.csv")
+    total_points = 0
+    with times.measure("export_csv", items=len(scan_ids)):
+        with open(csv_path, "w") as f:
+            writer = CsvPointWriter(f)
+            for scan_id in scan_ids:
+                points = db.get_point_array(scan_id)
+                writer.write_scan(points)
+                total_points += len(points)
+            writer.close()
+    times.stages["export_csv"]["points"] = total_points
+    os.remove(csv_path)
+
+    bin_path = os.path.join(workdir, "points.xyz.bin")
+    stored_poses = db.get_poses(scan_ids)
+    with times.measure("export_xyz_bin", items=len(scan_ids), points=total_points):
+        with open(bin_path, "wb") as f:
+            writer = XyzBinWriter(f)
+            for scan_id in scan_ids:
+                writer.write_scan(db.get_point_array(scan_id), stored_poses.get(scan_id))
+            writer.close()
+
+    progress("Building maps")
+    voxel_map = VoxelMap(resolution)
+    with times.measure("voxel_map_points", items=len(scan_ids), points=total_points):
+        for scan_id in scan_ids:
+            voxel_map.insert_points(db.get_point_array(scan_id))
+        voxel_map.write_bt(os.path.join(workdir, "voxel_map.bt"))
+    reader = os.path.join(os.path.dirname(os.path.abspath(__file__)), READER)
+    if not build_reader:
+        times.skip("my_point_cloud_reader", "disabled")
+    elif not os.access(reader, os.X_OK):
+        times.skip("my_point_cloud_reader", f"{reader} not built (run compile.sh)")
+    else:
+        with times.measure("my_point_cloud_reader", items=len(scan_ids), points=total_points):
+            build_octomaps(bin_path, os.path.join(workdir, "reader.bt"), [resolution], "points", reader=reader)
+    db.close()
+
+    db_size = sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+    return {
+        "benchmark": "pipeline",
+        "created": datetime.now().isoformat(),
+        "config": {"scans": scan_count, "scene": scene, "seed": seed, "batch_size": batch_size,
+                   "read_sample": len(sample), "point_storage": point_storage, "resolution": resolution,
+                   "points_per_scan": points_per_scan},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "stages": times.report(),
+        "peak_rss_mb": peak_rss_mb(),
+        "db_size_mb": db_size / 1e6,
+        "db_kib_per_scan": db_size / 1024 / max(1, scan_count),
+    }
+
+def compare_to_baseline(results, baseline, tolerance=0.25, min_seconds=0.01):
+    """Regressions of results against a baseline results dict
+
+    Stages are compared by time per item, so baselines taken with another
+    scan count stay comparable. Stages that took under min_seconds in both
+    runs are too noisy to judge and are left out.
+    """
+    regressions = []
+
+    def check(name, current, previous):
+        if current is not None and previous and current > previous * (1 + tolerance):
+            regressions.append({"metric": name, "baseline": previous, "current": current,
+                                "change": current / previous - 1})
+
+    for name, stage in results["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before or "skipped" in stage or "skipped" in before:
+            continue
+        if stage["seconds"] < min_seconds and before["seconds"] < min_seconds:
+            continue
+        check(f"{name}.ms_per_item", stage["ms_per_item"], before["ms_per_item"])
+    check("peak_rss_mb", results["peak_rss_mb"], baseline.get("peak_rss_mb"))
+    check("db_kib_per_scan", results["db_kib_per_scan"], baseline.get("db_kib_per_scan"))
+    return regressions
+
+def print_summary(results, regressions, stream=sys.stderr):
+    print(f"\n{'stage':<28}{'calls':>8}{'seconds':>10}{'ms/item':>10}{'Mpoints/s':>11}{'peak MB':>9}", file=stream)
+    for name, stage in results["stages"].items():
+        if "skipped" in stage:
+            print(f"{name:<28}  skipped: {stage['skipped']}", file=stream)
+            continue
+        mpoints = f"{stage['mpoints_per_s']:.2f}" if stage["mpoints_per_s"] else "-"
+        print(f"{name:<28}{stage['calls']:>8}{stage['seconds']:>10.3f}{stage['ms_per_item']:>10.3f}"
+              f"{mpoints:>11}{stage['peak_rss_mb']:>9.0f}", file=stream)
+    print(f"\nPeak RSS {results['peak_rss_mb']:.0f} MB, database {results['db_size_mb']:.1f} MB "
+          f"({results['db_kib_per_scan']:.1f} KiB/scan)", file=stream)
+    for regression in regressions:
+        print(f"REGRESSION {regression['metric']}: {regression['baseline']:.4g} -> {regression['current']:.4g} "
+              f"({regression['change']:+.0%})", file=stream)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on a synthetic workload")
+    parser.add_argument("--scans", type=int, default=100, help="Synthetic scans in the workload (1 to 10000)")
+    parser.add_argument("--scene", choices=("objects", "raycast"), default="raycast",
+                        help="Synthetic scene (see synthetic_data_generator.py)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the workload")
+    parser.add_argument("--batch-size", type=int, default=50, help="Scans stored per database commit")
+    parser.add_argument("--read-sample", type=int, default=200, help="Random scans read back by the get_* stages")
+    parser.add_argument("--point-storage", choices=("rows", "blob"), default="blob",
+                        help="Point storage mode of the benchmark database")
+    parser.add_argument("--resolution", type=float, default=0.5, help="Leaf size of the map building stages")
+    parser.add_argument("--no-reader", action="store_true", help="Skip the my_point_cloud_reader stage")
+    parser.add_argument("--workdir", help="Directory for the temporary workload and database")
+    parser.add_argument("--output", default="-", help="Results JSON ('-' for stdout)")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Slowdown over the baseline reported as a regression (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    if not 1 <= args.scans <= 10000:
+        parser.error("--scans must be between 1 and 10000")
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        results = run_benchmark(workdir, args.scans, args.scene, args.seed, args.batch_size, args.read_sample,
+                                args.point_storage, args.resolution, not args.no_reader)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        results["baseline"] = {"path": args.baseline, "created": baseline.get("created"),
+                               "tolerance": args.tolerance, "regressions": regressions}
+    print_summary(results, regressions)
+
+    text = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
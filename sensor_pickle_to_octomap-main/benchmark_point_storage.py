@@ -0,0 +1,82 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from db_utils import LiDARDatabase
+from projection import project_scans
+from synthetic_data_generator import SyntheticLiDARGenerator
+
+def run_mode(workdir, name, storage, codec, scan_count, point_pool, read_sample, scans_per_commit):
+    """Ingest scan_count scans with one storage mode and read a random sample back"""
+    db_path = os.path.join(workdir, name.replace("/", "_") + ".db")
+    db = LiDARDatabase(db_path, point_storage=storage, point_codec=codec)
+    points_per_scan = point_pool.shape[1]
+
+    start = time.perf_counter()
+    for batch_start in range(1, scan_count + 1, scans_per_commit):
+        with db.transaction():
+            for scan_id in range(batch_start, min(batch_start + scans_per_commit, scan_count + 1)):
+                db.store_point_cloud(scan_id, point_pool[scan_id % len(point_pool)])
+    ingest_seconds = time.perf_counter() - start
+
+    sample = random.sample(range(1, scan_count + 1), min(read_sample, scan_count))
+    start = time.perf_counter()
+    for scan_id in sample:
+        points = db.get_point_array(scan_id)
+        assert points.shape == (points_per_scan, 3)
+    read_seconds = time.perf_counter() - start
+
+    db.close()
+    size = os.path.getsize(db_path)
+    os.remove(db_path)
+    return {
+        "mode": name,
+        "scans": scan_count,
+        "ingest_ms_per_scan": ingest_seconds / scan_count * 1e3,
+        "ingest_mpoints_per_s": scan_count * points_per_scan / ingest_seconds / 1e6,
+        "read_ms_per_scan": read_seconds / len(sample) * 1e3,
+        "kib_per_scan": size / scan_count / 1024,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark point cloud storage modes")
+    parser.add_argument("--scans", type=int, default=10000, help="Scans ingested per blob mode")
+    parser.add_argument("--row-scans", type=int, default=200,
+                        help="Scans ingested in row-per-point mode (it is far slower)")
+    parser.add_argument("--read-sample", type=int, default=200, help="Random scans read back per mode")
+    parser.add_argument("--scans-per-commit", type=int, default=100, help="Scans stored per transaction")
+    parser.add_argument("--workdir", help="Directory for the temporary databases")
+    args = parser.parse_args()
+
+    generator = SyntheticLiDARGenerator()
+    point_pool = project_scans(generator.generate_multiple_scans(num_scans=16))
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        results = [
+            run_mode(workdir, "rows", "rows", "shuffle-zlib", args.row_scans, point_pool, args.read_sample,
+                     args.scans_per_commit),
+            run_mode(workdir, "blob/raw", "blob", "raw", args.scans, point_pool, args.read_sample,
+                     args.scans_per_commit),
+            run_mode(workdir, "blob/shuffle-zlib", "blob", "shuffle-zlib", args.scans, point_pool, args.read_sample,
+                     args.scans_per_commit),
+        ]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'mode':<20}{'scans':>8}{'ingest ms/scan':>16}{'Mpoints/s':>11}"
+          f"{'read ms/scan':>14}{'KiB/scan':>10}")
+    for r in results:
+        print(f"{r['mode']:<20}{r['scans']:>8}{r['ingest_ms_per_scan']:>16.2f}"
+              f"{r['ingest_mpoints_per_s']:>11.2f}{r['read_ms_per_scan']:>14.2f}{r['kib_per_scan']:>10.1f}")
+
+    rows = results[0]
+    for r in results[1:]:
+        print(f"{r['mode']}: ingest {rows['ingest_ms_per_scan'] / r['ingest_ms_per_scan']:.0f}x faster, "
+              f"read {rows['read_ms_per_scan'] / r['read_ms_per_scan']:.0f}x faster, "
+              f"{rows['kib_per_scan'] / r['kib_per_scan']:.1f}x smaller than rows")
+
+if __name__ == "__main__":
+    main()
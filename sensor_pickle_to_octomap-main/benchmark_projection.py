@@ -0,0 +1,88 @@
+import argparse
+import math
+import pickle
+import time
+import numpy as np
+from pose import transform_scans
+from projection import project_scan, project_scans
+from sensor_model import SensorModel, default_sensor_model
+
+def legacy_sensor_data_to_cartesian_coordinates(sensor_data):
+    """Per-beam loop formerly used by sensor_pickle_to_xyz_csv (reference only)"""
+    cartesian_coordinates = [[],[],[]]
+    for altitude_angle_index, data in enumerate(sensor_data):
+        for encoder_angle_index, item in enumerate(data):
+            radius = item
+            encoder_angle = encoder_angle_index * math.pi / 512
+            altitude_angle = ( -22 + altitude_angle_index * ( ( 21.4764 * 2 + 1 ) / 32 ) ) * math.pi / 180
+
+            x = radius * math.cos(encoder_angle) * math.cos(altitude_angle)
+            y = radius * math.sin(encoder_angle) * math.cos(altitude_angle)
+            z = -1.0 * radius * math.sin(altitude_angle)
+
+            cartesian_coordinates[0].append(x)
+            cartesian_coordinates[1].append(y)
+            cartesian_coordinates[2].append(z)
+    return cartesian_coordinates
+
+def time_call(func, repeat):
+    """Return the best wall-clock time of func() over repeat runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scan-to-Cartesian conversion")
+    parser.add_argument("pickle_file", nargs="?", help="Scan pickle to convert (default: random 32x512 scan)")
+    parser.add_argument("--batch", type=int, default=64, help="Number of scans in the batched run")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions per measurement")
+    args = parser.parse_args()
+
+    if args.pickle_file:
+        with open(args.pickle_file, "rb") as f:
+            scan = np.asarray(pickle.load(f), dtype=np.float64)
+    else:
+        scan = np.random.uniform(0.5, 10.0, size=(32, 512))
+    scans = np.repeat(scan[np.newaxis], args.batch, axis=0)
+    points_per_scan = scan.size
+    # The loop hardcodes pi/512 encoder steps, i.e. 1024 counts per revolution
+    model = SensorModel(default_sensor_model(scan.shape[0]).altitude_angles_deg,
+                        counts_per_revolution=1024, name="legacy")
+
+    # Check the engine against the reference loop before timing anything
+    reference = np.array(legacy_sensor_data_to_cartesian_coordinates(scan)).T
+    exact = project_scan(scan, model, dtype=np.float64)
+    fast = project_scan(scan, model)
+    print(f"Scan shape: {scan.shape} ({points_per_scan} points)")
+    scale = np.maximum(np.abs(reference), 1.0)
+    print(f"float64 max relative difference vs loop: {(np.abs(exact - reference) / scale).max():.3e}")
+    print(f"float32 max relative difference vs loop: {(np.abs(fast - reference) / scale).max():.3e}")
+
+    loop_time = time_call(lambda: legacy_sensor_data_to_cartesian_coordinates(scan), args.repeat)
+    scan_time = time_call(lambda: project_scan(scan, model), args.repeat)
+    batch_time = time_call(lambda: project_scans(scans, model), args.repeat)
+    # A drone pose per scan: the batch is projected straight into the map frame
+    angles = np.linspace(0, np.pi, args.batch)
+    poses = np.column_stack([angles, angles, np.zeros(args.batch),
+                             np.cos(angles / 2), np.zeros(args.batch), np.zeros(args.batch), np.sin(angles / 2)])
+    posed = project_scans(scans, model, np.float64, poses)
+    transformed = transform_scans(project_scans(scans, model, np.float64), poses)
+    print(f"posed max difference vs transform_scans: {np.abs(posed - transformed).max():.3e}")
+    posed_time = time_call(lambda: project_scans(scans, model, poses=poses), args.repeat)
+
+    print(f"\n{'method':<28}{'ms/scan':>10}{'Mpoints/s':>12}{'speedup':>10}")
+    for name, seconds, count in (
+        ("python loop", loop_time, 1),
+        ("project_scan", scan_time, 1),
+        (f"project_scans (batch={args.batch})", batch_time, args.batch),
+        ("  with poses", posed_time, args.batch),
+    ):
+        per_scan = seconds / count
+        print(f"{name:<28}{per_scan * 1e3:>10.3f}"
+              f"{points_per_scan / per_scan / 1e6:>12.2f}{loop_time / per_scan:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import glob
+import os
+import pickle
+import time
+from collections import Counter
+import numpy as np
+from range_codec import DEFAULT_RANGE_SCALE, RANGE_CODECS, decode_ranges, encode_ranges
+from scan_container import ScanContainer, is_scan_container
+
+def load_scans(paths):
+    """Scans from pickles and .scans containers"""
+    scans = []
+    for path in paths:
+        if is_scan_container(path):
+            scans.extend(np.array(scan) for scan in ScanContainer(path))
+        else:
+            with open(path, "rb") as f:
+                scans.append(np.asarray(pickle.load(f)))
+    return scans
+
+def run_codec(scans, codec, scale, repeat):
+    """Best-of-repeat encode and decode times for all scans, plus size and error"""
+    encode_seconds = decode_seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encoded = [encode_ranges(scan, codec, scale) for scan in scans]
+        encode_seconds = min(encode_seconds, time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = [decode_ranges(payload, scan.shape, used, used_scale, scan.dtype.str)
+                   for scan, (used, used_scale, payload) in zip(scans, encoded)]
+        decode_seconds = min(decode_seconds, time.perf_counter() - start)
+
+    raw_bytes = sum(scan.nbytes for scan in scans)
+    max_error = 0.0
+    for scan, ranges in zip(scans, decoded):
+        finite = np.isfinite(scan)
+        if not np.array_equal(np.isfinite(ranges), finite):
+            raise AssertionError(f"{codec} changed which readings are finite")
+        if finite.any():
+            max_error = max(max_error, float(np.max(np.abs(ranges[finite].astype(np.float64) - scan[finite]))))
+    return {
+        "codec": codec,
+        "ratio": raw_bytes / sum(len(payload) for _, _, payload in encoded),
+        "encode_mb_s": raw_bytes / encode_seconds / 1e6,
+        "decode_mb_s": raw_bytes / decode_seconds / 1e6,
+        "max_error": max_error,
+        "stored_as": Counter(used for used, _, _ in encoded),
+    }
+
+def print_results(label, scans, scale, repeat):
+    raw_bytes = sum(scan.nbytes for scan in scans)
+    print(f"\n{label}: {len(scans)} scans, {raw_bytes / 1e6:.2f} MB as stored by the raw codec")
+    print(f"{'codec':<16}{'ratio':>8}{'encode MB/s':>13}{'decode MB/s':>13}{'max error':>12}  stored as")
+    for codec in RANGE_CODECS:
+        result = run_codec(scans, codec, scale, repeat)
+        stored_as = ", ".join(f"{name} x{count}" for name, count in result["stored_as"].items())
+        print(f"{codec:<16}{result['ratio']:>8.2f}{result['encode_mb_s']:>13.1f}{result['decode_mb_s']:>13.1f}"
+              f"{result['max_error']:>12.2e}  {stored_as}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark raw_scans range codecs")
+    parser.add_argument("files", nargs="*",
+                        help="Scan pickles or .scans containers (default: synthetic_data/*.pickle, in metres, "
+                             "and test.pickle, in millimetres, separately)")
+    parser.add_argument("--scale", type=float, default=DEFAULT_RANGE_SCALE,
+                        help="Fixed-point step in range units (default: chosen per scan)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per measurement")
+    args = parser.parse_args()
+
+    if args.files:
+        datasets = [("given scans", args.files)]
+    else:
+        datasets = [("synthetic_data (metres)", sorted(glob.glob(os.path.join("synthetic_data", "*.pickle")))),
+                    ("test.pickle (millimetres)", ["test.pickle"] if os.path.exists("test.pickle") else [])]
+        datasets = [(label, paths) for label, paths in datasets if paths]
+    if not datasets:
+        parser.error("no scans given, synthetic_data/ is empty (run synthetic_data_generator.py) "
+                     "and there is no test.pickle")
+    for label, paths in datasets:
+        print_results(label, load_scans(paths), args.scale, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import argparse
+import collections
+import warnings
+import numpy as np
+from db_utils import LiDARDatabase
+from point_io import write_points
+from pose import transform_points
+from range_codec import NO_RETURN_RANGE
+
+ScanChange = collections.namedtuple("ScanChange", "scan_id reference_scan_ids summary points")
+
+def valid_ranges(scan, max_range=None):
+    """Mask of readings that hit something: finite, positive, not NO_RETURN_RANGE and, with max_range, closer than it"""
+    scan = np.asarray(scan, dtype=np.float64)
+    valid = np.isfinite(scan) & (scan > 0) & (scan != NO_RETURN_RANGE)
+    if max_range is not None:
+        with np.errstate(invalid="ignore"):
+            valid &= scan < max_range
+    return valid
+
+def reference_ranges(scans, max_range=None):
+    """Per-beam median of a window of (altitude, encoder) scans, NaN where no scan has a return"""
+    stack = np.array(scans, dtype=np.float64)
+    stack[~valid_ranges(stack, max_range)] = np.nan
+    if len(stack) == 1:
+        return stack[0]
+    with warnings.catch_warnings():
+        # Beams without any return in the window are expected
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(stack, axis=0)
+
+def neighbour_counts(mask):
+    """Number of set cells among the 8 neighbours of each cell
+
+    Rows (rings) do not wrap; columns wrap around, since encoder steps
+    cover a full revolution.
+    """
+    padded = np.pad(mask.astype(np.int16), ((1, 1), (0, 0)))
+    rows = padded[:-2] + padded[1:-1] + padded[2:]
+    counts = rows + np.roll(rows, 1, axis=1) + np.roll(rows, -1, axis=1)
+    return counts - mask
+
+def diff_ranges(reference, current, abs_tolerance=0.1, rel_tolerance=0.02, max_range=None, min_neighbours=0):
+    """Compare two (altitude, encoder) range images beam by beam
+
+    A beam changed if both readings hit and differ by more than
+    abs_tolerance + rel_tolerance * the nearer range, or if only one of them
+    hit. Changed beams with fewer than min_neighbours changed neighbours
+    are dropped as noise. Returns (changed, closer, difference): closer
+    marks changes where something is now nearer (or newly hit), and
+    difference is current - reference (NaN unless both hit).
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    current = np.asarray(current, dtype=np.float64)
+    if reference.shape != current.shape:
+        raise ValueError(f"Scan shapes differ: {reference.shape} and {current.shape}")
+    reference_hit = valid_ranges(reference, max_range)
+    current_hit = valid_ranges(current, max_range)
+    both = reference_hit & current_hit
+
+    difference = np.where(both, current - reference, np.nan)
+    tolerance = abs_tolerance + rel_tolerance * np.fmin(reference, current)
+    with np.errstate(invalid="ignore"):
+        moved = both & (np.abs(difference) > tolerance)
+        changed = moved | (reference_hit != current_hit)
+        closer = (moved & (difference < 0)) | (current_hit & ~reference_hit)
+    if min_neighbours:
+        changed &= neighbour_counts(changed) >= min_neighbours
+        closer &= changed
+    return changed, closer, difference
+
+def summarize_change(changed, closer, difference, reference, current, max_range=None):
+    """Counts of a diff_ranges result, keyed like db_utils.SCAN_CHANGE_COLUMNS (without the ids)"""
+    reference_hit = valid_ranges(reference, max_range)
+    current_hit = valid_ranges(current, max_range)
+    moved = changed & reference_hit & current_hit
+    return {
+        "changed_count": int(changed.sum()),
+        "closer_count": int(closer.sum()),
+        "farther_count": int((changed & ~closer).sum()),
+        "appeared_count": int((changed & current_hit & ~reference_hit).sum()),
+        "vanished_count": int((changed & reference_hit & ~current_hit).sum()),
+        "mean_abs_change": float(np.abs(difference[moved]).mean()) if moved.any() else None,
+    }
+
+def changed_points(reference, current, changed, closer, sensor_model, pose=None):
+    """(N, 3) points of the changed beams
+
+    Beams where something came closer give the current hit; beams where
+    something went away give the reference hit, i.e. where it used to be.
+    With a pose the points are moved into the map frame.
+    """
+    directions = sensor_model.direction_table(current.shape[1])
+    flat = np.flatnonzero(changed)
+    ranges = np.where(closer, current, reference).reshape(-1)[flat]
+    points = directions[flat] * ranges[:, np.newaxis]
+    if pose is not None:
+        points = transform_points(points, pose)
+    return points.astype(np.float32)
+
+def detect_changes(db, scan_ids=None, window=1, abs_tolerance=0.1, rel_tolerance=0.02, max_range=None,
+                   min_neighbours=0, store=True, compare_after=None):
+    """Stream over scans, comparing each with the per-beam median of the window scans before it
+
+    scan_ids default to every stored scan in order. Only window raw scans
+    are held in memory at a time; the window restarts when the scan shape
+    or sensor model changes. window=1 compares consecutive scans. The
+    comparison is per beam, so it finds what moved for a sensor that stays
+    put (or between scans taken from nearly the same pose). Scans up to
+    compare_after only fill the window. Yields a ScanChange per compared
+    scan and stores it when store is set.
+    """
+    if scan_ids is None:
+        scan_ids = db.get_scan_ids()
+    history = collections.deque(maxlen=window)
+    for scan_id in scan_ids:
+        current = db.get_raw_scan_data(scan_id)
+        if current is None:
+            continue
+        sensor_model = db.get_sensor_model(scan_id)
+        if history and (history[-1][1].shape != current.shape or history[-1][2] != sensor_model):
+            history.clear()
+        if history and (compare_after is None or scan_id > compare_after):
+            reference_ids = [entry[0] for entry in history]
+            reference = reference_ranges([entry[1] for entry in history], max_range)
+            changed, closer, difference = diff_ranges(reference, current, abs_tolerance, rel_tolerance,
+                                                      max_range, min_neighbours)
+            summary = summarize_change(changed, closer, difference, reference, current, max_range)
+            summary["reference_scan_id"] = reference_ids[-1]
+            summary["window_size"] = len(reference_ids)
+            points = changed_points(reference, current, changed, closer, sensor_model, db.get_pose(scan_id))
+            if store:
+                db.store_scan_change(scan_id, summary, points)
+            yield ScanChange(scan_id, reference_ids, summary, points)
+        history.append((scan_id, current, sensor_model))
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect what changed between consecutive scans of a flight")
+    parser.add_argument("--db", default="lidar_data.db", help="Database with the raw scans")
+    parser.add_argument("--window", type=int, default=1,
+                        help="Compare each scan with the per-beam median of this many scans before it")
+    parser.add_argument("--abs-tolerance", type=float, default=0.1, help="Range change always ignored")
+    parser.add_argument("--rel-tolerance", type=float, default=0.02,
+                        help="Range change ignored per unit of range (noise grows with distance)")
+    parser.add_argument("--max-range", type=float,
+                        help="Readings at or beyond this are no-returns (the sensor maximum distance)")
+    parser.add_argument("--min-neighbours", type=int, default=0,
+                        help="Changed neighbours a changed beam needs to count (drops isolated flicker)")
+    parser.add_argument("--new-only", action="store_true",
+                        help="Only compare scans after the last one with stored changes")
+    parser.add_argument("--points", help="Also write the changed points to this point file, one block per scan")
+    args = parser.parse_args()
+
+    db = LiDARDatabase(args.db)
+    after = last = None
+    if args.new_only:
+        last = db.connect().execute("SELECT MAX(scan_id) FROM scan_changes").fetchone()[0]
+        # Start far enough back to fill the window before the first new scan
+        if last is not None:
+            earlier = [scan_id for scan_id in db.get_scan_ids() if scan_id <= last]
+            after = earlier[-args.window - 1] if len(earlier) > args.window else None
+    scan_ids = db.get_scan_ids(after)
+
+    changes = []
+    with db.transaction():
+        for change in detect_changes(db, scan_ids, args.window, args.abs_tolerance, args.rel_tolerance,
+                                     args.max_range, args.min_neighbours, compare_after=last):
+            summary = change.summary
+            print(f"Scan {change.scan_id} vs {change.reference_scan_ids[-1]}: {summary['changed_count']} changed "
+                  f"({summary['closer_count']} closer, {summary['farther_count']} farther)")
+            if args.points:
+                changes.append(change.points)
+    if args.points:
+        write_points(args.points, changes)
+    db.close()
+
+if __name__ == "__main__":
+    main()
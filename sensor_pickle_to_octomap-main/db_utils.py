@@ -1,16 +1,344 @@
+import hashlib
+import json
 import sqlite3
+import threading
+import uuid
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
 import numpy as np
+from instrumentation import count, instrumented, span
+from range_codec import DEFAULT_RANGE_SCALE, RANGE_CODECS, decode_ranges, encode_ranges
+from sensor_model import SensorModel, default_sensor_model
+
+# Point storage modes: one SQLite row per point, or one BLOB per scan
+POINT_STORAGE_MODES = ("rows", "blob")
+
+# Codecs for point_blobs.data:
+#   raw          interleaved float32 x,y,z (read back zero-copy)
+#   shuffle-zlib float32 columns split into byte planes, then zlib
+POINT_BLOB_CODECS = ("raw", "shuffle-zlib")
+
+# Applied to every connection. WAL lets readers (e.g. LiDARDataAnalyzer) run
+# while ingestion writes; synchronous=NORMAL is durable in WAL mode except
+# for the last transactions on power loss.
+CONNECTION_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+)
+WRITER_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+)
+
+def encode_point_blob(points, codec="shuffle-zlib"):
+    """Encode an (N, 3) point array as a point_blobs payload"""
+    points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3)
+    if codec == "raw":
+        return points.tobytes()
+    if codec == "shuffle-zlib":
+        # (N, 3, 4) bytes -> (4, 3, N): each byte plane of each column is
+        # contiguous, which zlib compresses far better than interleaved floats
+        planes = points.view(np.uint8).reshape(-1, 3, 4).transpose(2, 1, 0)
+        return zlib.compress(planes.tobytes(), 1)
+    raise ValueError(f"Unknown point blob codec: {codec}")
+
+def decode_point_blob(data, point_count, codec):
+    """Decode a point_blobs payload into an (N, 3) float32 array"""
+    if codec == "raw":
+        # Zero-copy view on the BLOB returned by SQLite (read-only)
+        return np.frombuffer(data, dtype=np.float32).reshape(point_count, 3)
+    if codec == "shuffle-zlib":
+        planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(4, 3, point_count)
+        return np.ascontiguousarray(planes.transpose(2, 1, 0)).view(np.float32).reshape(point_count, 3)
+    raise ValueError(f"Unknown point blob codec: {codec}")
+
+# Edge length of the spatial index cells. 5 m matches the buckets of the
+# point distribution analysis (query 5).
+DEFAULT_INDEX_CELL_SIZE = 5.0
+
+def _cell_coordinates(points, cell_size):
+    """Integer cell coordinates ROUND(coordinate / cell_size), rounding half away from zero like SQLite"""
+    scaled = np.asarray(points, dtype=np.float64) / cell_size
+    return np.trunc(scaled + np.copysign(0.5, scaled)).astype(np.int64)
+
+def spatial_cells(points, cell_size):
+    """Group points into cubic cells of cell_size
+
+    Returns (order, cells): points[order] lists the points cell by cell
+    (non-finite points last, unindexed), and cells is a list of
+    (cell_x, cell_y, cell_z, first_index, point_count, min_xyz, max_xyz)
+    where first_index is the offset of the cell in points[order]. Cell
+    coordinates are ROUND(coordinate / cell_size) with SQLite's rounding.
+    """
+    points = np.asarray(points).reshape(-1, 3)
+    finite = np.isfinite(points).all(axis=1)
+    finite_count = int(finite.sum())
+    if finite_count == 0:
+        return np.arange(len(points)), []
+    all_finite = finite_count == len(points)
+
+    keys = _cell_coordinates(points if all_finite else points[finite], cell_size)
+
+    # Pack the three cell coordinates into one sortable integer
+    low = keys.min(axis=0)
+    span = keys.max(axis=0) - low + 1
+    if float(span[0]) * float(span[1]) * float(span[2]) < 2**62:
+        packed = ((keys[:, 0] - low[0]) * span[1] + (keys[:, 1] - low[1])) * span[2] + (keys[:, 2] - low[2])
+    else:
+        # Far-away outliers: rank the distinct cells instead
+        packed = np.unique(keys, axis=0, return_inverse=True)[1].reshape(-1)
+    finite_order = np.argsort(packed)
+    if all_finite:
+        order = finite_order
+    else:
+        # Non-finite points go last and are not indexed
+        order = np.concatenate((np.nonzero(finite)[0][finite_order], np.nonzero(~finite)[0]))
+
+    sorted_packed = packed[finite_order]
+    sorted_points = points[order[:finite_count]]
+    starts = np.concatenate(([0], np.nonzero(sorted_packed[1:] != sorted_packed[:-1])[0] + 1))
+    counts = np.diff(np.append(starts, finite_count))
+    mins = np.minimum.reduceat(sorted_points, starts, axis=0)
+    maxs = np.maximum.reduceat(sorted_points, starts, axis=0)
+
+    cells = [
+        (int(key[0]), int(key[1]), int(key[2]), int(start), int(count), low_corner, high_corner)
+        for key, start, count, low_corner, high_corner in zip(
+            keys[finite_order[starts]].tolist(), starts.tolist(), counts.tolist(),
+            mins.tolist(), maxs.tolist())
+    ]
+    return order, cells
+
+def density_cells(points, cell_size=None):
+    """(cell_x, cell_y, point_count) of the horizontal cells holding a scan's finite points (query 5)"""
+    cell_size = cell_size or DENSITY_CELL_SIZE
+    points = np.asarray(points).reshape(-1, 3)
+    points = points[np.isfinite(points).all(axis=1)]
+    if len(points) == 0:
+        return []
+    cells, counts = np.unique(_cell_coordinates(points[:, :2], cell_size), axis=0, return_counts=True)
+    return [(x, y, count) for (x, y), count in zip(cells.tolist(), counts.tolist())]
+
+# Horizontal distance bounds of the near/medium/far categories (query 8)
+NEAR_DISTANCE = 2.0
+MEDIUM_DISTANCE = 5.0
+# Points beyond this on any axis, or closer than ANOMALY_MIN_DISTANCE to the
+# sensor, are counted as anomalies (query 10)
+ANOMALY_MAX_COORDINATE = 100.0
+ANOMALY_MIN_DISTANCE = 0.1
+# Range histogram: 1 m bins up to 100 m, the last bin collects everything beyond
+RANGE_HISTOGRAM_BIN_WIDTH = 1.0
+RANGE_HISTOGRAM_BINS = 101
+# Horizontal cell size of the point_density table (query 5), independent of the spatial index
+DENSITY_CELL_SIZE = 5.0
+
+SCAN_STATS_COLUMNS = (
+    "point_count",
+    "min_x", "max_x", "min_y", "max_y", "min_z", "max_z",
+    "avg_x", "avg_y", "avg_z",
+    "max_distance", "avg_distance", "rms_distance",
+    "near_count", "near_avg_distance",
+    "medium_count", "medium_avg_distance",
+    "far_count", "far_avg_distance",
+    "anomaly_count",
+    "range_histogram",
+)
+
+# Summary of one scan's range-image change against its reference scans (see change_detection)
+SCAN_CHANGE_COLUMNS = (
+    "reference_scan_id",
+    "window_size",
+    "changed_count",
+    "closer_count",
+    "farther_count",
+    "appeared_count",
+    "vanished_count",
+    "mean_abs_change",
+)
+
+# One tile of a tiled map (see tiled_map): its grid index, bounds and file
+MAP_TILE_COLUMNS = (
+    "map_name", "resolution", "tile_size",
+    "tile_x", "tile_y", "tile_z",
+    "min_x", "max_x", "min_y", "max_y", "min_z", "max_z",
+    "file_path", "voxel_count", "file_size", "version", "timestamp",
+)
+
+# Tables whose writes change data_version (see _create_tables)
+VERSIONED_TABLES = (
+    "sensor_models", "raw_scans", "point_blobs", "point_orders", "scan_stats", "octomaps", "octomap_scans",
+    "scan_products", "map_tiles", "scan_changes", "poses",
+)
+
+def compute_scan_stats(points):
+    """Summary statistics of one scan's (N, 3) points, keyed by SCAN_STATS_COLUMNS
+
+    Non-finite points only count towards anomaly_count.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    finite_mask = np.isfinite(points).all(axis=1)
+    finite = points[finite_mask]
+    distance = np.sqrt(np.einsum("ij,ij->i", finite, finite))
+    horizontal = np.hypot(finite[:, 0], finite[:, 1])
+    anomalies = (np.abs(finite) > ANOMALY_MAX_COORDINATE).any(axis=1) | (distance < ANOMALY_MIN_DISTANCE)
+
+    stats = dict.fromkeys(SCAN_STATS_COLUMNS)
+    stats["point_count"] = len(finite)
+    stats["anomaly_count"] = int(anomalies.sum()) + len(points) - len(finite)
+    bins = np.minimum(distance // RANGE_HISTOGRAM_BIN_WIDTH, RANGE_HISTOGRAM_BINS - 1).astype(np.int64)
+    stats["range_histogram"] = json.dumps(np.bincount(bins, minlength=RANGE_HISTOGRAM_BINS).tolist())
+    if len(finite) == 0:
+        stats.update(near_count=0, medium_count=0, far_count=0)
+        return stats
+
+    low, high, mean = finite.min(axis=0), finite.max(axis=0), finite.mean(axis=0)
+    stats.update(
+        min_x=low[0], max_x=high[0], min_y=low[1], max_y=high[1], min_z=low[2], max_z=high[2],
+        avg_x=mean[0], avg_y=mean[1], avg_z=mean[2],
+        max_distance=distance.max(),
+        avg_distance=distance.mean(),
+        rms_distance=np.sqrt(np.mean(distance * distance)),
+    )
+    near = horizontal <= NEAR_DISTANCE
+    medium = ~near & (horizontal <= MEDIUM_DISTANCE)
+    far = ~near & ~medium
+    for name, mask in (("near", near), ("medium", medium), ("far", far)):
+        count = int(mask.sum())
+        stats[f"{name}_count"] = count
+        stats[f"{name}_avg_distance"] = distance[mask].mean() if count else None
+    return {key: float(value) if isinstance(value, np.floating) else value for key, value in stats.items()}
+
+def scan_content_hash(scan, sensor_model=None):
+    """Hex SHA-1 identifying a range scan: its little-endian ranges, shape, dtype and sensor model
+
+    A missing sensor model stands for the default geometry, as in store_raw_scan.
+    """
+    scan = np.asarray(scan)
+    scan = np.ascontiguousarray(scan, dtype=scan.dtype.newbyteorder("<"))
+    sensor_model = sensor_model or default_sensor_model(scan.shape[0])
+    digest = hashlib.sha1(f"{scan.shape} {scan.dtype.str} {sensor_model.to_json()}\n".encode("utf-8"))
+    digest.update(scan.tobytes())
+    return digest.hexdigest()
+
+def _merge_ranges(ranges):
+    """Merge sorted (start, count) ranges that touch"""
+    merged = []
+    for start, count in ranges:
+        if merged and merged[-1][0] + merged[-1][1] == start:
+            merged[-1][1] += count
+        else:
+            merged.append([start, count])
+    return merged
 
 class LiDARDatabase:
-    def __init__(self, db_path="lidar_data.db"):
+    """SQLite store for raw scans, point clouds and octomap metadata
+
+    Keeps one long-lived connection per instance. Every store_* call runs in
+    its own transaction unless it is made inside `with db.transaction():`,
+    in which case all of them are committed together. Open with
+    readonly=True for analysis while another process is ingesting.
+    """
+
+    def __init__(self, db_path="lidar_data.db", point_storage="rows", point_codec="shuffle-zlib",
+                 readonly=False, index_cell_size=DEFAULT_INDEX_CELL_SIZE, range_codec="raw",
+                 range_scale=DEFAULT_RANGE_SCALE):
+        if point_storage not in POINT_STORAGE_MODES:
+            raise ValueError(f"Unknown point storage mode: {point_storage}")
+        if point_codec not in POINT_BLOB_CODECS:
+            raise ValueError(f"Unknown point blob codec: {point_codec}")
+        if range_codec not in RANGE_CODECS:
+            raise ValueError(f"Unknown range codec: {range_codec}")
         self.db_path = db_path
-        self.init_database()
+        self.point_storage = point_storage
+        self.point_codec = point_codec
+        # Encoding of raw_scans.data (see range_codec); the codec used is stored per row
+        self.range_codec = range_codec
+        self.range_scale = range_scale
+        self.readonly = readonly
+        # Cell size of the spatial index written with each point cloud (None disables it)
+        self.index_cell_size = index_cell_size
+        self._conn = None
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
+        self._model_ids = {}
+        if not readonly:
+            self.init_database()
+
+    def connect(self):
+        """Return the instance's connection, opening it on first use"""
+        if self._conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True,
+                                       isolation_level=None, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+                for pragma in WRITER_PRAGMAS:
+                    conn.execute(pragma)
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        """Close the connection; the next call reopens it"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one commit; nested calls become savepoints"""
+        with self._lock:
+            conn = self.connect()
+            depth = self._transaction_depth
+            savepoint = f"sp_{depth}"
+            conn.execute("BEGIN IMMEDIATE" if depth == 0 else f"SAVEPOINT {savepoint}")
+            # Sensor models cached during a rolled back (sub)transaction were never stored
+            model_ids = dict(self._model_ids)
+            self._transaction_depth += 1
+            try:
+                yield conn.cursor()
+            except BaseException:
+                self._transaction_depth -= 1
+                if depth == 0:
+                    conn.execute("ROLLBACK")
+                else:
+                    conn.execute(f"ROLLBACK TO {savepoint}")
+                    conn.execute(f"RELEASE {savepoint}")
+                self._model_ids = model_ids
+                raise
+            self._transaction_depth -= 1
+            if depth == 0:
+                with span("db_commit"):
+                    conn.execute("COMMIT")
+            else:
+                conn.execute(f"RELEASE {savepoint}")
 
     def init_database(self):
         """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        with self.transaction() as c:
+            self._create_tables(c)
+
+    def _create_tables(self, c):
+
+        # Create table for sensor geometry models shared by raw scans
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_models (
+            model_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            definition TEXT NOT NULL UNIQUE
+        )
+        ''')
 
         # Create table for raw LiDAR scans
         c.execute('''
@@ -19,10 +347,35 @@ class LiDARDatabase:
             timestamp TEXT NOT NULL,
             altitude_angle_count INTEGER NOT NULL,
             encoder_angle_count INTEGER NOT NULL,
-            data BLOB NOT NULL
+            data BLOB NOT NULL,
+            sensor_model_id INTEGER REFERENCES sensor_models (model_id),
+            dtype TEXT,
+            codec TEXT,
+            scale REAL,
+            content_hash TEXT,
+            points_key TEXT
         )
         ''')
 
+        # Databases created before sensor models, scan dtypes, range codecs and content hashes were tracked
+        columns = [row[1] for row in c.execute("PRAGMA table_info(raw_scans)")]
+        if 'sensor_model_id' not in columns:
+            c.execute('ALTER TABLE raw_scans ADD COLUMN sensor_model_id INTEGER REFERENCES sensor_models (model_id)')
+        if 'dtype' not in columns:
+            # NULL means float64, the only type stored before
+            c.execute('ALTER TABLE raw_scans ADD COLUMN dtype TEXT')
+        if 'codec' not in columns:
+            # NULL means the raw codec, the only encoding stored before
+            c.execute('ALTER TABLE raw_scans ADD COLUMN codec TEXT')
+            c.execute('ALTER TABLE raw_scans ADD COLUMN scale REAL')
+        if 'content_hash' not in columns:
+            # NULL until hash_raw_scans fills it in
+            c.execute('ALTER TABLE raw_scans ADD COLUMN content_hash TEXT')
+            c.execute('ALTER TABLE raw_scans ADD COLUMN points_key TEXT')
+        # content_hash finds a scan stored before (see scan_content_hash); points_key
+        # identifies the conversion that produced its stored points (see ingest.conversion_key)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_raw_scans_content_hash ON raw_scans (content_hash)')
+
         # Create table for processed point cloud data
         c.execute('''
         CREATE TABLE IF NOT EXISTS point_clouds (
@@ -35,6 +388,89 @@ class LiDARDatabase:
             FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
         )
         ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_point_clouds_scan_id ON point_clouds (scan_id)')
+
+        # Create table for per-scan point blobs (point_storage="blob")
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS point_blobs (
+            scan_id INTEGER PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            point_count INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+
+        # Spatial index: each scan's points are stored cell by cell, and every
+        # cell records where its points are (offset into the scan's blob and,
+        # for row storage, its first point_id) plus its bounds in an R*Tree.
+        # point_orders keeps the scan position of each stored point, so reads
+        # return the points in scan order
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS point_orders (
+            scan_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS point_cells (
+            cell_id INTEGER PRIMARY KEY,
+            scan_id INTEGER NOT NULL,
+            cell_size REAL NOT NULL,
+            cell_x INTEGER NOT NULL,
+            cell_y INTEGER NOT NULL,
+            cell_z INTEGER NOT NULL,
+            first_index INTEGER NOT NULL,
+            first_point_id INTEGER,
+            point_count INTEGER NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_point_cells_scan_id ON point_cells (scan_id)')
+        c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS point_cells_rtree USING rtree (
+            cell_id, min_x, max_x, min_y, max_y, min_z, max_z
+        )
+        ''')
+
+        # Per-scan summary statistics written with every point cloud, so
+        # analyses read one row per scan instead of every point
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS scan_stats (
+            scan_id INTEGER PRIMARY KEY,
+            point_count INTEGER NOT NULL,
+            min_x REAL, max_x REAL,
+            min_y REAL, max_y REAL,
+            min_z REAL, max_z REAL,
+            avg_x REAL, avg_y REAL, avg_z REAL,
+            max_distance REAL,
+            avg_distance REAL,
+            rms_distance REAL,
+            near_count INTEGER NOT NULL,
+            near_avg_distance REAL,
+            medium_count INTEGER NOT NULL,
+            medium_avg_distance REAL,
+            far_count INTEGER NOT NULL,
+            far_avg_distance REAL,
+            anomaly_count INTEGER NOT NULL,
+            range_histogram TEXT NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+
+        # Points per DENSITY_CELL_SIZE horizontal cell of each scan, written with scan_stats
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS point_density (
+            scan_id INTEGER NOT NULL,
+            cell_x INTEGER NOT NULL,
+            cell_y INTEGER NOT NULL,
+            point_count INTEGER NOT NULL,
+            PRIMARY KEY (scan_id, cell_x, cell_y),
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
 
         # Create table for octomap metadata
         c.execute('''
@@ -43,68 +479,422 @@ class LiDARDatabase:
             timestamp TEXT NOT NULL,
             resolution REAL NOT NULL,
             file_path TEXT NOT NULL,
-            point_count INTEGER NOT NULL
+            point_count INTEGER NOT NULL,
+            node_count INTEGER,
+            file_size INTEGER
         )
         ''')
 
-        conn.commit()
-        conn.close()
+        # Databases created before map sizes were recorded
+        columns = [row[1] for row in c.execute("PRAGMA table_info(octomaps)")]
+        for column in ('node_count', 'file_size'):
+            if column not in columns:
+                c.execute(f'ALTER TABLE octomaps ADD COLUMN {column} INTEGER')
 
-    def store_raw_scan(self, scan_data, altitude_angle_count, encoder_angle_count):
-        """Store raw LiDAR scan data"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # Convert numpy array to bytes for storage
-        data_bytes = scan_data.tobytes()
-        
+        # Scans integrated into each map, so incremental updates insert only new scans
         c.execute('''
-        INSERT INTO raw_scans (timestamp, altitude_angle_count, encoder_angle_count, data)
-        VALUES (?, ?, ?, ?)
-        ''', (datetime.now().isoformat(), altitude_angle_count, encoder_angle_count, data_bytes))
-        
-        scan_id = c.lastrowid
-        conn.commit()
-        conn.close()
-        return scan_id
-
-    def store_point_cloud(self, scan_id, points):
-        """Store processed point cloud data"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        CREATE TABLE IF NOT EXISTS octomap_scans (
+            map_id INTEGER NOT NULL,
+            scan_id INTEGER NOT NULL,
+            PRIMARY KEY (map_id, scan_id),
+            FOREIGN KEY (map_id) REFERENCES octomaps (map_id),
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+
+        # Range-image products of each scan (see range_image): per-beam
+        # ground/obstacle labels, obstacle distance per encoder column and a
+        # sensor-centred 2.5D height and occupancy grid, each a zlib-compressed
+        # array; params holds the settings they were computed with
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS scan_products (
+            scan_id INTEGER PRIMARY KEY,
+            params TEXT NOT NULL,
+            cell_size REAL NOT NULL,
+            grid_cells INTEGER NOT NULL,
+            labels BLOB NOT NULL,
+            obstacle_distance BLOB NOT NULL,
+            height BLOB NOT NULL,
+            occupancy BLOB NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+
+        # Tiles of tiled maps: each tile's voxels live in their own file, and
+        # version counts the writes so readers can tell a cached tile is stale
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS map_tiles (
+            tile_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            map_name TEXT NOT NULL,
+            resolution REAL NOT NULL,
+            tile_size REAL NOT NULL,
+            tile_x INTEGER NOT NULL,
+            tile_y INTEGER NOT NULL,
+            tile_z INTEGER NOT NULL,
+            min_x REAL NOT NULL, max_x REAL NOT NULL,
+            min_y REAL NOT NULL, max_y REAL NOT NULL,
+            min_z REAL NOT NULL, max_z REAL NOT NULL,
+            file_path TEXT NOT NULL,
+            voxel_count INTEGER NOT NULL,
+            file_size INTEGER,
+            version INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            UNIQUE (map_name, resolution, tile_x, tile_y, tile_z)
+        )
+        ''')
+
+        # Range-image changes of each scan against the scans before it; the
+        # changed cells' points are kept as a point blob
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS scan_changes (
+            scan_id INTEGER PRIMARY KEY,
+            reference_scan_id INTEGER NOT NULL,
+            window_size INTEGER NOT NULL,
+            changed_count INTEGER NOT NULL,
+            closer_count INTEGER NOT NULL,
+            farther_count INTEGER NOT NULL,
+            appeared_count INTEGER NOT NULL,
+            vanished_count INTEGER NOT NULL,
+            mean_abs_change REAL,
+            point_count INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            points BLOB NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id),
+            FOREIGN KEY (reference_scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+
+        # Sensor pose of each scan in the map frame; timestamp is the sensor
+        # time the pose was taken or interpolated at, if known
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS poses (
+            scan_id INTEGER PRIMARY KEY,
+            timestamp REAL,
+            tx REAL NOT NULL,
+            ty REAL NOT NULL,
+            tz REAL NOT NULL,
+            qw REAL NOT NULL,
+            qx REAL NOT NULL,
+            qy REAL NOT NULL,
+            qz REAL NOT NULL,
+            FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+        )
+        ''')
+
+        # Range-image products depend on the scan's ranges, sensor model and
+        # pose, so changing any of them drops the cached products
+        for event, table, row in (("INSERT", "poses", "NEW"), ("UPDATE", "poses", "NEW"),
+                                  ("DELETE", "poses", "OLD"),
+                                  ("UPDATE OF data, dtype, codec, scale, sensor_model_id", "raw_scans", "NEW")):
+            c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS scan_products_{table}_{event.split()[0].lower()} AFTER {event} ON {table}
+            BEGIN
+                DELETE FROM scan_products WHERE scan_id = {row}.scan_id;
+            END
+            ''')
+
+        # Count of the rows inserted, replaced, updated and deleted in the
+        # tables analyses read, kept by triggers so writes from any connection
+        # change data_version. Point rows, index cells and density cells are
+        # always written and removed together with their scan's scan_stats row,
+        # which keeps them out of the per-row triggers
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS data_writes (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            database_id TEXT NOT NULL,
+            writes INTEGER NOT NULL
+        )
+        ''')
+        c.execute('INSERT OR IGNORE INTO data_writes (id, database_id, writes) VALUES (0, ?, 0)',
+                  (uuid.uuid4().hex,))
+        for table in VERSIONED_TABLES:
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_writes AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_writes SET writes = writes + 1 WHERE id = 0;
+                END
+                ''')
+
+    def _sensor_model_id(self, c, sensor_model):
+        """Return the id of a stored sensor model, inserting it if new"""
+        definition = sensor_model.to_json()
+        model_id = self._model_ids.get(definition)
+        if model_id is not None:
+            return model_id
+        c.execute('SELECT model_id FROM sensor_models WHERE definition = ?', (definition,))
+        row = c.fetchone()
+        if row:
+            model_id = row[0]
+        else:
+            c.execute('''
+            INSERT INTO sensor_models (name, definition)
+            VALUES (?, ?)
+            ''', (sensor_model.name, definition))
+            model_id = c.lastrowid
+        self._model_ids[definition] = model_id
+        return model_id
+
+    @instrumented("db_store_raw_scan")
+    def store_raw_scan(self, scan_data, altitude_angle_count, encoder_angle_count, sensor_model=None,
+                       content_hash=None):
+        """Store raw LiDAR scan data along with the sensor model that produced it, its dtype and content hash"""
+        if sensor_model is None:
+            sensor_model = default_sensor_model(altitude_angle_count)
+
+        # Encode the numpy array for storage
+        scan_data = np.asarray(scan_data).reshape(altitude_angle_count, encoder_angle_count)
+        dtype = scan_data.dtype.newbyteorder("<")
+        codec, scale, data_bytes = encode_ranges(scan_data, self.range_codec, self.range_scale)
+        if content_hash is None:
+            content_hash = scan_content_hash(scan_data, sensor_model)
         
+        with self.transaction() as c:
+            model_id = self._sensor_model_id(c, sensor_model)
+            c.execute('''
+            INSERT INTO raw_scans (timestamp, altitude_angle_count, encoder_angle_count, data, sensor_model_id, dtype,
+                                   codec, scale, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (datetime.now().isoformat(), altitude_angle_count, encoder_angle_count, data_bytes, model_id,
+                  dtype.str, codec, scale, content_hash))
+            count("db_rows_inserted", table="raw_scans")
+            count("db_bytes_written", len(data_bytes), table="raw_scans")
+            return c.lastrowid
+
+    @instrumented("db_store_point_cloud")
+    def store_point_cloud(self, scan_id, points, points_key=None):
+        """Store processed point cloud data (list of (x, y, z) tuples or an (N, 3) array)
+
+        Replaces any points stored for the scan before, since its statistics
+        and index cells describe the whole cloud; pass all of a scan's points
+        in one call. Reads return them in the order given. points_key identifies the conversion the points came from; it is
+        kept with the raw scan so storing the same result again can be
+        skipped.
+        """
         timestamp = datetime.now().isoformat()
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
         
-        # Points should be a list of (x, y, z) tuples
-        point_data = [(scan_id, x, y, z, timestamp) for x, y, z in points]
-        
-        c.executemany('''
-        INSERT INTO point_clouds (scan_id, x, y, z, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-        ''', point_data)
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as c:
+            self._write_points(c, scan_id, points, timestamp)
+            c.execute('UPDATE raw_scans SET points_key = ? WHERE scan_id = ?', (points_key, scan_id))
+
+    def find_raw_scan(self, content_hash):
+        """(scan_id, points_key) of the first stored scan with this content hash, or None"""
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT scan_id, points_key FROM raw_scans
+        WHERE content_hash = ?
+        ORDER BY scan_id
+        LIMIT 1
+        ''', (content_hash,))
+        return c.fetchone()
+
+    def _write_points(self, c, scan_id, points, timestamp, storage=None, codec=None):
+        """Write a scan's points (replacing any stored ones) and its spatial index cells"""
+        storage = storage or self.point_storage
+        codec = codec or self.point_codec
+        cells = []
+        self._delete_points(c, scan_id)
+        if self.index_cell_size:
+            order, cells = spatial_cells(points, self.index_cell_size)
+            if not np.array_equal(order, np.arange(len(order))):
+                points = points[order]
+                c.execute('INSERT INTO point_orders (scan_id, data) VALUES (?, ?)',
+                          (scan_id, zlib.compress(order.astype("<u4").tobytes())))
+
+        first_point_id = None
+        if storage == "blob":
+            blob = encode_point_blob(points, codec)
+            c.execute('''
+            INSERT INTO point_blobs (scan_id, timestamp, point_count, codec, data)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (scan_id, timestamp, len(points), codec, blob))
+            count("db_rows_inserted", table="point_blobs")
+            count("db_bytes_written", len(blob), table="point_blobs")
+        else:
+            # Explicit point_ids keep each scan's rows consecutive, so a cell is one id range
+            first_point_id = c.execute('''
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'point_clouds'), 0),
+                       COALESCE((SELECT MAX(point_id) FROM point_clouds), 0)) + 1
+            ''').fetchone()[0]
+            point_data = [(point_id, scan_id, x, y, z, timestamp)
+                          for point_id, (x, y, z) in enumerate(points.tolist(), first_point_id)]
+            
+            c.executemany('''
+            INSERT INTO point_clouds (point_id, scan_id, x, y, z, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', point_data)
+            count("db_rows_inserted", len(point_data), table="point_clouds")
+
+        count("db_points_written", len(points), storage=storage)
+        if cells:
+            count("db_rows_inserted", len(cells), table="point_cells")
+            next_cell_id = (c.execute('SELECT MAX(cell_id) FROM point_cells').fetchone()[0] or 0) + 1
+            cell_ids = range(next_cell_id, next_cell_id + len(cells))
+            c.executemany('''
+            INSERT INTO point_cells (cell_id, scan_id, cell_size, cell_x, cell_y, cell_z,
+                                     first_index, first_point_id, point_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (cell_id, scan_id, self.index_cell_size, cx, cy, cz, first,
+                 None if first_point_id is None else first_point_id + first, count)
+                for cell_id, (cx, cy, cz, first, count, _, _) in zip(cell_ids, cells)
+            ])
+            c.executemany('''
+            INSERT INTO point_cells_rtree (cell_id, min_x, max_x, min_y, max_y, min_z, max_z)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (cell_id, low[0], high[0], low[1], high[1], low[2], high[2])
+                for cell_id, (_, _, _, _, _, low, high) in zip(cell_ids, cells)
+            ])
+
+        self._write_scan_stats(c, scan_id, points)
+
+    def _write_scan_stats(self, c, scan_id, points):
+        stats = compute_scan_stats(points)
+        c.execute(f'''
+        INSERT OR REPLACE INTO scan_stats (scan_id, {", ".join(SCAN_STATS_COLUMNS)})
+        VALUES ({", ".join("?" * (len(SCAN_STATS_COLUMNS) + 1))})
+        ''', [scan_id] + [stats[column] for column in SCAN_STATS_COLUMNS])
+        c.execute('DELETE FROM point_density WHERE scan_id = ?', (scan_id,))
+        c.executemany('INSERT INTO point_density (scan_id, cell_x, cell_y, point_count) VALUES (?, ?, ?, ?)',
+                      [(scan_id, x, y, count) for x, y, count in density_cells(points)])
+
+    def _delete_points(self, c, scan_id):
+        """Remove a scan's stored points and index cells"""
+        c.execute('''
+        DELETE FROM point_cells_rtree
+        WHERE cell_id IN (SELECT cell_id FROM point_cells WHERE scan_id = ?)
+        ''', (scan_id,))
+        c.execute('DELETE FROM point_cells WHERE scan_id = ?', (scan_id,))
+        c.execute('DELETE FROM point_orders WHERE scan_id = ?', (scan_id,))
+        c.execute('DELETE FROM scan_stats WHERE scan_id = ?', (scan_id,))
+        c.execute('DELETE FROM point_density WHERE scan_id = ?', (scan_id,))
+        c.execute('DELETE FROM point_blobs WHERE scan_id = ?', (scan_id,))
+        c.execute('DELETE FROM point_clouds WHERE scan_id = ?', (scan_id,))
+
+    @instrumented("db_store_pose")
+    def store_pose(self, scan_id, pose, timestamp=None):
+        """Store (or replace) the (tx, ty, tz, qw, qx, qy, qz) sensor pose of a scan"""
+        with self.transaction() as c:
+            c.execute('''
+            INSERT OR REPLACE INTO poses (scan_id, timestamp, tx, ty, tz, qw, qx, qy, qz)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (scan_id, timestamp, *(float(v) for v in pose)))
+
+    def delete_pose(self, scan_id):
+        """Remove the stored pose of a scan, if any"""
+        with self.transaction() as c:
+            c.execute('DELETE FROM poses WHERE scan_id = ?', (scan_id,))
+
+    @instrumented("db_get_poses")
+    def get_poses(self, scan_ids):
+        """Stored poses of the given scans as a dict of scan_id -> pose tuple (scans without one are left out)"""
+        c = self.connect().cursor()
+        scan_ids = list(scan_ids)
+        poses = {}
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(scan_ids), 500):
+            chunk = scan_ids[start:start + 500]
+            c.execute(f'''
+            SELECT scan_id, tx, ty, tz, qw, qx, qy, qz FROM poses
+            WHERE scan_id IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+            for scan_id, *pose in c.fetchall():
+                poses[scan_id] = tuple(pose)
+        return poses
 
-    def store_octomap(self, resolution, file_path, point_count):
+    def get_pose(self, scan_id):
+        """Stored pose of a scan, or None"""
+        return self.get_poses([scan_id]).get(scan_id)
+
+    def store_octomap(self, resolution, file_path, point_count, node_count=None, file_size=None):
         """Store octomap metadata"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
+        with self.transaction() as c:
+            c.execute('''
+            INSERT INTO octomaps (timestamp, resolution, file_path, point_count, node_count, file_size)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (datetime.now().isoformat(), resolution, file_path, point_count, node_count, file_size))
+            return c.lastrowid
+
+    def update_octomap(self, map_id, added_points, node_count=None, file_size=None):
+        """Record that scans were added to an existing map file"""
+        with self.transaction() as c:
+            c.execute('''
+            UPDATE octomaps
+            SET timestamp = ?, point_count = point_count + ?, node_count = ?, file_size = ?
+            WHERE map_id = ?
+            ''', (datetime.now().isoformat(), added_points, node_count, file_size, map_id))
+
+    def get_octomap_by_path(self, file_path):
+        """Latest map registered for file_path as (map_id, resolution, point_count), or None"""
+        c = self.connect().cursor()
         c.execute('''
-        INSERT INTO octomaps (timestamp, resolution, file_path, point_count)
-        VALUES (?, ?, ?, ?)
-        ''', (datetime.now().isoformat(), resolution, file_path, point_count))
-        
-        map_id = c.lastrowid
-        conn.commit()
-        conn.close()
-        return map_id
+        SELECT map_id, resolution, point_count FROM octomaps
+        WHERE file_path = ?
+        ORDER BY map_id DESC
+        LIMIT 1
+        ''', (file_path,))
+        return c.fetchone()
+
+    def link_octomap_scans(self, map_id, scan_ids):
+        """Mark scans as integrated into a map"""
+        with self.transaction() as c:
+            c.executemany('INSERT OR IGNORE INTO octomap_scans (map_id, scan_id) VALUES (?, ?)',
+                          [(map_id, scan_id) for scan_id in scan_ids])
+
+    def get_unintegrated_scan_ids(self, map_id=None):
+        """Ids of scans with stored points that are not yet in the map (all of them for map_id None)"""
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT rs.scan_id FROM raw_scans rs
+        WHERE NOT EXISTS (SELECT 1 FROM octomap_scans os WHERE os.map_id = ? AND os.scan_id = rs.scan_id)
+          AND (EXISTS (SELECT 1 FROM point_blobs pb WHERE pb.scan_id = rs.scan_id)
+               OR EXISTS (SELECT 1 FROM point_clouds pc WHERE pc.scan_id = rs.scan_id))
+        ORDER BY rs.scan_id
+        ''', (map_id,))
+        return [row[0] for row in c.fetchall()]
+
+    def select_octomap(self, max_resolution):
+        """Cheapest stored map whose leaves are at most max_resolution across
+
+        Prefers the coarsest qualifying resolution, then the smallest file,
+        then the newest map. Returns (map_id, resolution, file_path,
+        node_count, file_size) or None.
+        """
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT map_id, resolution, file_path, node_count, file_size
+        FROM octomaps
+        WHERE resolution <= ?
+        ORDER BY resolution DESC, file_size IS NULL, file_size, map_id DESC
+        LIMIT 1
+        ''', (max_resolution,))
+        return c.fetchone()
+
+    def data_version(self):
+        """Fingerprint of the stored data; it changes whenever scans, points, poses or maps are written
+
+        It is the database's random id and its write count, so a database
+        recreated at the same path does not repeat the versions of the old one.
+        None for a database created before writes were counted that has only
+        been opened read-only since (opening it read-write adds the counter).
+        """
+        if "data_writes" not in self.table_names():
+            return None
+        c = self.connect().cursor()
+        c.execute('SELECT database_id, writes FROM data_writes WHERE id = 0')
+        return "/".join(str(value) for value in c.fetchone())
+
+    def table_names(self):
+        """Names of the tables in the database"""
+        c = self.connect().cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {row[0] for row in c.fetchall()}
 
     def get_latest_scans(self, limit=10):
         """Retrieve latest scans with metadata"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        c = self.connect().cursor()
         
         c.execute('''
         SELECT scan_id, timestamp, altitude_angle_count, encoder_angle_count
@@ -113,42 +903,483 @@ class LiDARDatabase:
         LIMIT ?
         ''', (limit,))
         
-        results = c.fetchall()
-        conn.close()
-        return results
+        return c.fetchall()
 
     def get_point_cloud_by_scan_id(self, scan_id):
-        """Retrieve point cloud data for a specific scan"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
+        """Retrieve point cloud data for a specific scan as a list of (x, y, z) tuples
+
+        Row storage keeps full float64 precision; blobs hold float32.
+        """
+        c = self.connect().cursor()
+        c.execute('SELECT 1 FROM point_blobs WHERE scan_id = ?', (scan_id,))
+        points = self.get_point_array(scan_id) if c.fetchone() else self._get_point_rows(scan_id)
+        return list(map(tuple, points.tolist()))
+
+    @instrumented("db_get_point_array")
+    def get_point_array(self, scan_id):
+        """Retrieve point cloud data for a specific scan as an (N, 3) float32 array"""
+        c = self.connect().cursor()
+
+        c.execute('''
+        SELECT data, point_count, codec
+        FROM point_blobs
+        WHERE scan_id = ?
+        ''', (scan_id,))
+        blob = c.fetchone()
+        if blob is not None:
+            return self._scan_order(scan_id, decode_point_blob(*blob))
+
+        return self._get_point_rows(scan_id).astype(np.float32)
+
+    def _get_point_rows(self, scan_id):
+        """Read a scan's point_clouds rows in scan order as float64"""
+        c = self.connect().cursor()
         c.execute('''
         SELECT x, y, z
         FROM point_clouds
         WHERE scan_id = ?
+        ORDER BY point_id
         ''', (scan_id,))
-        
-        points = c.fetchall()
-        conn.close()
+        return self._scan_order(scan_id, np.array(c.fetchall(), dtype=np.float64).reshape(-1, 3))
+
+    def _scan_order(self, scan_id, points):
+        """Put points read in storage (cell) order back in the order they were stored in"""
+        c = self.connect().cursor()
+        c.execute('SELECT data FROM point_orders WHERE scan_id = ?', (scan_id,))
+        result = c.fetchone()
+        if result is None:
+            return points
+        ordered = np.empty_like(points)
+        ordered[np.frombuffer(zlib.decompress(result[0]), dtype="<u4")] = points
+        return ordered
+
+    def _read_cell_points(self, scan_id, codec, ranges):
+        """Read (start, count) ranges of a scan's cell-ordered points as one array"""
+        conn = self.connect()
+        ranges = _merge_ranges(ranges)
+        if codec == "raw":
+            # Incremental BLOB I/O reads only the pages holding these cells
+            chunks = []
+            if hasattr(conn, "blobopen"):
+                with conn.blobopen("point_blobs", "data", scan_id, readonly=True) as blob:
+                    for start, count in ranges:
+                        blob.seek(start * 12)
+                        chunks.append(blob.read(count * 12))
+            else:
+                for start, count in ranges:
+                    chunks.append(conn.execute(
+                        'SELECT substr(data, ?, ?) FROM point_blobs WHERE scan_id = ?',
+                        (start * 12 + 1, count * 12, scan_id)).fetchone()[0])
+            return np.frombuffer(b"".join(chunks), dtype=np.float32).reshape(-1, 3)
+        if codec is not None:
+            # Ranges are positions in storage (cell) order
+            points = decode_point_blob(*conn.execute(
+                'SELECT data, point_count, codec FROM point_blobs WHERE scan_id = ?', (scan_id,)).fetchone())
+            return np.concatenate([points[start:start + count] for start, count in ranges])
+
+        # Row storage: each range is a run of consecutive point_ids
+        c = conn.cursor()
+        rows = []
+        for start, count in ranges:
+            c.execute('''
+            SELECT x, y, z
+            FROM point_clouds
+            WHERE point_id BETWEEN ? AND ?
+            ''', (start, start + count - 1))
+            rows.extend(c.fetchall())
+        return np.array(rows, dtype=np.float32).reshape(-1, 3)
+
+    @instrumented("db_query_box")
+    def query_box(self, min_corner, max_corner, return_scan_ids=False):
+        """Return stored points inside an axis-aligned box as an (N, 3) float32 array
+
+        Only cells whose bounds intersect the box are read. With
+        return_scan_ids=True, also returns the scan_id of every point.
+        """
+        low = np.asarray(min_corner, dtype=np.float64)
+        high = np.asarray(max_corner, dtype=np.float64)
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT pc.scan_id, pc.first_index, pc.first_point_id, pc.point_count, pb.codec
+        FROM point_cells_rtree r
+        JOIN point_cells pc ON pc.cell_id = r.cell_id
+        LEFT JOIN point_blobs pb ON pb.scan_id = pc.scan_id
+        WHERE r.max_x >= ? AND r.min_x <= ?
+          AND r.max_y >= ? AND r.min_y <= ?
+          AND r.max_z >= ? AND r.min_z <= ?
+        ORDER BY pc.scan_id, pc.first_index
+        ''', (low[0], high[0], low[1], high[1], low[2], high[2]))
+
+        scans = {}
+        for scan_id, first_index, first_point_id, count, codec in c.fetchall():
+            if codec is None and first_point_id is None:
+                continue
+            start = first_index if codec is not None else first_point_id
+            scans.setdefault((scan_id, codec), []).append((start, count))
+
+        chunks, chunk_ids = [], []
+        for (scan_id, codec), ranges in scans.items():
+            points = self._read_cell_points(scan_id, codec, ranges)
+            # Cells on the box edge also hold points outside it
+            inside = np.all((points >= low) & (points <= high), axis=1)
+            chunks.append(points[inside])
+            chunk_ids.append(np.full(int(inside.sum()), scan_id, dtype=np.int64))
+
+        points = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.float32)
+        if return_scan_ids:
+            scan_ids = np.concatenate(chunk_ids) if chunk_ids else np.empty(0, dtype=np.int64)
+            return points, scan_ids
         return points
 
+    @instrumented("db_query_radius")
+    def query_radius(self, center, radius, return_scan_ids=False):
+        """Return stored points within radius of center as an (N, 3) float32 array"""
+        center = np.asarray(center, dtype=np.float64)
+        points, scan_ids = self.query_box(center - radius, center + radius, return_scan_ids=True)
+        inside = np.sum((points - center) ** 2, axis=1) <= radius * radius
+        if return_scan_ids:
+            return points[inside], scan_ids[inside]
+        return points[inside]
+
+    def rebuild_spatial_index(self, cell_size=None):
+        """Re-index every stored scan (e.g. scans stored before the index existed), returning scans indexed"""
+        if cell_size is not None:
+            self.index_cell_size = cell_size
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT scan_id, timestamp, codec FROM point_blobs
+        UNION ALL
+        SELECT scan_id, MIN(timestamp), NULL FROM point_clouds
+        WHERE scan_id NOT IN (SELECT scan_id FROM point_blobs)
+        GROUP BY scan_id
+        ''')
+        scans = c.fetchall()
+
+        for scan_id, timestamp, blob_codec in scans:
+            # Keep each scan in the storage and codec it is already in
+            with self.transaction() as writer:
+                if blob_codec is None:
+                    self._write_points(writer, scan_id, self._get_point_rows(scan_id), timestamp, "rows")
+                else:
+                    self._write_points(writer, scan_id, self.get_point_array(scan_id), timestamp,
+                                       "blob", blob_codec)
+        return len(scans)
+
+    def get_scan_stats(self, scan_id):
+        """Retrieve the summary statistics of a scan as a dict (None if it has no points)"""
+        c = self.connect().cursor()
+        c.execute(f'''
+        SELECT {", ".join(SCAN_STATS_COLUMNS)}
+        FROM scan_stats
+        WHERE scan_id = ?
+        ''', (scan_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        stats = dict(zip(SCAN_STATS_COLUMNS, result))
+        stats["range_histogram"] = json.loads(stats["range_histogram"])
+        return stats
+
+    def store_scan_change(self, scan_id, change, points):
+        """Store (or replace) a scan's change summary, keyed by SCAN_CHANGE_COLUMNS, and its changed points"""
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        with self.transaction() as c:
+            c.execute(f'''
+            INSERT OR REPLACE INTO scan_changes (scan_id, {", ".join(SCAN_CHANGE_COLUMNS)}, point_count, codec, points)
+            VALUES ({", ".join("?" * (len(SCAN_CHANGE_COLUMNS) + 4))})
+            ''', [scan_id] + [change[column] for column in SCAN_CHANGE_COLUMNS]
+                  + [len(points), self.point_codec, encode_point_blob(points, self.point_codec)])
+
+    def get_scan_change(self, scan_id):
+        """Change summary of a scan as a dict (None if it has not been compared)"""
+        c = self.connect().cursor()
+        c.execute(f'''
+        SELECT {", ".join(SCAN_CHANGE_COLUMNS)}
+        FROM scan_changes
+        WHERE scan_id = ?
+        ''', (scan_id,))
+        result = c.fetchone()
+        return None if result is None else dict(zip(SCAN_CHANGE_COLUMNS, result))
+
+    def get_changed_points(self, scan_id):
+        """Points of a scan's changed cells as an (N, 3) float32 array (empty if it has not been compared)"""
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT points, point_count, codec
+        FROM scan_changes
+        WHERE scan_id = ?
+        ''', (scan_id,))
+        result = c.fetchone()
+        if result is None:
+            return np.empty((0, 3), dtype=np.float32)
+        return decode_point_blob(*result)
+
+    def store_scan_products(self, scan_id, params, cell_size, labels, obstacle_distance, height, occupancy):
+        """Store (or replace) a scan's range-image products, computed with the params dict"""
+        with self.transaction() as c:
+            c.execute('''
+            INSERT OR REPLACE INTO scan_products
+                (scan_id, params, cell_size, grid_cells, labels, obstacle_distance, height, occupancy)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (scan_id, json.dumps(params, sort_keys=True), cell_size, height.shape[0],
+                  zlib.compress(np.ascontiguousarray(labels, dtype=np.int8).tobytes()),
+                  zlib.compress(np.ascontiguousarray(obstacle_distance, dtype="<f4").tobytes()),
+                  zlib.compress(np.ascontiguousarray(height, dtype="<f4").tobytes()),
+                  zlib.compress(np.ascontiguousarray(occupancy, dtype=np.int8).tobytes())))
+
+    def get_scan_products(self, scan_id):
+        """A scan's range-image products as a dict of params, cell_size and arrays, or None"""
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT sp.params, sp.cell_size, sp.grid_cells, sp.labels, sp.obstacle_distance, sp.height,
+               sp.occupancy, rs.altitude_angle_count, rs.encoder_angle_count
+        FROM scan_products sp
+        JOIN raw_scans rs ON sp.scan_id = rs.scan_id
+        WHERE sp.scan_id = ?
+        ''', (scan_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        params, cell_size, grid_cells, labels, distance, height, occupancy, altitude_count, encoder_count = result
+        grid = (grid_cells, grid_cells)
+        return {
+            "params": json.loads(params),
+            "cell_size": cell_size,
+            "labels": np.frombuffer(zlib.decompress(labels), dtype=np.int8).reshape(altitude_count, encoder_count),
+            "obstacle_distance": np.frombuffer(zlib.decompress(distance), dtype="<f4"),
+            "height": np.frombuffer(zlib.decompress(height), dtype="<f4").reshape(grid),
+            "occupancy": np.frombuffer(zlib.decompress(occupancy), dtype=np.int8).reshape(grid),
+        }
+
+    def store_map_tile(self, map_name, resolution, tile_size, tile, bounds, file_path, voxel_count,
+                       file_size=None):
+        """Record a written tile (tile is its (x, y, z) index, bounds its (min, max) corners); returns its version"""
+        (min_x, min_y, min_z), (max_x, max_y, max_z) = bounds
+        with self.transaction() as c:
+            c.execute('''
+            INSERT INTO map_tiles (map_name, resolution, tile_size, tile_x, tile_y, tile_z,
+                                   min_x, max_x, min_y, max_y, min_z, max_z,
+                                   file_path, voxel_count, file_size, version, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+            ON CONFLICT (map_name, resolution, tile_x, tile_y, tile_z) DO UPDATE SET
+                file_path = excluded.file_path, voxel_count = excluded.voxel_count,
+                file_size = excluded.file_size, version = version + 1, timestamp = excluded.timestamp
+            ''', (map_name, resolution, tile_size, *(int(i) for i in tile),
+                  min_x, max_x, min_y, max_y, min_z, max_z,
+                  file_path, voxel_count, file_size, datetime.now().isoformat()))
+            c.execute('''
+            SELECT version FROM map_tiles
+            WHERE map_name = ? AND resolution = ? AND tile_x = ? AND tile_y = ? AND tile_z = ?
+            ''', (map_name, resolution, *(int(i) for i in tile)))
+            return c.fetchone()[0]
+
+    def get_map_tiles(self, map_name, resolution, min_corner=None, max_corner=None):
+        """Tiles of a map as dicts keyed by MAP_TILE_COLUMNS, only those intersecting the box if corners are given"""
+        query = f'''
+        SELECT {", ".join(MAP_TILE_COLUMNS)}
+        FROM map_tiles
+        WHERE map_name = ? AND resolution = ?
+        '''
+        params = [map_name, resolution]
+        if min_corner is not None:
+            query += 'AND max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ? AND max_z >= ? AND min_z <= ?'
+            for low, high in zip(min_corner, max_corner):
+                params += [float(low), float(high)]
+        c = self.connect().cursor()
+        c.execute(query + ' ORDER BY tile_x, tile_y, tile_z', params)
+        return [dict(zip(MAP_TILE_COLUMNS, row)) for row in c.fetchall()]
+
+    def get_map_tile(self, map_name, resolution, tile):
+        """One tile of a map as a dict keyed by MAP_TILE_COLUMNS, or None if it was never written"""
+        c = self.connect().cursor()
+        c.execute(f'''
+        SELECT {", ".join(MAP_TILE_COLUMNS)}
+        FROM map_tiles
+        WHERE map_name = ? AND resolution = ? AND tile_x = ? AND tile_y = ? AND tile_z = ?
+        ''', (map_name, resolution, *(int(i) for i in tile)))
+        result = c.fetchone()
+        return None if result is None else dict(zip(MAP_TILE_COLUMNS, result))
+
+    def get_tiled_maps(self):
+        """(map_name, resolution, tile_size, tile count, voxel count, bytes on disk) of every tiled map"""
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT map_name, resolution, MAX(tile_size), COUNT(*), SUM(voxel_count), SUM(file_size)
+        FROM map_tiles
+        GROUP BY map_name, resolution
+        ORDER BY map_name, resolution
+        ''')
+        return c.fetchall()
+
+    def get_scan_ids(self, after=None):
+        """Stored scan ids in order, optionally only those after a given scan_id"""
+        c = self.connect().cursor()
+        c.execute('SELECT scan_id FROM raw_scans WHERE scan_id > ? ORDER BY scan_id',
+                  (-1 if after is None else after,))
+        return [row[0] for row in c.fetchall()]
+
+    def rebuild_scan_stats(self):
+        """Compute statistics and point density for stored scans that have none, returning scans updated"""
+        c = self.connect().cursor()
+        c.execute('''
+        WITH missing AS (
+            SELECT scan_id FROM raw_scans
+            WHERE scan_id NOT IN (SELECT scan_id FROM scan_stats)
+               -- Scans stored before point_density existed
+               OR scan_id IN (SELECT scan_id FROM scan_stats WHERE point_count > 0
+                              AND scan_id NOT IN (SELECT scan_id FROM point_density))
+        )
+        SELECT scan_id FROM point_blobs WHERE scan_id IN missing
+        UNION
+        SELECT DISTINCT scan_id FROM point_clouds WHERE scan_id IN missing
+        ''')
+        scan_ids = [row[0] for row in c.fetchall()]
+
+        for scan_id in scan_ids:
+            with self.transaction() as writer:
+                blob = writer.execute('SELECT 1 FROM point_blobs WHERE scan_id = ?', (scan_id,)).fetchone()
+                points = self.get_point_array(scan_id) if blob else self._get_point_rows(scan_id)
+                self._write_scan_stats(writer, scan_id, points)
+        return len(scan_ids)
+
+    def convert_rows_to_blobs(self, codec=None, keep_rows=False):
+        """Move row-per-point scans from point_clouds into point_blobs, returning scans converted"""
+        codec = codec or self.point_codec
+
+        with self.transaction() as writer:
+            # One ordered pass over point_clouds instead of a full scan per scan_id
+            reader = self.connect().cursor()
+            reader.execute('''
+            SELECT scan_id, x, y, z, timestamp
+            FROM point_clouds
+            WHERE scan_id NOT IN (SELECT scan_id FROM point_blobs)
+            ORDER BY scan_id, point_id
+            ''')
+
+            def write_blob(scan_id, timestamp, rows):
+                points = np.array(rows, dtype=np.float32)
+                writer.execute('''
+                INSERT INTO point_blobs (scan_id, timestamp, point_count, codec, data)
+                VALUES (?, ?, ?, ?, ?)
+                ''', (scan_id, timestamp, len(points), codec, encode_point_blob(points, codec)))
+
+            converted = 0
+            current_scan, current_timestamp, rows = None, None, []
+            for scan_id, x, y, z, timestamp in reader:
+                if scan_id != current_scan:
+                    if rows:
+                        write_blob(current_scan, current_timestamp, rows)
+                        converted += 1
+                    current_scan, current_timestamp, rows = scan_id, timestamp, []
+                rows.append((x, y, z))
+            if rows:
+                write_blob(current_scan, current_timestamp, rows)
+                converted += 1
+
+            if not keep_rows:
+                writer.execute('DELETE FROM point_clouds WHERE scan_id IN (SELECT scan_id FROM point_blobs)')
+
+        return converted
+
+    def recode_raw_scans(self, codec=None, scale=None):
+        """Re-encode stored raw scans with another range codec, returning scans rewritten"""
+        codec = codec or self.range_codec
+        scale = scale or self.range_scale
+        reader = self.connect().cursor()
+        reader.execute('SELECT scan_id FROM raw_scans ORDER BY scan_id')
+        scan_ids = [row[0] for row in reader.fetchall()]
+        for start in range(0, len(scan_ids), 100):
+            with self.transaction() as writer:
+                for scan_id in scan_ids[start:start + 100]:
+                    scan = self.get_raw_scan_data(scan_id)
+                    used, used_scale, data = encode_ranges(scan, codec, scale)
+                    writer.execute('''
+                    UPDATE raw_scans SET data = ?, codec = ?, scale = ?, dtype = ?
+                    WHERE scan_id = ?
+                    ''', (data, used, used_scale, scan.dtype.newbyteorder("<").str, scan_id))
+        return len(scan_ids)
+
+    def hash_raw_scans(self):
+        """Fill in the content hash of scans stored without one, returning scans hashed
+
+        Scans stored with a quantized range codec are hashed from their
+        decoded ranges, so they only match scans stored the same way.
+        """
+        reader = self.connect().cursor()
+        reader.execute('SELECT scan_id FROM raw_scans WHERE content_hash IS NULL ORDER BY scan_id')
+        scan_ids = [row[0] for row in reader.fetchall()]
+        for start in range(0, len(scan_ids), 100):
+            with self.transaction() as writer:
+                for scan_id in scan_ids[start:start + 100]:
+                    content_hash = scan_content_hash(self.get_raw_scan_data(scan_id), self.get_sensor_model(scan_id))
+                    writer.execute('UPDATE raw_scans SET content_hash = ? WHERE scan_id = ?', (content_hash, scan_id))
+        return len(scan_ids)
+
+    def remove_duplicate_scans(self):
+        """Delete scans whose content hash matches an earlier scan, returning scans removed
+
+        Map links move to the earliest copy; everything else stored for a
+        duplicate (points, index cells, stats, pose, changes and products)
+        is deleted with it.
+        """
+        c = self.connect().cursor()
+        c.execute('''
+        SELECT rs.scan_id, first.scan_id
+        FROM raw_scans rs
+        JOIN (SELECT content_hash, MIN(scan_id) AS scan_id FROM raw_scans
+              WHERE content_hash IS NOT NULL GROUP BY content_hash) first
+          ON rs.content_hash = first.content_hash AND rs.scan_id > first.scan_id
+        ORDER BY rs.scan_id
+        ''')
+        duplicates = c.fetchall()
+        with self.transaction() as writer:
+            for scan_id, kept_id in duplicates:
+                writer.execute('''
+                INSERT OR IGNORE INTO octomap_scans (map_id, scan_id)
+                SELECT map_id, ? FROM octomap_scans WHERE scan_id = ?
+                ''', (kept_id, scan_id))
+                self._delete_points(writer, scan_id)
+                for table in ("octomap_scans", "poses", "scan_changes", "scan_products", "raw_scans"):
+                    writer.execute(f'DELETE FROM {table} WHERE scan_id = ?', (scan_id,))
+                writer.execute('DELETE FROM scan_changes WHERE reference_scan_id = ?', (scan_id,))
+        return len(duplicates)
+
+    @instrumented("db_get_raw_scan_data")
     def get_raw_scan_data(self, scan_id):
         """Retrieve raw scan data"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        c = self.connect().cursor()
         
         c.execute('''
-        SELECT data, altitude_angle_count, encoder_angle_count
+        SELECT data, altitude_angle_count, encoder_angle_count, dtype, codec, scale
         FROM raw_scans
         WHERE scan_id = ?
         ''', (scan_id,))
         
         result = c.fetchone()
-        conn.close()
         
         if result:
-            data_bytes, alt_count, enc_count = result
-            # Convert bytes back to numpy array
-            data = np.frombuffer(data_bytes).reshape(alt_count, enc_count)
+            data_bytes, alt_count, enc_count, dtype, codec, scale = result
+            # Decode back to a numpy array in the stored dtype
+            data = decode_ranges(data_bytes, (alt_count, enc_count), codec or "raw", scale, dtype or "<f8")
             return data
         return None
+
+    def get_sensor_model(self, scan_id):
+        """Retrieve the sensor model of a scan (default geometry for scans stored without one)"""
+        c = self.connect().cursor()
+
+        c.execute('''
+        SELECT sm.definition, rs.altitude_angle_count
+        FROM raw_scans rs
+        LEFT JOIN sensor_models sm ON rs.sensor_model_id = sm.model_id
+        WHERE rs.scan_id = ?
+        ''', (scan_id,))
+
+        result = c.fetchone()
+
+        if result is None:
+            return None
+        definition, alt_count = result
+        if definition is None:
+            return default_sensor_model(alt_count)
+        return SensorModel.from_json(definition)
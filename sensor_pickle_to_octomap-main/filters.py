@@ -0,0 +1,132 @@
+import numpy as np
+
+# Bits per axis when packing grid cell coordinates into one int64 key
+_KEY_BITS = 21
+_KEY_LIMIT = 1 << _KEY_BITS
+
+def range_mask(ranges, min_range=None, max_range=None):
+    """Mask of finite ranges in [min_range, max_range)
+
+    Readings at or beyond max_range are dropped, so setting it to the
+    sensor's maximum distance removes the no-return readings.
+    """
+    ranges = np.asarray(ranges).reshape(-1)
+    mask = np.isfinite(ranges)
+    if min_range is not None:
+        mask &= ranges >= min_range
+    if max_range is not None:
+        mask &= ranges < max_range
+    return mask
+
+def _cell_keys(points, cell_size):
+    """Packed int64 keys of the cubic cells holding each point, with one empty cell of margin on every side"""
+    cells = np.floor(points / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    if np.any(cells.max(axis=0) >= _KEY_LIMIT - 1):
+        raise ValueError(f"Points span too many cells of {cell_size}; use a larger cell size")
+    return (cells[:, 0] << (2 * _KEY_BITS)) | (cells[:, 1] << _KEY_BITS) | cells[:, 2]
+
+def voxel_downsample(points, voxel_size):
+    """Replace the points in each voxel_size cube by their centroid
+
+    Returns the centroids ordered by voxel key, as float32 or float64 like
+    the input. Non-finite points are dropped.
+    """
+    points = np.asarray(points).reshape(-1, 3)
+    points = points[np.isfinite(points).all(axis=1)]
+    if len(points) == 0:
+        return points.copy()
+    keys = _cell_keys(points, voxel_size)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    sums = np.add.reduceat(points[order].astype(np.float64), starts, axis=0)
+    counts = np.diff(np.append(starts, len(points)))
+    return (sums / counts[:, np.newaxis]).astype(points.dtype if points.dtype.kind == "f" else np.float64)
+
+_NEIGHBOUR_OFFSETS = np.array([
+    (dx << (2 * _KEY_BITS)) + (dy << _KEY_BITS) + dz
+    for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+], dtype=np.int64)
+
+def neighbour_counts(points, radius):
+    """Number of other points in the 3x3x3 block of radius-sized cells around each point
+
+    Non-finite points get -1.
+    """
+    points = np.asarray(points).reshape(-1, 3)
+    finite = np.isfinite(points).all(axis=1)
+    result = np.full(len(points), -1, dtype=np.int64)
+    if not finite.any():
+        return result
+    keys = _cell_keys(points[finite], radius)
+    cells, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    block = np.zeros(len(cells), dtype=np.int64)
+    for offset in _NEIGHBOUR_OFFSETS:
+        neighbours = cells + offset
+        index = np.minimum(np.searchsorted(cells, neighbours), len(cells) - 1)
+        block += np.where(cells[index] == neighbours, counts[index], 0)
+    result[finite] = block[inverse] - 1
+    return result
+
+def outlier_mask(points, radius, min_neighbours):
+    """Mask of points with at least min_neighbours other points in their neighbourhood of cells"""
+    return neighbour_counts(points, radius) >= min_neighbours
+
+class PointFilter:
+    """Filtering stage between projection and storage or export
+
+    Drops out-of-range and no-return readings in the sensor frame, then
+    removes isolated points and downsamples to voxel centroids in the map
+    frame. Every step is off unless configured.
+    """
+
+    def __init__(self, min_range=None, max_range=None, voxel_size=None, outlier_radius=None,
+                 outlier_min_neighbours=2):
+        self.min_range = min_range
+        self.max_range = max_range
+        self.voxel_size = voxel_size
+        self.outlier_radius = outlier_radius
+        self.outlier_min_neighbours = outlier_min_neighbours
+
+    def __bool__(self):
+        return any(value is not None for value in (self.min_range, self.max_range, self.voxel_size,
+                                                    self.outlier_radius))
+
+    def sensor_frame(self, points, ranges):
+        """Apply the range limits; ranges are the scan's readings in the same order as points"""
+        if self.min_range is None and self.max_range is None:
+            return points
+        return points[range_mask(ranges, self.min_range, self.max_range)]
+
+    def map_frame(self, points):
+        """Remove outliers, then downsample"""
+        if self.outlier_radius is not None:
+            points = points[outlier_mask(points, self.outlier_radius, self.outlier_min_neighbours)]
+        if self.voxel_size is not None:
+            points = voxel_downsample(points, self.voxel_size)
+        return points
+
+    def __repr__(self):
+        return (f"PointFilter(min_range={self.min_range}, max_range={self.max_range}, "
+                f"voxel_size={self.voxel_size}, outlier_radius={self.outlier_radius}, "
+                f"outlier_min_neighbours={self.outlier_min_neighbours})")
+
+def add_filter_arguments(parser):
+    """Add the point filter options to an argparse parser"""
+    group = parser.add_argument_group("point filtering")
+    group.add_argument("--min-range", type=float, help="Drop readings closer than this")
+    group.add_argument("--max-range", type=float,
+                       help="Drop readings at or beyond this (the sensor maximum drops no-returns)")
+    group.add_argument("--outlier-radius", type=float,
+                       help="Drop points with too few neighbours within cells of this size")
+    group.add_argument("--outlier-min-neighbours", type=int, default=2,
+                       help="Neighbours a point needs to be kept by --outlier-radius")
+    group.add_argument("--voxel-size", type=float, help="Replace the points in each voxel by their centroid")
+
+def point_filter_from_args(args):
+    """PointFilter for the options added by add_filter_arguments, or None if none is set"""
+    point_filter = PointFilter(args.min_range, args.max_range, args.voxel_size, args.outlier_radius,
+                               args.outlier_min_neighbours)
+    return point_filter if point_filter else None
@@ -0,0 +1,386 @@
+import argparse
+import collections
+import pickle
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+from db_utils import LiDARDatabase, POINT_STORAGE_MODES, scan_content_hash
+from filters import add_filter_arguments, point_filter_from_args
+from instrumentation import add_metrics_arguments, count, enable_from_args, observe, write_metrics_from_args
+from point_io import POINT_FORMATS, open_point_stream, open_point_writer, point_format_for_path
+from pose import read_pose_file, read_trajectory
+from projection import project_scan
+from range_codec import DEFAULT_RANGE_SCALE, RANGE_CODECS
+from result_cache import add_cache_arguments, cache_key, result_cache_from_args
+from scan_container import ScanContainer, ScanRecord, is_scan_container
+from sensor_model import SensorModel
+
+# content_hash identifies the scan (see db_utils.scan_content_hash), points_key the
+# conversion that produced points (see conversion_key); cached is set when they came
+# from a ResultCache
+ScanResult = collections.namedtuple(
+    "ScanResult", "file_name scan points pose seconds input_points timestamp sensor_model content_hash points_key "
+                  "cached", defaults=(None, None, False))
+
+# One scan to ingest: a pickle file (index None) or scan index of a .scans container
+ScanSource = collections.namedtuple("ScanSource", "name path index")
+
+# Sensor model, point filter and result cache of the current worker process, set by _init_worker
+_worker_sensor_model = None
+_worker_point_filter = None
+_worker_cache = None
+# .scans containers opened by this process, by path
+_open_containers = {}
+
+def _init_worker(sensor_model_json, point_filter, cache=None):
+    global _worker_sensor_model, _worker_point_filter, _worker_cache
+    _worker_sensor_model = SensorModel.from_json(sensor_model_json) if sensor_model_json else None
+    _worker_point_filter = point_filter
+    _worker_cache = cache
+
+def _container(path):
+    if path not in _open_containers:
+        _open_containers[path] = ScanContainer(path)
+    return _open_containers[path]
+
+def scan_sources(file_names):
+    """Expand .scans containers into one ScanSource per scan; other files are scan pickles
+
+    Container scans are named after the scan names recorded in the container.
+    """
+    for file_name in file_names:
+        if is_scan_container(file_name):
+            for index, name in enumerate(_container(file_name).names):
+                yield ScanSource(name, file_name, index)
+        else:
+            yield ScanSource(file_name, file_name, None)
+
+def load_and_project(source, sensor_model=None, pose=None, point_filter=None, timestamp=None, cache=None):
+    """Read one scan and project it to an (N, 3) float64 point array
+
+    source is a ScanSource or a pickle path. A container scan falls back to
+    its recorded pose, timestamp and sensor model where none is given.
+    With a (tx, ty, tz, qw, qx, qy, qz) sensor pose the points are moved
+    into the map frame; without one they stay in the sensor frame. A
+    PointFilter masks ranges before and thins the points after the move.
+    With a ResultCache the points of an unchanged scan, pose and filter are
+    read from it instead of being computed again.
+    """
+    start = time.perf_counter()
+    if isinstance(source, str):
+        source = ScanSource(source, source, None)
+    record = read_scan(source)
+    pose = pose if pose is not None else record.pose
+    timestamp = timestamp if timestamp is not None else record.timestamp
+    result = convert_scan(source.name, record.scan, sensor_model or record.sensor_model, pose, point_filter,
+                          timestamp, cache)
+    return result._replace(seconds=time.perf_counter() - start)
+
+def read_scan(source):
+    """ScanRecord of a ScanSource; a pickle has no recorded pose, timestamp or sensor model"""
+    if source.index is None:
+        with open(source.path, "rb") as f:
+            return ScanRecord(source.name, np.asarray(pickle.load(f)), None, None, None)
+    return _container(source.path).record(source.index)
+
+def conversion_key(content_hash, pose=None, point_filter=None):
+    """Key of the points convert_scan makes from a scan with this content hash, pose and filter"""
+    return cache_key("points", content_hash, None if pose is None else [float(v) for v in pose],
+                     repr(point_filter) if point_filter else None)
+
+def convert_scan(name, scan, sensor_model=None, pose=None, point_filter=None, timestamp=None, cache=None):
+    """Project an (altitude, encoder) range array already in memory; see load_and_project"""
+    start = time.perf_counter()
+    content_hash = scan_content_hash(scan, sensor_model)
+    points_key = conversion_key(content_hash, pose, point_filter)
+    if cache is not None:
+        points = cache.load_array(points_key)
+        if points is not None:
+            return ScanResult(name, scan, points, pose, time.perf_counter() - start, scan.size, timestamp,
+                              sensor_model, content_hash, points_key, True)
+    # The range filter only looks at the ranges, so projecting straight into the map frame is equivalent
+    points = project_scan(scan, sensor_model, dtype=np.float64, pose=pose)
+    input_points = len(points)
+    if point_filter:
+        points = point_filter.map_frame(point_filter.sensor_frame(points, scan))
+    if cache is not None:
+        cache.store_array(points_key, points)
+    return ScanResult(name, scan, points, pose, time.perf_counter() - start, input_points, timestamp,
+                      sensor_model, content_hash, points_key)
+
+def _worker_load_and_project(source, pose, timestamp):
+    return load_and_project(source, _worker_sensor_model, pose, _worker_point_filter, timestamp, _worker_cache)
+
+def _worker_convert_scan(name, scan, pose, timestamp):
+    return convert_scan(name, scan, _worker_sensor_model, pose, _worker_point_filter, timestamp, _worker_cache)
+
+class StageCounter:
+    """Scans, points and busy seconds accumulated by one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.scans = 0
+        self.points = 0
+        self.seconds = 0.0
+
+    def add(self, points, seconds, scans=1):
+        self.scans += scans
+        self.points += points
+        self.seconds += seconds
+
+    def __str__(self):
+        rate = self.scans / self.seconds if self.seconds else 0.0
+        mpoints = self.points / self.seconds / 1e6 if self.seconds else 0.0
+        return f"{self.name}: {self.scans} scans, {self.seconds:.2f}s busy, {rate:.1f} scans/s, {mpoints:.2f} Mpoints/s"
+
+class PointFileSink:
+    """Streams each scan's points to a point file (see point_io) as scans arrive"""
+
+    def __init__(self, stream, fmt="csv"):
+        self.writer = open_point_writer(stream, fmt)
+        self.counter = StageCounter(fmt)
+
+    def write(self, result):
+        start = time.perf_counter()
+        self.writer.write_scan(result.points, result.pose)
+        self.counter.add(len(result.points), time.perf_counter() - start)
+
+    def close(self):
+        self.writer.close()
+
+class DatabaseSink:
+    """Stores raw scans, point clouds and poses, committing once per batch of scans
+
+    With dedupe a scan whose content hash is already stored reuses that
+    scan_id: its points and pose are only written again if they came from
+    a different conversion (pose or filter), and nothing is written if not.
+    """
+
+    def __init__(self, db, sensor_model=None, batch_size=50, dedupe=True):
+        self.db = db
+        self.sensor_model = sensor_model
+        self.batch_size = batch_size
+        self.dedupe = dedupe
+        self.counter = StageCounter("database")
+        self.duplicates = 0
+        self.unchanged = 0
+        self._batch = []
+
+    def __len__(self):
+        """Scans waiting for the next commit"""
+        return len(self._batch)
+
+    def write(self, result):
+        self._batch.append(result)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+        start = time.perf_counter()
+        with self.db.transaction():
+            for result in self._batch:
+                scan = result.scan
+                sensor_model = result.sensor_model or self.sensor_model
+                content_hash = result.content_hash
+                if content_hash is None or sensor_model is not result.sensor_model:
+                    content_hash = scan_content_hash(scan, sensor_model)
+                stored = self.db.find_raw_scan(content_hash) if self.dedupe else None
+                if stored is None:
+                    scan_id = self.db.store_raw_scan(scan, scan.shape[0], scan.shape[1], sensor_model, content_hash)
+                else:
+                    scan_id, stored_key = stored
+                    self.duplicates += 1
+                    if result.points_key is not None and stored_key == result.points_key:
+                        self.unchanged += 1
+                        continue
+                self.db.store_point_cloud(scan_id, result.points, result.points_key)
+                if result.pose is not None:
+                    self.db.store_pose(scan_id, result.pose, result.timestamp)
+                elif stored is not None:
+                    # The points were just rewritten without a pose; the old one no longer applies
+                    self.db.delete_pose(scan_id)
+        self.counter.add(sum(len(result.points) for result in self._batch),
+                         time.perf_counter() - start, scans=len(self._batch))
+        self._batch = []
+
+    def close(self):
+        self.flush()
+
+def _completed_results(file_names, workers, max_in_flight, ordered, sensor_model, poses, timestamps,
+                       point_filter, cache):
+    """Yield ScanResults, keeping at most max_in_flight scans submitted but not yet consumed"""
+    sources = scan_sources(file_names)
+    if workers <= 0:
+        for source in sources:
+            yield load_and_project(source, sensor_model, poses.get(source.name), point_filter,
+                                   timestamps.get(source.name), cache)
+        return
+
+    model_json = sensor_model.to_json() if sensor_model else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_json, point_filter, cache)) as executor:
+        in_flight = collections.deque()
+
+        def submit_next():
+            source = next(sources, None)
+            if source is not None:
+                in_flight.append(executor.submit(_worker_load_and_project, source, poses.get(source.name),
+                                                 timestamps.get(source.name)))
+            return source is not None
+
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+
+        while in_flight:
+            if ordered:
+                # Results leave in input order; a slow scan holds back the ones behind it
+                done = [in_flight.popleft()]
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+            for future in done:
+                # The slot is reused only once its result has been consumed (backpressure)
+                yield future.result()
+                submit_next()
+
+def ingest_files(file_names, db=None, point_sink=None, sensor_model=None, workers=4, max_in_flight=None,
+                 ordered=True, batch_size=50, progress_interval=5.0, log=sys.stderr, poses=None, timestamps=None,
+                 point_filter=None, cache=None, dedupe=True):
+    """Convert scans with a worker pool and stream them into the database and/or a point file sink
+
+    file_names are scan pickles or .scans containers. They may be any
+    iterable and are consumed lazily, so memory stays bounded by
+    max_in_flight results plus one database batch regardless of how many
+    scans are ingested. poses maps file (or container scan) names to sensor poses;
+    those scans are moved into the map frame and the pose is stored and
+    passed on to the point file, with the sensor time from timestamps if
+    given. A PointFilter thins each scan before it reaches the sinks.
+    Converted points are reused from a ResultCache when the scan, pose and
+    filter are unchanged, and the cache is trimmed to its size afterwards;
+    dedupe stores each distinct scan once (see DatabaseSink). Returns the
+    StageCounters keyed by stage name.
+    """
+    if max_in_flight is None:
+        max_in_flight = max(1, 2 * workers)
+    project_stage = StageCounter("read+project")
+    sinks = []
+    database_sink = None
+    if db is not None:
+        database_sink = DatabaseSink(db, sensor_model, batch_size, dedupe)
+        sinks.append(database_sink)
+    if point_sink is not None:
+        sinks.append(point_sink)
+    stages = [project_stage] + [sink.counter for sink in sinks]
+
+    def report(prefix):
+        if log is not None:
+            for stage in stages:
+                print(f"{prefix}{stage}", file=log)
+
+    input_points = 0
+    cached = 0
+    start = last_report = time.perf_counter()
+    for result in _completed_results(file_names, workers, max_in_flight, ordered, sensor_model, poses or {},
+                                     timestamps or {}, point_filter, cache):
+        project_stage.add(len(result.points), result.seconds)
+        cached += result.cached
+        # Conversion runs in the workers; record it here where the metrics are collected
+        observe("scan_convert_seconds", result.seconds)
+        count("scan_convert_points", len(result.points))
+        input_points += result.input_points
+        for sink in sinks:
+            sink.write(result)
+
+        now = time.perf_counter()
+        if progress_interval and now - last_report >= progress_interval:
+            report(f"[{now - start:.1f}s] ")
+            last_report = now
+
+    for sink in sinks:
+        sink.close()
+    if cache is not None:
+        cache.evict()
+
+    elapsed = time.perf_counter() - start
+    if log is not None:
+        print(f"Ingested {project_stage.scans} scans ({project_stage.points} points) in {elapsed:.2f}s "
+              f"with {workers or 'no'} workers", file=log)
+        if point_filter:
+            kept = project_stage.points / input_points if input_points else 0.0
+            print(f"  filter: {input_points} points in, {project_stage.points} out ({kept:.1%} kept)", file=log)
+        if cache is not None:
+            print(f"  cache: {cached} of {project_stage.scans} scans reused from {cache.directory}", file=log)
+        if database_sink is not None and database_sink.duplicates:
+            print(f"  database: {database_sink.duplicates} scans already stored "
+                  f"({database_sink.unchanged} unchanged)", file=log)
+    report("  ")
+    return {stage.name: stage for stage in stages}
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream sensor scans into the LiDAR database")
+    parser.add_argument("file_names", nargs="+", help="Sensor data pickle files or .scans containers")
+    parser.add_argument("--db", default="lidar_data.db", help="Database to store scans and points in")
+    parser.add_argument("--no-db", action="store_true", help="Do not store anything in the database")
+    parser.add_argument("--points", help="Also write all points to this file ('-' for stdout)")
+    parser.add_argument("--format", choices=POINT_FORMATS,
+                        help="Format of --points (default: from its extension, csv for stdout)")
+    parser.add_argument("--poses", help="CSV of file_name,tx,ty,tz,qw,qx,qy,qz sensor poses per scan file, "
+                                        "or file_name,timestamp with --trajectory")
+    parser.add_argument("--trajectory", help="CSV of timestamp,tx,ty,tz,qw,qx,qy,qz poses to interpolate "
+                                             "the --poses timestamps from")
+    parser.add_argument("--calibration", help="Sensor model calibration JSON (default: built-in geometry)")
+    parser.add_argument("--point-storage", choices=POINT_STORAGE_MODES, default="blob",
+                        help="Store points as one row per point or one blob per scan")
+    parser.add_argument("--range-codec", choices=RANGE_CODECS, default="raw",
+                        help="Encoding of the stored raw scans (quantized codecs round to --range-scale)")
+    parser.add_argument("--range-scale", type=float, default=DEFAULT_RANGE_SCALE,
+                        help="Fixed-point step of the quantized range codecs, in range units "
+                             "(default: 1 for whole-number ranges such as millimetres, 0.001 otherwise)")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes (0 converts in-process)")
+    parser.add_argument("--max-in-flight", type=int, help="Scans queued or converted but not yet written "
+                                                         "(default: twice the worker count)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="Write scans as soon as they are converted instead of in input order")
+    parser.add_argument("--batch-size", type=int, default=50, help="Scans stored per database commit")
+    parser.add_argument("--keep-duplicates", action="store_true",
+                        help="Store scans again even if the database already has the same scan")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="Seconds between throughput reports on stderr (0 disables them)")
+    add_filter_arguments(parser)
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    enable_from_args(args)
+
+    if args.trajectory and not args.poses:
+        parser.error("--trajectory needs --poses with the scan timestamps")
+    sensor_model = SensorModel.from_calibration_file(args.calibration) if args.calibration else None
+    poses, timestamps = None, None
+    if args.poses:
+        poses, timestamps = read_pose_file(args.poses, read_trajectory(args.trajectory) if args.trajectory else None)
+    db = None if args.no_db else LiDARDatabase(args.db, point_storage=args.point_storage,
+                                                 range_codec=args.range_codec, range_scale=args.range_scale)
+    point_file = point_sink = None
+    if args.points:
+        fmt = args.format or ("csv" if args.points == "-" else point_format_for_path(args.points))
+        point_file = open_point_stream(args.points, fmt)
+        point_sink = PointFileSink(point_file, fmt)
+    try:
+        ingest_files(args.file_names, db, point_sink, sensor_model,
+                     workers=args.workers, max_in_flight=args.max_in_flight, ordered=not args.unordered,
+                     batch_size=args.batch_size, progress_interval=args.progress_interval,
+                     poses=poses, timestamps=timestamps, point_filter=point_filter_from_args(args),
+                     cache=result_cache_from_args(args), dedupe=not args.keep_duplicates)
+    finally:
+        if point_file is not None and args.points != "-":
+            point_file.close()
+        if db is not None:
+            db.close()
+        write_metrics_from_args(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import collections
+import math
+import os
+import signal
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from db_utils import LiDARDatabase, POINT_STORAGE_MODES
+from filters import add_filter_arguments, point_filter_from_args
+from ingest import DatabaseSink, StageCounter, _init_worker, _worker_convert_scan, convert_scan, read_scan, scan_sources
+from instrumentation import add_metrics_arguments, count, enable_from_args, observe, write_metrics_from_args
+from pose import read_pose_file, read_trajectory
+from scan_container import SCAN_DTYPES
+from sensor_model import SensorModel
+from voxel_map import VoxelMap
+
+# Frame layout (little endian), one scan per frame:
+#   header: magic "LSCF", uint16 version, uint16 name length, dtype (4 bytes,
+#           one of scan_container.SCAN_DTYPES), uint32 altitude count,
+#           uint32 encoder count, float64 sensor time (NaN if unknown),
+#           7 float64 pose tx, ty, tz, qw, qx, qy, qz (NaN if unknown)
+#   name: UTF-8
+#   ranges: altitude count * encoder count values of dtype, row-major
+FRAME_MAGIC = b"LSCF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sHH4sIId7d")
+# Larger frames are refused rather than allocated (64 Mi readings)
+MAX_FRAME_READINGS = 1 << 26
+
+# What a connection does when the frame queue is full: wait (the sender is
+# slowed down through TCP flow control), drop the frame just received, or
+# drop the oldest queued frame to make room
+QUEUE_POLICIES = ("block", "drop-newest", "drop-oldest")
+
+DEFAULT_PORT = 7878
+
+Frame = collections.namedtuple("Frame", "name scan timestamp pose received")
+
+def encode_frame(scan, name="", timestamp=None, pose=None):
+    """One scan as a frame; the scan keeps its dtype if it is one of SCAN_DTYPES, else becomes float64"""
+    scan = np.asarray(scan)
+    dtype = scan.dtype.newbyteorder("<").str
+    if dtype not in SCAN_DTYPES:
+        dtype = "<f8"
+    name = name.encode("utf-8")
+    pose = (math.nan,) * 7 if pose is None else tuple(pose)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(name), dtype.encode("ascii"), scan.shape[0],
+                               scan.shape[1], math.nan if timestamp is None else timestamp, *pose)
+    return header + name + np.ascontiguousarray(scan, dtype=dtype).tobytes()
+
+async def read_frame(reader):
+    """Next Frame from a stream, or None at a clean end of stream; ValueError on a malformed frame"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ValueError("Stream ended inside a frame header") from None
+        return None
+    magic, version, name_length, dtype, altitude_count, encoder_count, timestamp, *pose = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"Not a version {FRAME_VERSION} scan frame")
+    dtype = dtype.rstrip(b"\0").decode("ascii", "replace")
+    if dtype not in SCAN_DTYPES:
+        raise ValueError(f"Unsupported scan dtype: {dtype}")
+    if not altitude_count or not encoder_count:
+        raise ValueError(f"Frame of {altitude_count}x{encoder_count} readings is empty")
+    if altitude_count * encoder_count > MAX_FRAME_READINGS:
+        raise ValueError(f"Frame of {altitude_count}x{encoder_count} readings is too large")
+    try:
+        name = (await reader.readexactly(name_length)).decode("utf-8")
+        data = await reader.readexactly(altitude_count * encoder_count * np.dtype(dtype).itemsize)
+    except asyncio.IncompleteReadError:
+        raise ValueError("Stream ended inside a frame") from None
+    scan = np.frombuffer(data, dtype=dtype).reshape(altitude_count, encoder_count)
+    return Frame(name, scan, None if math.isnan(timestamp) else timestamp,
+                 None if any(math.isnan(value) for value in pose) else tuple(pose), time.perf_counter())
+
+class LatencyTracker:
+    """Percentiles over the most recent latencies"""
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+
+    def add(self, seconds):
+        self.latencies.append(seconds)
+
+    def percentiles(self, qs=(50, 90, 99)):
+        """{q: seconds}, empty before the first latency"""
+        if not self.latencies:
+            return {}
+        return dict(zip(qs, np.percentile(np.fromiter(self.latencies, dtype=np.float64), qs)))
+
+    def __str__(self):
+        percentiles = self.percentiles()
+        if not percentiles:
+            return "no scans mapped yet"
+        return ", ".join(f"p{q} {seconds * 1000:.1f} ms" for q, seconds in percentiles.items())
+
+class IngestService:
+    """Accepts framed scans on a socket and streams them into the database and an in-memory map
+
+    Each frame goes through three stages joined by bounded queues:
+    connection handlers read frames into the frame queue (applying policy
+    when it is full), converters project them in an executor (worker
+    processes, or threads with workers=0), and two consumers insert the
+    points into the VoxelMap and store scans in the database. Converted
+    scans are handed to the consumers in the order their frames were
+    received, so scan_ids follow the stream whatever order the converters
+    finish in. The database
+    commits once batch_size scans are pending or the oldest has waited
+    flush_interval seconds. Latency is measured from the moment a frame is
+    fully received until its points are in the map.
+    """
+
+    def __init__(self, db=None, voxel_map=None, sensor_model=None, point_filter=None, workers=2, queue_size=64,
+                 policy="block", batch_size=50, flush_interval=1.0, insert_mode="points", max_range=None,
+                 latency_window=10000, log=sys.stderr):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.db = db
+        self.voxel_map = voxel_map
+        self.sensor_model = sensor_model
+        self.point_filter = point_filter
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.insert_mode = insert_mode
+        self.max_range = max_range
+        self.log = log
+        self.latency = LatencyTracker(latency_window)
+        self.convert_stage = StageCounter("convert")
+        self.map_stage = StageCounter("map")
+        self.counts = {"received": 0, "dropped": 0, "failed": 0, "stored": 0, "bad_frames": 0, "connections": 0}
+        self._stopping = None
+
+    def stats(self):
+        """Counters, queue depth and latency percentiles in seconds"""
+        stats = dict(self.counts, converted=self.convert_stage.scans, mapped=self.map_stage.scans,
+                     queued=self._frames.qsize() if self._stopping else 0)
+        stats.update({f"latency_p{q}": seconds for q, seconds in self.latency.percentiles().items()})
+        return stats
+
+    def report(self, prefix=""):
+        if self.log is not None:
+            counts = ", ".join(f"{value} {name}" for name, value in self.counts.items())
+            print(f"{prefix}{counts}, {self.map_stage.scans} mapped; latency {self.latency}", file=self.log)
+
+    def stop(self):
+        """Stop accepting scans; serve() returns once the queued ones are stored"""
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def _submit(self, frame):
+        self.counts["received"] += 1
+        count("service_frames_received")
+        if self.policy == "block":
+            await self._frames.put(frame)
+            return
+        if self._frames.full():
+            self.counts["dropped"] += 1
+            count("service_frames_dropped", policy=self.policy)
+            if self.policy == "drop-newest":
+                return
+            self._frames.get_nowait()
+        self._frames.put_nowait(frame)
+
+    async def _handle_connection(self, reader, writer):
+        self.counts["connections"] += 1
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self._stopping.is_set():
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                await self._submit(frame)
+                if self._max_scans and self.counts["received"] >= self._max_scans:
+                    self.stop()
+        except ValueError as e:
+            self.counts["bad_frames"] += 1
+            if self.log is not None:
+                print(f"Closing connection: {e}", file=self.log)
+        except (ConnectionError, asyncio.CancelledError):
+            # Cancelled by serve() draining; ending quietly keeps asyncio from reporting it
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _release(self, sequence, received, result):
+        """Pass converted scans on to the consumers in the order their frames were taken from the queue
+
+        result None marks a frame that failed to convert; it is skipped
+        without holding up the frames after it.
+        """
+        self._converted[sequence] = (received, result)
+        async with self._release_lock:
+            while self._next_release in self._converted:
+                received, result = self._converted.pop(self._next_release)
+                self._next_release += 1
+                if result is not None:
+                    await self._forward(received, result)
+
+    async def _forward(self, received, result):
+        await self._mapped.put((received, result))
+        if self.db is not None:
+            await self._stored.put(result)
+
+    async def _convert_loop(self, loop, executor):
+        while True:
+            frame = await self._frames.get()
+            if frame is None:
+                return
+            # The queue is first in, first out, so this numbers the frames in receipt order
+            sequence = self._next_sequence
+            self._next_sequence += 1
+            try:
+                if self.workers > 0:
+                    result = await loop.run_in_executor(executor, _worker_convert_scan, frame.name, frame.scan,
+                                                        frame.pose, frame.timestamp)
+                else:
+                    result = await loop.run_in_executor(executor, convert_scan, frame.name, frame.scan,
+                                                        self.sensor_model, frame.pose, self.point_filter,
+                                                        frame.timestamp)
+            except Exception as e:
+                # One scan the sensor model cannot convert must not stop the stream
+                self.counts["failed"] += 1
+                count("service_frames_failed")
+                if self.log is not None:
+                    print(f"Dropping scan {frame.name!r}: {e}", file=self.log)
+                await self._release(sequence, frame.received, None)
+                continue
+            self.convert_stage.add(len(result.points), result.seconds)
+            observe("scan_convert_seconds", result.seconds)
+            await self._release(sequence, frame.received, result)
+
+    def _insert(self, result):
+        start = time.perf_counter()
+        if self.insert_mode == "rays" and result.pose is not None:
+            self.voxel_map.insert_scan(result.points, result.pose[:3], self.max_range)
+        else:
+            self.voxel_map.insert_points(result.points)
+        self.map_stage.add(len(result.points), time.perf_counter() - start)
+
+    async def _map_loop(self, loop, executor):
+        while True:
+            item = await self._mapped.get()
+            if item is None:
+                return
+            received, result = item
+            if self.voxel_map is not None:
+                await loop.run_in_executor(executor, self._insert, result)
+            else:
+                self.map_stage.add(len(result.points), 0.0)
+            latency = time.perf_counter() - received
+            self.latency.add(latency)
+            observe("service_latency_seconds", latency)
+
+    async def _store_loop(self, loop, executor):
+        sink = DatabaseSink(self.db, self.sensor_model, self.batch_size)
+        oldest = None
+        while True:
+            timeout = None if oldest is None else max(0.0, oldest + self.flush_interval - time.monotonic())
+            try:
+                result = await asyncio.wait_for(self._stored.get(), timeout)
+            except asyncio.TimeoutError:
+                result = False
+            if result:
+                if not len(sink):
+                    oldest = time.monotonic()
+                # write() commits by itself once batch_size scans are pending
+                await loop.run_in_executor(executor, sink.write, result)
+                self.counts["stored"] += 1
+            if result is None or (len(sink) and time.monotonic() - oldest >= self.flush_interval):
+                await loop.run_in_executor(executor, sink.flush)
+            if not len(sink):
+                oldest = None
+            if result is None:
+                return
+
+    async def serve(self, host=None, port=None, path=None, max_scans=None, stats_interval=5.0):
+        """Accept scans on a Unix socket at path or on host:port until stop() or max_scans, then drain"""
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._connections = set()
+        self._max_scans = max_scans
+        self._frames = asyncio.Queue(self.queue_size)
+        converters = max(1, 2 * self.workers)
+        self._mapped = asyncio.Queue(converters)
+        self._stored = asyncio.Queue(max(converters, self.batch_size))
+        self._next_sequence = self._next_release = 0
+        self._converted = {}
+        self._release_lock = asyncio.Lock()
+
+        if self.workers > 0:
+            model_json = self.sensor_model.to_json() if self.sensor_model else None
+            convert_executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                   initargs=(model_json, self.point_filter))
+        else:
+            convert_executor = ThreadPoolExecutor(max_workers=1)
+        # One thread each: the map and the database connection are only touched by one thread
+        map_executor = ThreadPoolExecutor(max_workers=1)
+        db_executor = ThreadPoolExecutor(max_workers=1)
+
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self._handle_connection, path)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host, port)
+        if self.log is not None:
+            where = path or ", ".join(str(s.getsockname()[:2]) for s in server.sockets)
+            print(f"Listening on {where} ({self.policy} when {self.queue_size} frames are queued)", file=self.log)
+
+        tasks = [loop.create_task(self._convert_loop(loop, convert_executor)) for _ in range(converters)]
+        consumers = [loop.create_task(self._map_loop(loop, map_executor))]
+        if self.db is not None:
+            consumers.append(loop.create_task(self._store_loop(loop, db_executor)))
+        try:
+            async with server:
+                while not self._stopping.is_set():
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), stats_interval or None)
+                    except asyncio.TimeoutError:
+                        self.report("  ")
+            # Drain: drop the connections, let the converters finish the queued frames,
+            # then the consumers the converted scans
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            for _ in tasks:
+                await self._frames.put(None)
+            # A converter that died anyway must not keep the converted scans from being stored
+            for error in await asyncio.gather(*tasks, return_exceptions=True):
+                if error is not None and self.log is not None:
+                    print(f"Converter failed: {error!r}", file=self.log)
+            # Scans still held back behind a frame whose converter died, in order
+            for sequence in sorted(self._converted):
+                received, result = self._converted.pop(sequence)
+                if result is not None:
+                    await self._forward(received, result)
+            await self._mapped.put(None)
+            if self.db is not None:
+                await self._stored.put(None)
+            await asyncio.gather(*consumers)
+        finally:
+            for task in tasks + consumers:
+                task.cancel()
+            convert_executor.shutdown()
+            map_executor.shutdown()
+            db_executor.shutdown()
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        self.report("Stopped: ")
+        return self.stats()
+
+async def replay(file_names, host=None, port=None, path=None, rate=None, poses=None, timestamps=None, repeat=1):
+    """Send scan pickles or .scans containers to a running service, at most rate scans per second
+
+    Returns the number of scans sent. Sending waits whenever the service
+    applies backpressure.
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    sent = 0
+    start = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            for source in scan_sources(file_names):
+                record = read_scan(source)
+                pose = (poses or {}).get(source.name, record.pose)
+                timestamp = (timestamps or {}).get(source.name, record.timestamp)
+                writer.write(encode_frame(record.scan, source.name, timestamp, pose))
+                await writer.drain()
+                sent += 1
+                if rate:
+                    await asyncio.sleep(max(0.0, start + sent / rate - time.perf_counter()))
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            # The service hung up first (e.g. it reached its --max-scans)
+            pass
+    return sent
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-running service ingesting live scans from a socket, "
+                                                 "or replay scan files into one")
+    parser.add_argument("--host", default="127.0.0.1", help="TCP address to listen on or send to")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port")
+    parser.add_argument("--socket", help="Unix socket path (instead of TCP)")
+    parser.add_argument("--replay", nargs="+", metavar="FILE",
+                        help="Send these scan pickles or .scans containers to a running service and exit")
+    parser.add_argument("--rate", type=float, help="With --replay, scans per second (default: as fast as accepted)")
+    parser.add_argument("--repeat", type=int, default=1, help="With --replay, send the files this many times")
+    parser.add_argument("--poses", help="CSV of file_name,tx,ty,tz,qw,qx,qy,qz sensor poses per scan file, "
+                                        "or file_name,timestamp with --trajectory (sent with --replay)")
+    parser.add_argument("--trajectory", help="CSV of timestamp,tx,ty,tz,qw,qx,qy,qz poses to interpolate "
+                                             "the --poses timestamps from")
+    parser.add_argument("--db", default="lidar_data.db", help="Database to store scans and points in")
+    parser.add_argument("--no-db", action="store_true", help="Only update the in-memory map")
+    parser.add_argument("--point-storage", choices=POINT_STORAGE_MODES, default="blob",
+                        help="Store points as one row per point or one blob per scan")
+    parser.add_argument("--calibration", help="Sensor model calibration JSON (default: built-in geometry)")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes (0 converts in a thread)")
+    parser.add_argument("--queue-size", type=int, default=64, help="Frames received but not yet converted")
+    parser.add_argument("--policy", choices=QUEUE_POLICIES, default="block",
+                        help="What to do with a frame arriving at a full queue")
+    parser.add_argument("--batch-size", type=int, default=50, help="Commit once this many scans are pending")
+    parser.add_argument("--flush-interval", type=float, default=1.0,
+                        help="Commit once the oldest pending scan has waited this many seconds")
+    parser.add_argument("--resolution", type=float, default=10.0, help="Leaf size of the in-memory map")
+    parser.add_argument("--insert", choices=("points", "rays"), default="points",
+                        help="Insert bare endpoints or whole rays from each scan's pose")
+    parser.add_argument("--ray-max-range", type=float, help="With --insert rays, truncate rays longer than this")
+    parser.add_argument("--map-out", help="Write the map as .bt here on shutdown")
+    parser.add_argument("--max-scans", type=int, help="Shut down after receiving this many scans")
+    parser.add_argument("--stats-interval", type=float, default=5.0,
+                        help="Seconds between counter and latency reports on stderr (0 disables them)")
+    add_filter_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.replay:
+        poses, timestamps = None, None
+        if args.poses:
+            poses, timestamps = read_pose_file(args.poses,
+                                               read_trajectory(args.trajectory) if args.trajectory else None)
+        sent = asyncio.run(replay(args.replay, args.host, args.port, args.socket, args.rate, poses, timestamps,
+                                  args.repeat))
+        print(f"Sent {sent} scans")
+        return
+
+    enable_from_args(args)
+    sensor_model = SensorModel.from_calibration_file(args.calibration) if args.calibration else None
+    db = None if args.no_db else LiDARDatabase(args.db, point_storage=args.point_storage)
+    voxel_map = VoxelMap(args.resolution)
+    service = IngestService(db, voxel_map, sensor_model, point_filter_from_args(args), args.workers,
+                            args.queue_size, args.policy, args.batch_size, args.flush_interval, args.insert,
+                            args.ray_max_range)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, service.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        return await service.serve(args.host, args.port, args.socket, args.max_scans, args.stats_interval)
+
+    try:
+        asyncio.run(run())
+        if args.map_out:
+            voxel_map.write_bt(args.map_out)
+            print(f"{len(voxel_map)} voxels -> {args.map_out}")
+    finally:
+        if db is not None:
+            db.close()
+        write_metrics_from_args(args)
+
+if __name__ == "__main__":
+    main()
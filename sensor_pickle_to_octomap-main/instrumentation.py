@@ -0,0 +1,251 @@
+import bisect
+import functools
+import json
+import re
+import threading
+import time
+import tracemalloc
+
+# Histogram bucket upper bounds for span durations in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+# Bucket bounds for the net bytes allocated by a span (freeing more than it allocates lands in the first)
+MEMORY_BUCKETS = (0, 1 << 10, 1 << 13, 1 << 16, 1 << 20, 1 << 23, 1 << 26, 1 << 30)
+# Prefix of every exported metric name
+METRIC_PREFIX = "lidar_"
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations <= bound) pairs ending with +Inf"""
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class _Registry:
+    """Process-wide metric state; the instrumentation functions below are its only users"""
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.snapshots = []
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+_registry = _Registry()
+
+class _NullSpan:
+    """What span() returns while instrumentation is off: enters and exits doing nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add(self, name, value=1):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    """A timed section; add() counts work done inside it under the span's labels"""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        if _registry.trace_memory:
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        labels = dict(self.labels, status="error" if exc_type else "ok")
+        observe(f"{self.name}_seconds", seconds, **labels)
+        if _registry.trace_memory:
+            observe(f"{self.name}_allocated_bytes", tracemalloc.get_traced_memory()[0] - self._memory,
+                    MEMORY_BUCKETS, **self.labels)
+        return False
+
+    def add(self, name, value=1):
+        count(f"{self.name}_{name}", value, **self.labels)
+
+def enable(trace_memory=False):
+    """Start collecting metrics; with trace_memory, spans also record the net bytes they allocate"""
+    _registry.enabled = True
+    _registry.trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    """Stop collecting metrics (what was collected is kept until reset)"""
+    _registry.enabled = False
+    if _registry.trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _registry.trace_memory = False
+
+def is_enabled():
+    return _registry.enabled
+
+def reset():
+    """Drop all collected metrics and snapshots"""
+    with _registry.lock:
+        _registry.counters.clear()
+        _registry.histograms.clear()
+        _registry.snapshots.clear()
+
+def count(name, value=1, **labels):
+    """Add value to a counter"""
+    if not _registry.enabled:
+        return
+    key = _registry.key(name, labels)
+    with _registry.lock:
+        _registry.counters[key] = _registry.counters.get(key, 0) + value
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Record value in a histogram"""
+    if not _registry.enabled:
+        return
+    key = _registry.key(name, labels)
+    with _registry.lock:
+        histogram = _registry.histograms.get(key)
+        if histogram is None:
+            histogram = _registry.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+def span(name, **labels):
+    """Context manager timing a section into the <name>_seconds histogram
+
+    Returns a shared do-nothing object while instrumentation is off, so
+    spans can stay in hot paths.
+    """
+    if not _registry.enabled:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+def instrumented(name):
+    """Decorator running every call of the function inside span(name)"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _registry.enabled:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def memory_snapshot(label, limit=10):
+    """Record the top allocation sites by size (needs enable(trace_memory=True))"""
+    if not _registry.enabled or not tracemalloc.is_tracing():
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+    with _registry.lock:
+        _registry.snapshots.append({
+            "label": label,
+            "time": time.time(),
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [{"site": str(stat.traceback[0]), "bytes": stat.size, "blocks": stat.count} for stat in top],
+        })
+
+def collect():
+    """Snapshot of all metrics as a list of dicts, one per counter, histogram or memory snapshot"""
+    with _registry.lock:
+        records = [{"type": "counter", "name": name, "labels": dict(labels), "value": value}
+                   for (name, labels), value in sorted(_registry.counters.items())]
+        for (name, labels), histogram in sorted(_registry.histograms.items()):
+            records.append({
+                "type": "histogram", "name": name, "labels": dict(labels),
+                "count": histogram.count, "sum": histogram.sum,
+                "buckets": [[bound if bound != float("inf") else "+Inf", total]
+                            for bound, total in histogram.cumulative()],
+            })
+        records += [dict(snapshot, type="memory_snapshot") for snapshot in _registry.snapshots]
+    return records
+
+def export_jsonl(stream):
+    """Write collect() to stream as JSON lines, stamped with the export time"""
+    now = time.time()
+    for record in collect():
+        stream.write(json.dumps(dict(record, exported=now)) + "\n")
+
+def _metric_name(name):
+    return METRIC_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def _label_text(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+def export_prometheus(stream):
+    """Write the counters and histograms to stream in the Prometheus text exposition format"""
+    typed = set()
+    for record in collect():
+        if record["type"] == "memory_snapshot":
+            continue
+        name = _metric_name(record["name"])
+        if record["type"] == "counter":
+            name += "_total"
+        if name not in typed:
+            stream.write(f"# TYPE {name} {record['type']}\n")
+            typed.add(name)
+        if record["type"] == "counter":
+            stream.write(f"{name}{_label_text(record['labels'])} {record['value']}\n")
+            continue
+        for bound, total in record["buckets"]:
+            stream.write(f"{name}_bucket{_label_text(record['labels'], le=bound)} {total}\n")
+        stream.write(f"{name}_sum{_label_text(record['labels'])} {record['sum']}\n")
+        stream.write(f"{name}_count{_label_text(record['labels'])} {record['count']}\n")
+
+def write_metrics(path):
+    """Export to path: Prometheus text for .prom files, JSON lines otherwise"""
+    with open(path, "w") as f:
+        if path.endswith(".prom"):
+            export_prometheus(f)
+        else:
+            export_jsonl(f)
+
+def add_metrics_arguments(parser):
+    """Add the --metrics and --trace-memory options to an argparse parser"""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--metrics", metavar="PATH",
+                       help="Collect per-stage timings and counters and write them here on exit "
+                            "(Prometheus text for .prom, JSON lines otherwise)")
+    group.add_argument("--trace-memory", action="store_true",
+                       help="With --metrics, also record allocations per span and memory snapshots (slower)")
+
+def enable_from_args(args):
+    """Enable instrumentation if --metrics was given"""
+    if args.metrics:
+        enable(trace_memory=args.trace_memory)
+
+def write_metrics_from_args(args):
+    """Write the metrics to the --metrics path, if given"""
+    if args.metrics:
+        memory_snapshot("exit")
+        write_metrics(args.metrics)
@@ -0,0 +1,57 @@
+import argparse
+import os
+from db_utils import LiDARDatabase, POINT_BLOB_CODECS
+from range_codec import DEFAULT_RANGE_SCALE, RANGE_CODECS
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a row-per-point LiDAR database to per-scan point blobs "
+                    "and backfill derived tables")
+    parser.add_argument("db_path", nargs="?", default="lidar_data.db", help="Database to migrate")
+    parser.add_argument("--codec", choices=POINT_BLOB_CODECS, default="shuffle-zlib",
+                        help="Encoding of the point blobs")
+    parser.add_argument("--no-blobs", action="store_true",
+                        help="Leave point storage as it is and only run the requested rebuilds")
+    parser.add_argument("--keep-rows", action="store_true",
+                        help="Leave the original point_clouds rows in place")
+    parser.add_argument("--rebuild-spatial-index", action="store_true",
+                        help="Re-index every scan (needed for scans stored before the spatial index)")
+    parser.add_argument("--rebuild-scan-stats", action="store_true",
+                        help="Compute scan_stats and point_density for scans stored before those tables existed")
+    parser.add_argument("--range-codec", choices=RANGE_CODECS,
+                        help="Re-encode the stored raw scans with this range codec")
+    parser.add_argument("--range-scale", type=float, default=DEFAULT_RANGE_SCALE,
+                        help="Fixed-point step of the quantized range codecs, in range units "
+                             "(default: 1 for whole-number ranges such as millimetres, 0.001 otherwise)")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="VACUUM afterwards to return freed pages to the filesystem")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db_path):
+        parser.error(f"{args.db_path} does not exist")
+
+    size_before = os.path.getsize(args.db_path)
+    db = LiDARDatabase(args.db_path, point_storage="blob", point_codec=args.codec)
+    if not args.no_blobs:
+        converted = db.convert_rows_to_blobs(keep_rows=args.keep_rows)
+        print(f"Converted {converted} scans to {args.codec} point blobs")
+
+    if args.rebuild_spatial_index:
+        print(f"Indexed {db.rebuild_spatial_index()} scans")
+
+    if args.rebuild_scan_stats:
+        print(f"Computed statistics for {db.rebuild_scan_stats()} scans")
+
+    if args.range_codec:
+        print(f"Re-encoded {db.recode_raw_scans(args.range_codec, args.range_scale)} raw scans "
+              f"with {args.range_codec}")
+
+    if args.vacuum:
+        db.connect().execute("VACUUM")
+    db.close()
+
+    size_after = os.path.getsize(args.db_path)
+    print(f"Database size: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 #include <vector>
 #include <map>
+#include <memory>
 #include <iostream>
 #include <string>
 #include <sstream>
 
 #include <fstream>
 #include <stdio.h>
+#include <stdint.h>
+#include <cstdlib>
 #ifdef _WIN32
   #include <Windows.h>  // to define Sleep()
 #else
@@ -75,83 +78,403 @@ std::string Command_Line_Argument_Parser::get_command() { return command; }
 std::vector<std::string> Command_Line_Argument_Parser::get_lone_arguments() { return lone_arguments; }
 std::map<std::string, std::string> Command_Line_Argument_Parser::get_flag_arguments() { return flag_arguments; }
 
-int main(int argc, char *argv[]) {
-
-	Command_Line_Argument_Parser parser{argc,argv};
-	std::map<std::string,std::string> flag_args = parser.get_flag_arguments();
+// One scan's points together with the sensor pose they were measured from
+struct Scan_Block {
+	pose6d pose;
+	Pointcloud points;
+};
 
-	if (
-		flag_args["--xyz_csv"].empty() ||
-		flag_args["--out"].empty()
-	) {
-		std::cout << parser.get_command()
-			<< " --xyz_csv <xyz csv point cloud file> --out <output octomap file>\n";
-		return -1;
+// Bulk-read count * 3 float32 values and append them to points
+static bool read_float_points(FILE *file, size_t count, Pointcloud &points) {
+	std::vector<float> buffer(count * 3);
+	if ( count > 0 && fread(buffer.data(), sizeof(float), buffer.size(), file) != buffer.size() ) {
+		return false;
 	}
+	points.reserve(points.size() + count);
+	for ( size_t i = 0; i < count; i++ ) {
+		points.push_back(buffer[3 * i], buffer[3 * i + 1], buffer[3 * i + 2]);
+	}
+	return true;
+}
 
-	Pointcloud point_cloud;
-	OcTreeStamped tree(10);
-	std::ifstream infile(flag_args["--xyz_csv"]);
+// x,y,z text with a header line, all points in one scan taken at the origin
+bool read_xyz_csv(const std::string &path, std::vector<Scan_Block> &scans) {
+	std::ifstream infile(path);
 	if ( !infile ) {
 		std::cout << "could not open file\n";
-		return -1;
+		return false;
 	}
 
+	Scan_Block scan;
 	std::string line;
 	std::getline(infile,line);
 
 	while ( std::getline(infile,line) ) {
 
 		std::stringstream ss(line);
-		// std::cout << "ss.str(): " << ss.str() << "\n";
 		if ( !ss.good() ) {
 			std::cout << "Could not get x\n";
-			return -2;
+			return false;
 		}
 
 		std::string substr;
 		std::getline(ss, substr, ',');
-		// std::cout << "ss.str(): " << ss.str() << "\n";
-		// std::cout << "substr: " << substr << "\n";
 		float x = std::stof(substr);
 		if ( !ss.good() ) {
 			std::cout << "Could not get y\n";
-			return -3;
+			return false;
 		}
 
 		std::getline(ss, substr, ',');
-		// std::cout << "ss.str(): " << ss.str() << "\n";
-		// std::cout << "substr: " << substr << "\n";
 		float y = std::stof(substr);
 		if ( !ss.good() ) {
 			std::cout << "Could not get z\n";
-			return -4;
+			return false;
 		}
 
 		std::getline(ss, substr, '\n');
-		// std::cout << "ss.str(): " << ss.str() << "\n";
-		// std::cout << "substr: " << substr << "\n";
 		float z = std::stof(substr);
-		// if ( !ss.good() ) {
-		// 	std::cout << "Could not get z\n";
-		// 	return -5;
-		// }
-
-		// std::cout << "(x,y,z): " << "(" << x << "," << y << "," << z << ")\n";
-		// point3d begin(0.0,0.0,0.0);
-		point3d end(x,y,z);
-		tree.updateNode(end,true);
-		// point_cloud.push_back(end);
-		// tree.insertRay(begin,end);
-	}
-
-	point3d begin(0.0,0.0,0.0);
-	// tree.insertPointCloudRays(point_cloud,begin);
-	// tree.insertPointCloud(point_cloud,begin);
-	tree.toMaxLikelihood();
-	tree.updateInnerOccupancy();
-
-	// std::cout << "tree.writeBinary(\"" << flag_args["--out"] << "\");\n";
-	tree.writeBinary(flag_args["--out"]);
-	std::cout << "\n";
+
+		scan.points.push_back(x, y, z);
+	}
+	scans.push_back(scan);
+	return true;
+}
+
+// .xyz.bin written by point_io.py: a 16 byte header ("XYZB", version, scan
+// count, reserved) then per scan 7 float32 pose values (tx ty tz qw qx qy qz),
+// a uint32 point count and the float32 points. Little endian.
+bool read_xyz_bin(const std::string &path, std::vector<Scan_Block> &scans) {
+	FILE *file = fopen(path.c_str(), "rb");
+	if ( !file ) {
+		std::cout << "could not open file\n";
+		return false;
+	}
+
+	char magic[4];
+	uint32_t header[3];
+	if ( fread(magic, 1, 4, file) != 4 || fread(header, sizeof(uint32_t), 3, file) != 3
+		|| std::string(magic, 4) != "XYZB" || header[0] != 1 ) {
+		std::cout << path << " is not a version 1 .xyz.bin file\n";
+		fclose(file);
+		return false;
+	}
+	uint32_t scan_count = header[1];  // 0 when written to a pipe: read until EOF
+
+	float pose[7];
+	uint32_t point_count;
+	while ( scan_count == 0 || scans.size() < scan_count ) {
+		if ( fread(pose, sizeof(float), 7, file) != 7 ) {
+			break;
+		}
+		if ( fread(&point_count, sizeof(uint32_t), 1, file) != 1 ) {
+			std::cout << "Truncated scan header in " << path << "\n";
+			fclose(file);
+			return false;
+		}
+		Scan_Block scan;
+		scan.pose = pose6d(point3d(pose[0], pose[1], pose[2]), Quaternion(pose[3], pose[4], pose[5], pose[6]));
+		if ( !read_float_points(file, point_count, scan.points) ) {
+			std::cout << "Truncated scan data in " << path << "\n";
+			fclose(file);
+			return false;
+		}
+		scans.push_back(scan);
+	}
+	fclose(file);
+	if ( scan_count != 0 && scans.size() != scan_count ) {
+		std::cout << path << " holds " << scans.size() << " of " << scan_count << " scans\n";
+		return false;
+	}
+	return true;
+}
+
+// Binary PCD with FIELDS x y z, float32
+bool read_pcd(const std::string &path, std::vector<Scan_Block> &scans) {
+	FILE *file = fopen(path.c_str(), "rb");
+	if ( !file ) {
+		std::cout << "could not open file\n";
+		return false;
+	}
+
+	std::map<std::string, std::string> fields;
+	char line[1024];
+	while ( fields.find("DATA") == fields.end() && fgets(line, sizeof(line), file) ) {
+		std::string text(line);
+		text.erase(text.find_last_not_of("\r\n") + 1);
+		if ( text.empty() || text[0] == '#' ) {
+			continue;
+		}
+		size_t space = text.find(' ');
+		fields[text.substr(0, space)] = space == std::string::npos ? "" : text.substr(space + 1);
+	}
+	if ( fields["DATA"] != "binary" || fields["FIELDS"] != "x y z" || fields["TYPE"] != "F F F"
+		|| fields["SIZE"] != "4 4 4" ) {
+		std::cout << path << ": only binary x y z float32 PCD files are supported\n";
+		fclose(file);
+		return false;
+	}
+
+	Scan_Block scan;
+	bool ok = read_float_points(file, std::stoul(fields["POINTS"]), scan.points);
+	fclose(file);
+	if ( !ok ) {
+		std::cout << "Truncated point data in " << path << "\n";
+		return false;
+	}
+	scans.push_back(scan);
+	return true;
+}
+
+// NumPy .npy holding one C-ordered (N, 3) '<f4' array
+bool read_npy(const std::string &path, std::vector<Scan_Block> &scans) {
+	FILE *file = fopen(path.c_str(), "rb");
+	if ( !file ) {
+		std::cout << "could not open file\n";
+		return false;
+	}
+
+	unsigned char preamble[8];
+	uint32_t header_length = 0;
+	bool ok = fread(preamble, 1, 8, file) == 8 && std::string((char *)preamble + 1, 5) == "NUMPY";
+	if ( ok && preamble[6] == 1 ) {
+		uint16_t length;
+		ok = fread(&length, sizeof(length), 1, file) == 1;
+		header_length = length;
+	} else if ( ok ) {
+		ok = fread(&header_length, sizeof(header_length), 1, file) == 1;
+	}
+	std::string header(header_length, ' ');
+	ok = ok && fread(&header[0], 1, header_length, file) == header_length;
+
+	size_t shape = ok ? header.find("'shape': (") : std::string::npos;
+	if ( !ok || header.find("'descr': '<f4'") == std::string::npos
+		|| header.find("'fortran_order': False") == std::string::npos || shape == std::string::npos ) {
+		std::cout << path << ": expected an .npy file with a C-ordered float32 (N, 3) array\n";
+		fclose(file);
+		return false;
+	}
+	char *rest = NULL;
+	size_t point_count = std::strtoul(header.c_str() + shape + 10, &rest, 10);
+	if ( header.compare(rest - header.c_str(), 4, ", 3)") != 0 ) {
+		std::cout << path << ": expected an (N, 3) array\n";
+		fclose(file);
+		return false;
+	}
+
+	Scan_Block scan;
+	ok = read_float_points(file, point_count, scan.points);
+	fclose(file);
+	if ( !ok ) {
+		std::cout << "Truncated point data in " << path << "\n";
+		return false;
+	}
+	scans.push_back(scan);
+	return true;
+}
+
+// Insert one scan into a tree; returns the number of points dropped as unrepresentable
+size_t insert_scan(OcTreeStamped &tree, const Scan_Block &scan, const std::string &insert_mode,
+		double max_range, bool discretize) {
+	const Pointcloud &points = scan.points;
+	point3d origin = scan.pose.trans();
+
+	if ( insert_mode == "points" ) {
+		for ( size_t i = 0; i < points.size(); i++ ) {
+			if ( max_range < 0.0 || (points[i] - origin).norm() <= max_range ) {
+				tree.updateNode(points[i], true, true);
+			}
+		}
+		return 0;
+	}
+
+	// Points are in the map frame and the pose's translation is where the
+	// sensor was. insertPointCloud collects the free and occupied keys of the
+	// whole scan into sets first, so every voxel is updated once per scan;
+	// discretize also merges endpoints that share a voxel before casting rays.
+	if ( max_range >= 0.0 ) {
+		tree.insertPointCloud(points, origin, max_range, true, discretize);
+		return 0;
+	}
+
+	// Without a max range, endpoints outside the map's key range (e.g.
+	// no-return sentinels) cannot be inserted as rays; drop them
+	Pointcloud in_bounds;
+	in_bounds.reserve(points.size());
+	OcTreeKey key;
+	for ( size_t i = 0; i < points.size(); i++ ) {
+		if ( tree.coordToKeyChecked(points[i], key) ) {
+			in_bounds.push_back(points[i]);
+		}
+	}
+	tree.insertPointCloud(in_bounds, origin, max_range, true, discretize);
+	return points.size() - in_bounds.size();
+}
+
+static bool has_suffix(const std::string &text, const std::string &suffix) {
+	return text.size() >= suffix.size() && text.compare(text.size() - suffix.size(), suffix.size(), suffix) == 0;
+}
+
+// Load a map to extend: .ot keeps the full log-odds and timestamps, .bt only
+// the maximum-likelihood occupancy (each voxel restarts at the clamping value)
+OcTreeStamped *read_map(const std::string &path) {
+	if ( has_suffix(path, ".ot") ) {
+		AbstractOcTree *tree = AbstractOcTree::read(path);
+		OcTreeStamped *stamped = dynamic_cast<OcTreeStamped *>(tree);
+		if ( !stamped ) {
+			std::cout << path << " is not an OcTreeStamped map\n";
+			delete tree;
+		}
+		return stamped;
+	}
+	OcTreeStamped *tree = new OcTreeStamped(0.1);
+	// readBinary takes the resolution from the file
+	if ( !tree->readBinary(path) ) {
+		delete tree;
+		return NULL;
+	}
+	return tree;
+}
+
+// Output file for one resolution: "{res}" in the pattern is replaced, otherwise
+// "_<res>" goes before the extension when several resolutions are built
+std::string output_path(const std::string &pattern, double resolution, bool multiple) {
+	std::ostringstream formatted;
+	formatted << resolution;
+	size_t placeholder = pattern.find("{res}");
+	if ( placeholder != std::string::npos ) {
+		return pattern.substr(0, placeholder) + formatted.str() + pattern.substr(placeholder + 5);
+	}
+	if ( !multiple ) {
+		return pattern;
+	}
+	size_t dot = pattern.find_last_of('.');
+	size_t slash = pattern.find_last_of('/');
+	if ( dot == std::string::npos || (slash != std::string::npos && dot < slash) ) {
+		dot = pattern.size();
+	}
+	return pattern.substr(0, dot) + "_" + formatted.str() + pattern.substr(dot);
+}
+
+int main(int argc, char *argv[]) {
+
+	Command_Line_Argument_Parser parser{argc,argv};
+	std::map<std::string,std::string> flag_args = parser.get_flag_arguments();
+
+	int input_count = !flag_args["--xyz_csv"].empty() + !flag_args["--xyz_bin"].empty()
+		+ !flag_args["--pcd"].empty() + !flag_args["--npy"].empty();
+	if (
+		input_count != 1 ||
+		flag_args["--out"].empty()
+	) {
+		std::cout << parser.get_command()
+			<< " (--xyz_csv <xyz csv point cloud file> | --xyz_bin <.xyz.bin file>"
+			<< " | --pcd <binary pcd file> | --npy <.npy file>) --out <output octomap file>"
+			<< " [--resolution <m> | --resolutions <m>,<m>,... | --in <map.bt|map.ot>]"
+			<< " [--insert points|rays] [--max_range <m>] [--discretize 0|1]\n";
+		return -1;
+	}
+
+	// points: mark each endpoint occupied (no free space).
+	// rays: insert each scan from its sensor origin, carving free space along every ray.
+	std::string insert_mode = flag_args["--insert"].empty() ? "points" : flag_args["--insert"];
+	if ( insert_mode != "points" && insert_mode != "rays" ) {
+		std::cout << "--insert must be points or rays\n";
+		return -1;
+	}
+	double max_range = flag_args["--max_range"].empty() ? -1.0 : std::stod(flag_args["--max_range"]);
+	bool discretize = !flag_args["--discretize"].empty() && flag_args["--discretize"] != "0";
+
+	// Every resolution is built from the same pass over the input
+	std::vector<double> resolutions;
+	std::stringstream resolution_list(flag_args["--resolutions"].empty()
+		? (flag_args["--resolution"].empty() ? "10" : flag_args["--resolution"])
+		: flag_args["--resolutions"]);
+	std::string item;
+	while ( std::getline(resolution_list, item, ',') ) {
+		double resolution = std::stod(item);
+		if ( resolution <= 0.0 ) {
+			std::cout << "resolutions must be positive\n";
+			return -1;
+		}
+		resolutions.push_back(resolution);
+	}
+
+	std::vector<Scan_Block> scans;
+	bool loaded;
+	if ( !flag_args["--xyz_bin"].empty() ) {
+		loaded = read_xyz_bin(flag_args["--xyz_bin"], scans);
+	} else if ( !flag_args["--pcd"].empty() ) {
+		loaded = read_pcd(flag_args["--pcd"], scans);
+	} else if ( !flag_args["--npy"].empty() ) {
+		loaded = read_npy(flag_args["--npy"], scans);
+	} else {
+		loaded = read_xyz_csv(flag_args["--xyz_csv"], scans);
+	}
+	if ( !loaded ) {
+		return -2;
+	}
+
+	std::vector<std::unique_ptr<OcTreeStamped>> trees;
+	if ( !flag_args["--in"].empty() ) {
+		// Incremental update: only the scans in the input are inserted into the existing map
+		if ( !flag_args["--resolutions"].empty() ) {
+			std::cout << "--in extends a single map and cannot be combined with --resolutions\n";
+			return -1;
+		}
+		OcTreeStamped *tree = read_map(flag_args["--in"]);
+		if ( !tree ) {
+			return -2;
+		}
+		if ( !flag_args["--resolution"].empty() && tree->getResolution() != resolutions[0] ) {
+			std::cout << flag_args["--in"] << " has resolution " << tree->getResolution()
+				<< ", not " << resolutions[0] << "\n";
+			delete tree;
+			return -1;
+		}
+		resolutions[0] = tree->getResolution();
+		trees.emplace_back(tree);
+	} else {
+		for ( size_t tree_index = 0; tree_index < resolutions.size(); tree_index++ ) {
+			trees.emplace_back(new OcTreeStamped(resolutions[tree_index]));
+		}
+	}
+
+	size_t point_count = 0;
+	std::vector<size_t> dropped_points(trees.size(), 0);
+	for ( size_t scan_index = 0; scan_index < scans.size(); scan_index++ ) {
+		point_count += scans[scan_index].points.size();
+		for ( size_t tree_index = 0; tree_index < trees.size(); tree_index++ ) {
+			dropped_points[tree_index] += insert_scan(*trees[tree_index], scans[scan_index],
+				insert_mode, max_range, discretize);
+		}
+	}
+
+	for ( size_t tree_index = 0; tree_index < trees.size(); tree_index++ ) {
+		OcTreeStamped &tree = *trees[tree_index];
+		if ( dropped_points[tree_index] > 0 ) {
+			std::cout << "Dropped " << dropped_points[tree_index] << " points outside the "
+				<< resolutions[tree_index] << " m map bounds (use --max_range to keep them as free space)\n";
+		}
+
+		tree.updateInnerOccupancy();
+
+		// .ot keeps the log-odds so later --in updates continue exactly;
+		// .bt is written as maximum likelihood (writeBinary also prunes)
+		std::string out = output_path(flag_args["--out"], resolutions[tree_index], trees.size() > 1);
+		bool written_ok = has_suffix(out, ".ot") ? tree.write(out) : tree.writeBinary(out);
+		if ( !written_ok ) {
+			std::cout << "could not write " << out << "\n";
+			return -3;
+		}
+		std::ifstream written(out, std::ios::binary | std::ios::ate);
+
+		// One line per map for octomap_builder.py to register; the path comes last
+		std::cout << "octomap resolution=" << resolutions[tree_index]
+			<< " nodes=" << tree.size()
+			<< " bytes=" << (long long)written.tellg()
+			<< " points=" << point_count
+			<< " scans=" << scans.size()
+			<< " path=" << out << "\n";
+	}
 }
@@ -0,0 +1,205 @@
+import argparse
+import os
+import subprocess
+from db_utils import LiDARDatabase
+from instrumentation import add_metrics_arguments, enable_from_args, span, write_metrics_from_args
+from point_io import XyzBinWriter, point_format_for_path
+from result_cache import add_cache_arguments, cache_key, file_digest, result_cache_from_args
+
+READER = "./my_point_cloud_reader"
+INPUT_FLAGS = {"csv": "--xyz_csv", "xyz.bin": "--xyz_bin", "pcd": "--pcd", "npy": "--npy"}
+
+def parse_map_lines(output):
+    """Parse the 'octomap key=value ... path=<file>' lines printed by the reader"""
+    maps = []
+    for line in output.splitlines():
+        if not line.startswith("octomap "):
+            continue
+        fields, _, path = line[len("octomap "):].partition(" path=")
+        values = dict(field.split("=", 1) for field in fields.split())
+        maps.append({
+            "resolution": float(values["resolution"]),
+            "node_count": int(values["nodes"]),
+            "file_size": int(values["bytes"]),
+            "point_count": int(values["points"]),
+            "scan_count": int(values["scans"]),
+            "file_path": path,
+        })
+    return maps
+
+def build_key(points_file, out, resolutions, insert_mode, max_range, discretize, fmt, reader):
+    """Cache key of a build: the point file and reader contents and every setting"""
+    return cache_key("octomap", file_digest(points_file), file_digest(reader) if os.path.isfile(reader) else reader,
+                     out, [float(r) for r in resolutions], insert_mode, max_range, discretize, fmt)
+
+def _cached_maps(cache, key):
+    """Copy the maps of a cached build to their paths; None unless all of them are cached"""
+    maps = cache.load_json(key)
+    if maps is None:
+        return None
+    for index, m in enumerate(maps):
+        if not cache.fetch_file(key, f".{index}{os.path.splitext(m['file_path'])[1]}", m["file_path"]):
+            return None
+        m["cached"] = True
+    return maps
+
+def build_octomaps(points_file, out, resolutions=(10.0,), insert_mode="points", max_range=None,
+                   discretize=False, fmt=None, reader=READER, in_map=None, cache=None):
+    """Run my_point_cloud_reader once for every resolution and return the maps it wrote
+
+    The point file is read once and all resolutions are built from that
+    pass. out is the output path; with several resolutions "{res}" in it is
+    replaced by the resolution, or "_<res>" is added before the extension.
+    With in_map the points are added to that existing map instead, at its
+    resolution. With a ResultCache a build of the same point file with the
+    same settings copies the maps from the cache; their dicts are marked
+    cached. Updates of an in_map are always run.
+    """
+    fmt = fmt or point_format_for_path(points_file)
+    key = None
+    if cache is not None and not in_map:
+        key = build_key(points_file, out, resolutions, insert_mode, max_range, discretize, fmt, reader)
+        maps = _cached_maps(cache, key)
+        if maps is not None:
+            return maps
+    command = [reader, INPUT_FLAGS[fmt], points_file, "--out", out, "--insert", insert_mode]
+    if in_map:
+        command += ["--in", in_map]
+        resolutions = [None]
+    else:
+        command += ["--resolutions", ",".join(repr(float(r)) for r in resolutions)]
+    if max_range is not None:
+        command += ["--max_range", repr(float(max_range))]
+    if discretize:
+        command += ["--discretize", "1"]
+
+    with span("octomap_build", insert=insert_mode) as timing:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{reader} failed ({result.returncode}): {result.stdout.strip()} {result.stderr.strip()}")
+        maps = parse_map_lines(result.stdout)
+        timing.add("points", maps[0]["point_count"] if maps else 0)
+        timing.add("bytes_written", sum(m["file_size"] for m in maps))
+    if len(maps) != len(resolutions):
+        raise RuntimeError(f"{reader} reported {len(maps)} maps for {len(resolutions)} resolutions")
+    if key is not None:
+        for index, m in enumerate(maps):
+            cache.store_file(key, f".{index}{os.path.splitext(m['file_path'])[1]}", m["file_path"])
+        # Written last, so a listed build always has its files (unless evicted since)
+        cache.store_json(key, maps)
+        cache.evict()
+    return maps
+
+def register_octomaps(db, maps, scan_ids=()):
+    """Record built maps in the octomaps table, linked to the scans they contain; returns their map_ids
+
+    A map copied from the cache reuses the registration of the same map
+    at the same path instead of adding another one.
+    """
+    with db.transaction():
+        map_ids = []
+        for m in maps:
+            registered = db.get_octomap_by_path(m["file_path"]) if m.get("cached") else None
+            if registered and registered[1:] == (m["resolution"], m["point_count"]):
+                map_id = registered[0]
+            else:
+                map_id = db.store_octomap(m["resolution"], m["file_path"], m["point_count"],
+                                          node_count=m["node_count"], file_size=m["file_size"])
+            db.link_octomap_scans(map_id, scan_ids)
+            map_ids.append(map_id)
+        return map_ids
+
+def update_octomap(db, map_path, resolution=10.0, insert_mode="points", max_range=None, discretize=False,
+                   reader=READER):
+    """Bring map_path up to date with the database by inserting only scans it does not contain yet
+
+    Creates the map from every stored scan at the given resolution if it is
+    not registered. Use a .ot path to keep the exact log-odds between
+    updates; a .bt map only keeps maximum-likelihood occupancy. The new map
+    replaces the old file atomically and is linked to the new scans in one
+    transaction. Returns (map_id, number of scans added).
+    """
+    registered = db.get_octomap_by_path(map_path) if os.path.exists(map_path) else None
+    map_id = registered[0] if registered else None
+    scan_ids = db.get_unintegrated_scan_ids(map_id)
+    if registered and not scan_ids:
+        return map_id, 0
+
+    root, extension = os.path.splitext(map_path)
+    points_file = root + ".pending.xyz.bin"
+    partial_map = root + ".partial" + extension
+    try:
+        # Only the new scans' points are written and read, so an update costs O(new points)
+        with open(points_file, "wb") as f:
+            writer = XyzBinWriter(f)
+            # Stored points are already in the map frame; the poses give the ray origins
+            poses = db.get_poses(scan_ids)
+            for scan_id in scan_ids:
+                writer.write_scan(db.get_point_array(scan_id), poses.get(scan_id))
+            writer.close()
+        (built,) = build_octomaps(points_file, partial_map, [resolution], insert_mode, max_range,
+                                  discretize, "xyz.bin", reader, in_map=map_path if registered else None)
+        os.replace(partial_map, map_path)
+        built["file_path"] = map_path
+    finally:
+        for path in (points_file, partial_map):
+            if os.path.exists(path):
+                os.remove(path)
+
+    with db.transaction():
+        if registered:
+            db.update_octomap(map_id, built["point_count"], built["node_count"], built["file_size"])
+            db.link_octomap_scans(map_id, scan_ids)
+        else:
+            (map_id,) = register_octomaps(db, [built], scan_ids)
+    return map_id, len(scan_ids)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build OctoMaps at one or more resolutions and register them")
+    parser.add_argument("points_file", nargs="?", help="Point file (csv, xyz.bin, pcd or npy)")
+    parser.add_argument("--out", help="Output .bt/.ot path; '{res}' is replaced by the resolution")
+    parser.add_argument("--update", metavar="MAP",
+                        help="Instead of building from a point file, add the database scans MAP "
+                             "does not contain yet (creating it if needed)")
+    parser.add_argument("--resolutions", default="10",
+                        help="Comma separated leaf sizes, e.g. 1.0,0.1 for a planning and an obstacle map "
+                             "(one value with --update)")
+    parser.add_argument("--insert", choices=("points", "rays"), default="points",
+                        help="Insert bare endpoints or whole rays (free space)")
+    parser.add_argument("--max-range", type=float, help="Truncate rays longer than this")
+    parser.add_argument("--discretize", action="store_true", help="Merge endpoints sharing a voxel first")
+    parser.add_argument("--db", default="lidar_data.db", help="Database to register the maps in")
+    parser.add_argument("--reader", default=READER, help="Path to my_point_cloud_reader")
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    enable_from_args(args)
+    try:
+        run(parser, args)
+    finally:
+        write_metrics_from_args(args)
+
+def run(parser, args):
+    """Build or update maps as requested on the command line"""
+    resolutions = [float(r) for r in args.resolutions.split(",")]
+    if args.update:
+        if len(resolutions) != 1:
+            parser.error("--update builds a single resolution")
+        with LiDARDatabase(args.db) as db:
+            map_id, added = update_octomap(db, args.update, resolutions[0], args.insert, args.max_range,
+                                           args.discretize, args.reader)
+        print(f"Map {map_id}: added {added} scans to {args.update}")
+        return
+
+    if not args.points_file or not args.out:
+        parser.error("points_file and --out are required unless --update is given")
+    maps = build_octomaps(args.points_file, args.out, resolutions, args.insert, args.max_range,
+                          args.discretize, reader=args.reader, cache=result_cache_from_args(args))
+    with LiDARDatabase(args.db) as db:
+        map_ids = register_octomaps(db, maps)
+    for map_id, m in zip(map_ids, maps):
+        print(f"Map {map_id}: {m['resolution']} m, {m['node_count']} nodes, "
+              f"{m['file_size'] / 1024:.1f} KiB -> {m['file_path']}{' (cached)' if m.get('cached') else ''}")
+
+if __name__ == "__main__":
+    main()
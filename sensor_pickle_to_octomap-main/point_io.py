@@ -0,0 +1,210 @@
+import contextlib
+import struct
+import sys
+import numpy as np
+
+# .xyz.bin layout (little endian):
+#   header: magic "XYZB", uint32 version, uint32 scan count (0 = read blocks until EOF), uint32 reserved
+#   per scan: float32 pose [tx, ty, tz, qw, qx, qy, qz], uint32 point count, count * (x, y, z) float32
+# The pose is the sensor origin and orientation the scan's points were
+# measured from; points are already in the map frame.
+XYZ_BIN_MAGIC = b"XYZB"
+XYZ_BIN_VERSION = 1
+XYZ_BIN_HEADER = struct.Struct("<4sIII")
+XYZ_BIN_BLOCK = np.dtype([("pose", "<f4", 7), ("count", "<u4")])
+IDENTITY_POSE = (0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0)
+
+POINT_FORMATS = ("csv", "xyz.bin", "pcd", "npy")
+
+def point_format_for_path(path):
+    """Guess the point file format from a file name"""
+    for fmt in ("xyz.bin", "pcd", "npy", "csv"):
+        if path.endswith("." + fmt):
+            return fmt
+    raise ValueError(f"Cannot tell the point format of {path}; expected one of {POINT_FORMATS}")
+
+def _as_float32_points(points):
+    return np.ascontiguousarray(points, dtype="<f4").reshape(-1, 3)
+
+class CsvPointWriter:
+    """x,y,z text rows, the format the octomap builder has always accepted"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.stream.write("x,y,z\n")
+
+    def write_scan(self, points, pose=None):
+        self.stream.write("".join(f"{x},{y},{z}\n" for x, y, z in np.asarray(points).reshape(-1, 3).tolist()))
+
+    def close(self):
+        self.stream.flush()
+
+class XyzBinWriter:
+    """Per-scan blocks of float32 points with the sensor pose they were taken from
+
+    The scan count in the header is filled in on close when the stream is
+    seekable; otherwise it stays 0 and readers take blocks until EOF.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.scan_count = 0
+        self._header_offset = stream.tell() if stream.seekable() else None
+        stream.write(XYZ_BIN_HEADER.pack(XYZ_BIN_MAGIC, XYZ_BIN_VERSION, 0, 0))
+
+    def write_scan(self, points, pose=None):
+        points = _as_float32_points(points)
+        block = np.zeros((), dtype=XYZ_BIN_BLOCK)
+        block["pose"] = IDENTITY_POSE if pose is None else pose
+        block["count"] = len(points)
+        self.stream.write(block.tobytes())
+        # Handed to write() as a buffer, so the points are not copied again
+        self.stream.write(memoryview(points).cast("B"))
+        self.scan_count += 1
+
+    def close(self):
+        if self._header_offset is not None:
+            end = self.stream.tell()
+            self.stream.seek(self._header_offset)
+            self.stream.write(XYZ_BIN_HEADER.pack(XYZ_BIN_MAGIC, XYZ_BIN_VERSION, self.scan_count, 0))
+            self.stream.seek(end)
+        self.stream.flush()
+
+class _CountPatchingWriter:
+    """Base for formats whose header holds the point count: it is written
+    zero-padded to a fixed width and patched on close, so the stream must be seekable"""
+    _COUNT_WIDTH = 12
+
+    def __init__(self, stream):
+        if not stream.seekable():
+            raise ValueError(f"{type(self).__name__} needs a seekable file, not a pipe")
+        self.stream = stream
+        self.point_count = 0
+        self._header_offset = stream.tell()
+        stream.write(self._header(0))
+
+    def _header(self, point_count):
+        raise NotImplementedError
+
+    def write_scan(self, points, pose=None):
+        points = _as_float32_points(points)
+        self.stream.write(memoryview(points).cast("B"))
+        self.point_count += len(points)
+
+    def close(self):
+        end = self.stream.tell()
+        self.stream.seek(self._header_offset)
+        self.stream.write(self._header(self.point_count))
+        self.stream.seek(end)
+        self.stream.flush()
+
+class PcdWriter(_CountPatchingWriter):
+    """Binary PCD v0.7 with x y z float32 fields"""
+
+    def _header(self, point_count):
+        count = f"{point_count:0{self._COUNT_WIDTH}d}"
+        return (
+            "# .PCD v0.7 - Point Cloud Data file format\n"
+            "VERSION 0.7\n"
+            "FIELDS x y z\n"
+            "SIZE 4 4 4\n"
+            "TYPE F F F\n"
+            "COUNT 1 1 1\n"
+            f"WIDTH {count}\n"
+            "HEIGHT 1\n"
+            "VIEWPOINT 0 0 0 1 0 0 0\n"
+            f"POINTS {count}\n"
+            "DATA binary\n"
+        ).encode("ascii")
+
+class NpyWriter(_CountPatchingWriter):
+    """NumPy .npy v1.0 holding one (N, 3) little-endian float32 array"""
+
+    def _header(self, point_count):
+        header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, 3), }" % point_count
+        # Pad to a fixed 128 byte preamble so the final header overwrites the placeholder exactly
+        header = header.ljust(128 - 10 - 1) + "\n"
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+POINT_WRITERS = {"csv": CsvPointWriter, "xyz.bin": XyzBinWriter, "pcd": PcdWriter, "npy": NpyWriter}
+
+def open_point_writer(stream, fmt):
+    """Create the streaming writer for fmt on an open stream (text for csv, binary otherwise)"""
+    if fmt not in POINT_WRITERS:
+        raise ValueError(f"Unknown point format {fmt!r}; expected one of {POINT_FORMATS}")
+    return POINT_WRITERS[fmt](stream)
+
+def open_point_stream(path, fmt):
+    """Open path ('-' for stdout) in the text or binary mode the format needs"""
+    if path == "-":
+        return sys.stdout if fmt == "csv" else sys.stdout.buffer
+    return open(path, "w" if fmt == "csv" else "wb")
+
+def write_points(path, scans, poses=None, fmt=None):
+    """Write a list of (N, 3) point arrays in the format given by fmt or the file extension
+
+    Only .xyz.bin keeps the scans and their poses apart; the other formats
+    hold all points as one cloud.
+    """
+    fmt = fmt or point_format_for_path(path)
+    stream = open_point_stream(path, fmt)
+    # stdout belongs to the process, so it is flushed but left open
+    with contextlib.nullcontext(stream) if path == "-" else stream as f:
+        writer = open_point_writer(f, fmt)
+        for index, points in enumerate(scans):
+            writer.write_scan(points, None if poses is None else poses[index])
+        writer.close()
+
+def read_xyz_bin(path):
+    """Read an .xyz.bin file into a list of (pose, (N, 3) float32 array) pairs
+
+    The point arrays are views of one memory map of the file.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, version, scan_count, _ = XYZ_BIN_HEADER.unpack_from(data, 0)
+    if magic != XYZ_BIN_MAGIC:
+        raise ValueError(f"{path} is not an .xyz.bin file")
+    if version != XYZ_BIN_VERSION:
+        raise ValueError(f"{path} has unsupported .xyz.bin version {version}")
+
+    scans = []
+    offset = XYZ_BIN_HEADER.size
+    while offset < len(data) and (scan_count == 0 or len(scans) < scan_count):
+        block = np.frombuffer(data, dtype=XYZ_BIN_BLOCK, count=1, offset=offset)[0]
+        offset += XYZ_BIN_BLOCK.itemsize
+        count = int(block["count"])
+        points = np.frombuffer(data, dtype="<f4", count=count * 3, offset=offset).reshape(count, 3)
+        offset += points.nbytes
+        scans.append((tuple(float(v) for v in block["pose"]), points))
+    return scans
+
+def read_pcd(path):
+    """Read a binary x y z float32 PCD file into an (N, 3) array"""
+    with open(path, "rb") as f:
+        fields = {}
+        while "DATA" not in fields:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{path} has no DATA line")
+            line = line.decode("ascii").strip()
+            if line and not line.startswith("#"):
+                key, _, value = line.partition(" ")
+                fields[key] = value
+        if fields["DATA"] != "binary" or fields.get("FIELDS") != "x y z" or fields.get("TYPE") != "F F F":
+            raise ValueError(f"{path}: only binary x y z float32 PCD files are supported")
+        count = int(fields["POINTS"])
+        return np.fromfile(f, dtype="<f4", count=count * 3).reshape(count, 3)
+
+def read_points(path, fmt=None):
+    """Read every point of a point file into one (N, 3) array"""
+    fmt = fmt or point_format_for_path(path)
+    if fmt == "xyz.bin":
+        scans = read_xyz_bin(path)
+        return np.concatenate([points for _, points in scans]) if scans else np.empty((0, 3), "<f4")
+    if fmt == "pcd":
+        return read_pcd(path)
+    if fmt == "npy":
+        return np.load(path, mmap_mode="r")
+    if fmt == "csv":
+        return np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    raise ValueError(f"Unknown point format {fmt!r}; expected one of {POINT_FORMATS}")
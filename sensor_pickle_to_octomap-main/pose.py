@@ -0,0 +1,129 @@
+import csv
+import numpy as np
+
+# A pose is the sensor position and orientation in the map frame: (tx, ty, tz, qw, qx, qy, qz)
+POSE_FIELDS = ("tx", "ty", "tz", "qw", "qx", "qy", "qz")
+
+def pose_rotations(poses):
+    """(S, 3, 3) rotation matrices of an (S, 7) pose array"""
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    q = poses[:, 3:7] / np.linalg.norm(poses[:, 3:7], axis=1, keepdims=True)
+    w, x, y, z = q.T
+    return np.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+        2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+        2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y),
+    ], axis=1).reshape(-1, 3, 3)
+
+def pose_rotation(pose):
+    """3x3 rotation matrix of a (tx, ty, tz, qw, qx, qy, qz) pose"""
+    return pose_rotations(pose)[0]
+
+def transform_points(points, pose):
+    """Move (N, 3) sensor-frame points into the map frame given the sensor pose"""
+    return transform_scans(np.asarray(points)[np.newaxis], [pose])[0]
+
+def transform_scans(points, poses):
+    """Move a stack of (S, N, 3) sensor-frame scans into the map frame, one pose per scan
+
+    All scans are rotated by a single batched matrix multiply in the
+    points' dtype, so float32 scans stay float32.
+    """
+    points = np.asarray(points)
+    if points.ndim != 3 or points.shape[2] != 3:
+        raise ValueError(f"Expected a (scans, points, 3) array, got shape {points.shape}")
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    if len(poses) != len(points):
+        raise ValueError(f"Got {len(poses)} poses for {len(points)} scans")
+    dtype = points.dtype if points.dtype.kind == "f" else np.float64
+    rotations = pose_rotations(poses).transpose(0, 2, 1).astype(dtype)
+    result = np.matmul(points.astype(dtype, copy=False), rotations)
+    result += poses[:, np.newaxis, :3].astype(dtype)
+    return result
+
+def slerp(q0, q1, t):
+    """Spherical linear interpolation between (N, 4) unit quaternions at fractions t"""
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)[:, np.newaxis]
+    dot = np.sum(q0 * q1, axis=1, keepdims=True)
+    # q and -q are the same rotation; take the short way round
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.minimum(np.abs(dot), 1.0)
+    angle = np.arccos(dot)
+    sin_angle = np.sin(angle)
+    # Nearly identical rotations fall back to linear interpolation
+    close = sin_angle < 1e-6
+    safe = np.where(close, 1.0, sin_angle)
+    w0 = np.where(close, 1 - t, np.sin((1 - t) * angle) / safe)
+    w1 = np.where(close, t, np.sin(t * angle) / safe)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+def interpolate_poses(times, pose_times, poses):
+    """Poses at the given times from a trajectory of timestamped poses
+
+    Positions are interpolated linearly and orientations by slerp between
+    the two neighbouring trajectory poses. Times outside the trajectory get
+    its first or last pose. Returns an (N, 7) array.
+    """
+    times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+    pose_times = np.asarray(pose_times, dtype=np.float64)
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    if len(poses) != len(pose_times) or not len(poses):
+        raise ValueError(f"Got {len(poses)} poses for {len(pose_times)} trajectory timestamps")
+    if np.any(np.diff(pose_times) < 0):
+        order = np.argsort(pose_times, kind="stable")
+        pose_times, poses = pose_times[order], poses[order]
+    if len(poses) == 1:
+        return np.repeat(poses, len(times), axis=0)
+
+    after = np.clip(np.searchsorted(pose_times, times, side="right"), 1, len(poses) - 1)
+    before = after - 1
+    span = pose_times[after] - pose_times[before]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(span > 0, (times - pose_times[before]) / span, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+
+    result = np.empty((len(times), 7))
+    result[:, :3] = poses[before, :3] + t[:, np.newaxis] * (poses[after, :3] - poses[before, :3])
+    result[:, 3:] = slerp(poses[before, 3:], poses[after, 3:], t)
+    return result
+
+def read_trajectory(path):
+    """Read a timestamp,tx,ty,tz,qw,qx,qy,qz CSV into (timestamps, (N, 7) poses)"""
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    times = np.array([float(row["timestamp"]) for row in rows])
+    poses = np.array([[float(row[key]) for key in POSE_FIELDS] for row in rows]).reshape(-1, 7)
+    return times, poses
+
+def read_pose_file(path, trajectory=None):
+    """Read per-file sensor poses and timestamps from a CSV
+
+    Rows are file_name plus either the pose columns tx,ty,tz,qw,qx,qy,qz or
+    a timestamp column; rows without a pose are interpolated from the
+    (timestamps, poses) trajectory at their timestamp. Returns two dicts
+    keyed by file name: poses and timestamps (only for rows that have one).
+    """
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    poses, timestamps, unposed = {}, {}, []
+    for row in rows:
+        if row.get("timestamp"):
+            timestamps[row["file_name"]] = float(row["timestamp"])
+        if all(row.get(key) for key in POSE_FIELDS):
+            poses[row["file_name"]] = tuple(float(row[key]) for key in POSE_FIELDS)
+        elif row["file_name"] in timestamps:
+            unposed.append(row["file_name"])
+        else:
+            raise ValueError(f"{path}: {row['file_name']} has neither a pose nor a timestamp")
+
+    if unposed:
+        if trajectory is None:
+            raise ValueError(f"{path}: scans given by timestamp need a trajectory to interpolate from")
+        interpolated = interpolate_poses([timestamps[name] for name in unposed], *trajectory)
+        for name, pose in zip(unposed, interpolated):
+            poses[name] = tuple(pose.tolist())
+    return poses, timestamps
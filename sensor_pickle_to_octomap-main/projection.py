@@ -0,0 +1,101 @@
+import numpy as np
+from instrumentation import span
+from point_io import IDENTITY_POSE
+from pose import pose_rotations
+from sensor_model import default_sensor_model
+
+# Points converted per block in project_scans
+_CHUNK_POINTS = 32768
+
+def project_scans(scans, sensor_model=None, dtype=np.float32, poses=None):
+    """Convert a stack of range scans (S, altitude, encoder) to (S, N, 3) points
+
+    Each point is its range times the cached unit beam direction of the
+    sensor model, so projecting a batch is a single broadcast multiply.
+    With one (tx, ty, tz, qw, qx, qy, qz) pose per scan the points come out
+    in the map frame (see _project_posed).
+    """
+    scans = np.asarray(scans, dtype=np.float64)
+    if scans.ndim != 3:
+        raise ValueError(f"Expected a (scans, altitude, encoder) array, got shape {scans.shape}")
+
+    scan_count, altitude_angle_count, encoder_angle_count = scans.shape
+    if sensor_model is None:
+        sensor_model = default_sensor_model(altitude_angle_count)
+    sensor_model.check_scan_shape(altitude_angle_count, encoder_angle_count)
+    directions = sensor_model.direction_table(encoder_angle_count)
+
+    point_count = altitude_angle_count * encoder_angle_count
+    if poses is not None:
+        return _project_posed(scans.reshape(scan_count, point_count), directions, poses, dtype)
+    ranges = scans.reshape(scan_count, point_count, 1)
+    points = np.empty((scan_count, point_count, 3), dtype=dtype)
+    # Work through the batch a few scans at a time so the float64
+    # temporaries stay in cache
+    step = max(1, _CHUNK_POINTS // point_count)
+    with span("project_scans") as timing:
+        for start in range(0, scan_count, step):
+            np.multiply(ranges[start:start + step], directions, out=points[start:start + step],
+                        casting="same_kind")
+        timing.add("points", scan_count * point_count)
+    return points
+
+def _project_posed(ranges, directions, poses, dtype):
+    """Project (S, N) ranges straight into the map frame
+
+    Each pose's rotation is applied to the (3, N) direction table, which is
+    cheap next to the points, so every point is then one multiply and add
+    per axis in a single pass instead of a projection followed by a
+    transform of all points. Working on whole axis planes keeps NumPy's
+    inner loops N long rather than 3.
+    """
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    scan_count, point_count = ranges.shape
+    if len(poses) != scan_count:
+        raise ValueError(f"Got {len(poses)} poses for {scan_count} scans")
+    planes = np.ascontiguousarray(directions.T)
+    rotations = pose_rotations(poses)
+    rotated = np.empty((3, point_count))
+    component = np.empty(point_count)
+    points = np.empty((scan_count, point_count, 3), dtype=dtype)
+    with span("project_scans", posed=True) as timing:
+        for index in range(scan_count):
+            np.matmul(rotations[index], planes, out=rotated)
+            for axis in range(3):
+                np.multiply(ranges[index], rotated[axis], out=component)
+                np.add(component, poses[index, axis], out=component)
+                points[index, :, axis] = component
+        timing.add("points", scan_count * point_count)
+    return points
+
+def project_scan(scan, sensor_model=None, dtype=np.float32, pose=None):
+    """Convert one (altitude, encoder) range scan to an (N, 3) point array, in the map frame with a pose"""
+    scan = np.asarray(scan, dtype=np.float64)
+    if scan.ndim != 2:
+        raise ValueError(f"Expected an (altitude, encoder) array, got shape {scan.shape}")
+    return project_scans(scan[np.newaxis], sensor_model, dtype, None if pose is None else [pose])[0]
+
+def reproject_scans(db, scan_ids, sensor_model=None, dtype=np.float32, apply_poses=False):
+    """Re-project stored raw scans, grouping scans that share geometry into one multiply
+
+    Uses each scan's stored sensor model unless sensor_model overrides it.
+    With apply_poses the scans are projected straight into the map frame by
+    their stored poses. Returns a dict of scan_id ->
+    (N, 3) point array.
+    """
+    groups = {}
+    for scan_id in scan_ids:
+        scan = db.get_raw_scan_data(scan_id)
+        if scan is None:
+            continue
+        model = sensor_model or db.get_sensor_model(scan_id)
+        groups.setdefault((model, scan.shape), []).append((scan_id, scan))
+
+    poses = db.get_poses(scan_ids) if apply_poses else {}
+    results = {}
+    for (model, _), members in groups.items():
+        member_poses = [poses.get(scan_id, IDENTITY_POSE) for scan_id, _ in members] if poses else None
+        points = project_scans(np.stack([scan for _, scan in members]), model, dtype, member_poses)
+        for (scan_id, _), scan_points in zip(members, points):
+            results[scan_id] = scan_points
+    return results
@@ -0,0 +1,133 @@
+import lzma
+import zlib
+import numpy as np
+
+# Codecs for raw_scans.data, named <quantization>[-delta][-<compressor>]:
+#   raw        the scan's own dtype, unchanged
+#   u16, u32   fixed point: round(range / scale); non-finite readings are
+#              stored as the largest code (decoded as NaN) and the sensor's
+#              NO_RETURN_RANGE readings as the one below it, so both come
+#              back exactly. A 0 reading (the other no-return) is code 0
+#   delta      each value replaced by its difference to the previous one in
+#              the same encoder row (modulo 2^16 or 2^32), so smooth
+#              surfaces turn into runs of small numbers
+#   zlib, lzma byte planes split apart (as in shuffle-zlib point blobs), then
+#              compressed
+RANGE_CODECS = (
+    "raw", "raw-zlib", "raw-lzma",
+    "u16", "u16-delta", "u16-delta-zlib", "u16-delta-lzma",
+    "u32", "u32-delta", "u32-delta-zlib", "u32-delta-lzma",
+)
+# None: the scale is chosen per scan by range_scale_for
+DEFAULT_RANGE_SCALE = None
+# Scale of integer ranges (the sensor's millimetres): one code per unit, lossless
+INTEGER_RANGE_SCALE = 1.0
+# Scale of fractional ranges (metres, as in the synthetic data): millimetre steps
+FRACTIONAL_RANGE_SCALE = 0.001
+# Reading the sensor reports for a beam without a return (as does 0)
+NO_RETURN_RANGE = 2.0 ** 28
+
+_QUANTIZED_DTYPES = {"u16": np.dtype("<u2"), "u32": np.dtype("<u4")}
+
+def _parse(codec):
+    if codec not in RANGE_CODECS:
+        raise ValueError(f"Unknown range codec {codec!r}; expected one of {RANGE_CODECS}")
+    parts = codec.split("-")
+    compressor = parts[-1] if parts[-1] in ("zlib", "lzma") else None
+    return parts[0], "delta" in parts, compressor
+
+def _shuffle(data, itemsize):
+    if itemsize == 1:
+        return data.tobytes()
+    return data.view(np.uint8).reshape(-1, itemsize).T.tobytes()
+
+def _unshuffle(payload, dtype):
+    planes = np.frombuffer(payload, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(-1)
+
+def _compress(data, compressor):
+    if compressor == "zlib":
+        return zlib.compress(_shuffle(data, data.dtype.itemsize), 6)
+    if compressor == "lzma":
+        return lzma.compress(_shuffle(data, data.dtype.itemsize), preset=1)
+    return data.tobytes()
+
+def _decompress(payload, dtype, compressor):
+    if compressor == "zlib":
+        return _unshuffle(zlib.decompress(payload), dtype)
+    if compressor == "lzma":
+        return _unshuffle(lzma.decompress(payload), dtype)
+    return np.frombuffer(payload, dtype=dtype)
+
+def range_scale_for(scan):
+    """INTEGER_RANGE_SCALE if every finite reading of scan is a whole number, else FRACTIONAL_RANGE_SCALE"""
+    scan = np.asarray(scan)
+    finite = scan[np.isfinite(scan)]
+    return INTEGER_RANGE_SCALE if np.array_equal(finite, np.rint(finite)) else FRACTIONAL_RANGE_SCALE
+
+def range_unit_metres(scan):
+    """Metres per range unit of scan: 0.001 for whole-number ranges (the sensor's millimetres), else 1"""
+    return 0.001 if range_scale_for(scan) == INTEGER_RANGE_SCALE else 1.0
+
+def _quantize(scan, dtype, scale):
+    """Fixed-point codes of scan, or None if a reading does not fit"""
+    not_finite = np.iinfo(dtype).max
+    no_return = not_finite - 1
+    with np.errstate(invalid="ignore"):
+        codes = np.rint(scan / scale)
+    finite = np.isfinite(codes)
+    sentinel = scan == NO_RETURN_RANGE
+    ranges = codes[finite & ~sentinel]
+    if np.any(ranges < 0) or np.any(ranges >= no_return):
+        return None
+    return np.where(sentinel, no_return, np.where(finite, codes, not_finite)).astype(dtype)
+
+def encode_ranges(scan, codec="raw", scale=DEFAULT_RANGE_SCALE):
+    """Encode an (altitude, encoder) range scan
+
+    Returns (codec, scale, payload). scale None picks range_scale_for(scan).
+    A quantized codec that cannot hold the scan (negative or too large
+    readings, or an integer scan) falls back to u32 and then to raw with the
+    same compression, so the returned codec is the one that must be stored
+    with the payload.
+    """
+    scan = np.asarray(scan)
+    quantization, delta, compressor = _parse(codec)
+    codes = None
+    if quantization != "raw" and scan.dtype.kind == "f":
+        scale = scale or range_scale_for(scan)
+        for name in (("u16", "u32") if quantization == "u16" else ("u32",)):
+            codes = _quantize(scan, _QUANTIZED_DTYPES[name], scale)
+            if codes is not None:
+                quantization = name
+                break
+    if codes is None:
+        quantization, delta = "raw", False
+        codes = np.ascontiguousarray(scan, dtype=scan.dtype.newbyteorder("<"))
+        scale = None
+
+    if delta:
+        codes = codes.reshape(scan.shape)
+        # Unsigned subtraction wraps around, so decoding by cumulative sum is exact
+        codes = np.concatenate([codes[:, :1], np.diff(codes, axis=1)], axis=1)
+    used = "-".join([quantization] + (["delta"] if delta else []) + ([compressor] if compressor else []))
+    return used, scale, _compress(codes.reshape(-1), compressor)
+
+def decode_ranges(payload, shape, codec="raw", scale=None, dtype="<f8"):
+    """Decode an encode_ranges payload into an (altitude, encoder) array
+
+    dtype is the scan's element type as stored. Non-finite readings of
+    quantized codecs come back as NaN, and NO_RETURN_RANGE readings as they were.
+    """
+    quantization, delta, compressor = _parse(codec)
+    code_dtype = _QUANTIZED_DTYPES.get(quantization, np.dtype(dtype))
+    codes = _decompress(payload, code_dtype, compressor).reshape(shape)
+    if delta:
+        codes = np.cumsum(codes, axis=1, dtype=code_dtype)
+    if quantization == "raw":
+        return codes
+    ranges = (codes * scale).astype(dtype, copy=False)
+    not_finite = np.iinfo(code_dtype).max
+    ranges[codes == not_finite] = np.nan
+    ranges[codes == not_finite - 1] = NO_RETURN_RANGE
+    return ranges
@@ -0,0 +1,326 @@
+import argparse
+import collections
+import math
+import numpy as np
+from db_utils import LiDARDatabase
+from filters import range_mask
+from pose import pose_rotation
+from range_codec import NO_RETURN_RANGE, range_unit_metres
+from sensor_model import default_sensor_model
+from voxel_map import FREE, OCCUPIED, UNKNOWN
+
+# Per-beam labels of RangeImage.segment_ground
+NO_RETURN = -1
+GROUND = 0
+OBSTACLE = 1
+
+# Default lengths in metres; RangeImage converts them to each scan's range units
+DEFAULT_CELL_SIZE = 0.5
+DEFAULT_GRID_CELLS = 128
+DEFAULT_MAX_SLOPE_DEG = 15.0
+DEFAULT_HEIGHT_TOLERANCE = 0.5
+
+# Settings of compute_products; the cached products record the values they were computed with
+PRODUCT_SETTINGS = {
+    "min_range": None,
+    "max_range": None,
+    "max_slope_deg": DEFAULT_MAX_SLOPE_DEG,
+    "sensor_height": None,
+    "height_tolerance": None,
+    "min_height": None,
+    "max_height": None,
+    "cell_size": None,
+    "grid_cells": DEFAULT_GRID_CELLS,
+}
+
+# Cached per scan in the scan_products table
+ScanProducts = collections.namedtuple("ScanProducts", "labels obstacle_distance height occupancy cell_size params")
+
+def bearing_columns(sensor_model, encoder_angle_count, bearings):
+    """Encoder column of each bearing (radians, sensor frame) by direct indexing; -1 where the scan has none"""
+    counts = sensor_model.counts_per_revolution or encoder_angle_count
+    step = sensor_model.encoder_direction * 2 * math.pi / counts
+    offset = math.radians(sensor_model.encoder_offset_deg)
+    columns = np.rint((np.asarray(bearings, dtype=np.float64) - offset) / step).astype(np.int64) % counts
+    return np.where(columns < encoder_angle_count, columns, -1)
+
+class RangeImage:
+    """One scan kept in its (altitude ring, encoder step) layout
+
+    Neighbouring beams are neighbouring array cells, so normals, ground
+    segmentation and per-bearing obstacle distances are a few whole-array
+    operations instead of searches through an unordered point cloud.
+    Readings outside [min_range, max_range), zero readings and the sensor's
+    NO_RETURN_RANGE readings count as no-returns. With a
+    pose the points are rotated (not moved) into the map frame's axes, so
+    z is up even when the sensor is tilted; the origin stays at the sensor.
+    Lengths are in the scan's range units; the defaults left as None are
+    DEFAULT_* metres in those units (see range_codec.range_unit_metres), so
+    they fit both metre scans and the sensor's millimetre scans.
+    """
+
+    def __init__(self, scan, sensor_model=None, min_range=None, max_range=None, pose=None):
+        scan = np.asarray(scan, dtype=np.float64)
+        if scan.ndim != 2:
+            raise ValueError(f"Expected an (altitude, encoder) array, got shape {scan.shape}")
+        self.sensor_model = sensor_model or default_sensor_model(scan.shape[0])
+        self.sensor_model.check_scan_shape(*scan.shape)
+        self.ranges = scan
+        self.unit_metres = range_unit_metres(scan)
+        self.valid = range_mask(scan, min_range, max_range).reshape(scan.shape) & (scan > 0) & (scan != NO_RETURN_RANGE)
+
+        directions = self.sensor_model.direction_table(scan.shape[1]).reshape(scan.shape + (3,))
+        if pose is not None:
+            directions = directions @ pose_rotation(pose).T
+        self.directions = directions
+        with np.errstate(invalid="ignore"):
+            self.points = np.where(self.valid[..., np.newaxis], directions * scan[..., np.newaxis], np.nan)
+        self._labels = None
+
+    @property
+    def shape(self):
+        return self.ranges.shape
+
+    @property
+    def full_revolution(self):
+        """True if the encoder steps close a full circle (so columns wrap around)"""
+        counts = self.sensor_model.counts_per_revolution
+        return counts is None or counts == self.shape[1]
+
+    def ring_order(self):
+        """Ring indices from the lowest-looking to the highest-looking beam"""
+        return np.argsort(self.directions[..., 2].mean(axis=1), kind="stable")
+
+    def column_at(self, bearings):
+        """Encoder column of each bearing (radians, sensor frame); -1 where the scan has none"""
+        return bearing_columns(self.sensor_model, self.shape[1], bearings)
+
+    def normals(self, max_depth_ratio=0.1):
+        """(altitude, encoder, 3) unit normals from the neighbouring beams, facing the sensor
+
+        The normal is the cross product of the central differences along the
+        ring and across rings. It is NaN where a neighbour is missing or lies
+        across a depth edge (its range differs by more than max_depth_ratio
+        times this beam's range).
+        """
+        order = self.ring_order()
+        points = self.points[order]
+        ranges = np.where(self.valid, self.ranges, np.nan)[order]
+
+        def shifted(array, offset, axis):
+            result = np.roll(array, offset, axis=axis)
+            if axis == 1 and self.full_revolution:
+                return result
+            edge = [slice(None)] * array.ndim
+            edge[axis] = slice(0, offset) if offset > 0 else slice(offset, None)
+            result[tuple(edge)] = np.nan
+            return result
+
+        neighbours = [(shifted(points, offset, axis), shifted(ranges, offset, axis))
+                      for axis in (1, 0) for offset in (1, -1)]
+        with np.errstate(invalid="ignore"):
+            usable = np.ones(self.shape, dtype=bool)
+            for _, neighbour_ranges in neighbours:
+                usable &= np.abs(neighbour_ranges - ranges) <= max_depth_ratio * ranges
+            along = neighbours[1][0] - neighbours[0][0]
+            across = neighbours[3][0] - neighbours[2][0]
+            normals = np.cross(along, across)
+            length = np.linalg.norm(normals, axis=2, keepdims=True)
+            normals /= length
+            facing = np.sum(normals * points, axis=2, keepdims=True) > 0
+            normals = np.where(facing, -normals, normals)
+        usable &= length[..., 0] > 0
+        normals[~usable] = np.nan
+
+        result = np.empty_like(normals)
+        result[order] = normals
+        return result
+
+    def length(self, metres):
+        """metres in the scan's range units"""
+        return metres / self.unit_metres
+
+    def segment_ground(self, max_slope_deg=DEFAULT_MAX_SLOPE_DEG, sensor_height=None, height_tolerance=None):
+        """Label each beam GROUND, OBSTACLE or NO_RETURN, column by column
+
+        Each encoder column is walked from the lowest ring up, all columns
+        at once. A column's ground starts at its first return within
+        height_tolerance of the ground level (-sensor_height, or the median
+        height of the lowest ring's returns when not given); a later return
+        is ground if it lies farther out than the column's last ground
+        return and the slope between them is at most max_slope_deg; after an
+        obstacle return it must also be within height_tolerance of that
+        ground return, so flat tops of objects stay obstacles. Beams
+        whose normal (where one is defined) is tilted more than
+        max_slope_deg from vertical are never ground, which keeps the foot
+        of distant walls, where rings are far apart, from passing the slope
+        test. Everything else with a return is an obstacle.
+        """
+        if height_tolerance is None:
+            height_tolerance = self.length(DEFAULT_HEIGHT_TOLERANCE)
+        labels = np.where(self.valid, OBSTACLE, NO_RETURN).astype(np.int8)
+        order = self.ring_order()
+        radius = np.hypot(self.points[..., 0], self.points[..., 1])
+        height = self.points[..., 2]
+        if sensor_height is not None:
+            ground_level = -sensor_height
+        else:
+            lowest = height[order[0]][self.valid[order[0]]]
+            ground_level = float(np.median(lowest)) if len(lowest) else -np.inf
+        max_slope = math.tan(math.radians(max_slope_deg))
+        with np.errstate(invalid="ignore"):
+            steep = np.abs(self.normals()[..., 2]) < math.cos(math.radians(max_slope_deg))
+
+        last_radius = np.full(self.shape[1], np.nan)
+        last_height = np.full(self.shape[1], np.nan)
+        blocked = np.zeros(self.shape[1], dtype=bool)
+        with np.errstate(invalid="ignore"):
+            for ring in order:
+                started = ~np.isnan(last_radius)
+                run = radius[ring] - last_radius
+                rise = np.abs(height[ring] - last_height)
+                continues = started & (run > 0) & (rise <= max_slope * run) & (~blocked | (rise <= height_tolerance))
+                starts = ~started & (np.abs(height[ring] - ground_level) <= height_tolerance)
+                ground = self.valid[ring] & ~steep[ring] & (continues | starts)
+                labels[ring, ground] = GROUND
+                last_radius[ground] = radius[ring, ground]
+                last_height[ground] = height[ring, ground]
+                blocked = np.where(self.valid[ring], started & ~ground, blocked)
+        self._labels = labels
+        return labels
+
+    def labels(self):
+        """segment_ground with the default settings, unless it has been run already"""
+        return self._labels if self._labels is not None else self.segment_ground()
+
+    def obstacle_distances(self, min_height=None, max_height=None):
+        """(encoder,) horizontal distance to the nearest obstacle return in each column; inf where none
+
+        Obstacle returns below min_height or above max_height (relative to
+        the sensor) are ignored, e.g. overhanging branches.
+        """
+        obstacle = self.labels() == OBSTACLE
+        height = self.points[..., 2]
+        with np.errstate(invalid="ignore"):
+            if min_height is not None:
+                obstacle &= height >= min_height
+            if max_height is not None:
+                obstacle &= height <= max_height
+        radius = np.hypot(self.points[..., 0], self.points[..., 1])
+        return np.where(obstacle, radius, np.inf).min(axis=0)
+
+    def grids(self, cell_size=None, grid_cells=DEFAULT_GRID_CELLS):
+        """Sensor-centred (grid_cells, grid_cells) 2.5D height and occupancy grids
+
+        Cell [i, j] covers x in [(i - grid_cells / 2) * cell_size, + cell_size)
+        and likewise j for y. height is the highest return in the cell (NaN
+        if none); occupancy is OCCUPIED if any obstacle return falls in it,
+        FREE if only ground returns do and UNKNOWN otherwise.
+        """
+        if cell_size is None:
+            cell_size = self.length(DEFAULT_CELL_SIZE)
+        labels = self.labels()
+        points = self.points[self.valid]
+        cells = np.floor(points[:, :2] / cell_size).astype(np.int64) + grid_cells // 2
+        inside = np.all((cells >= 0) & (cells < grid_cells), axis=1)
+        flat = cells[inside, 0] * grid_cells + cells[inside, 1]
+        kinds = labels[self.valid][inside]
+
+        height = np.full(grid_cells * grid_cells, -np.inf)
+        np.maximum.at(height, flat, points[inside, 2])
+        height[np.isinf(height)] = np.nan
+        obstacles = np.bincount(flat[kinds == OBSTACLE], minlength=grid_cells * grid_cells)
+        ground = np.bincount(flat[kinds == GROUND], minlength=grid_cells * grid_cells)
+        occupancy = np.where(obstacles > 0, OCCUPIED, np.where(ground > 0, FREE, UNKNOWN)).astype(np.int8)
+        shape = (grid_cells, grid_cells)
+        return height.reshape(shape).astype(np.float32), occupancy.reshape(shape)
+
+def compute_products(scan, sensor_model=None, pose=None, **settings):
+    """ScanProducts of one scan; settings override PRODUCT_SETTINGS"""
+    unknown = settings.keys() - PRODUCT_SETTINGS.keys()
+    if unknown:
+        raise TypeError(f"Unknown range image settings: {', '.join(sorted(unknown))}")
+    params = dict(PRODUCT_SETTINGS, **settings)
+    image = RangeImage(scan, sensor_model, params["min_range"], params["max_range"], pose)
+    labels = image.segment_ground(params["max_slope_deg"], params["sensor_height"], params["height_tolerance"])
+    cell_size = image.length(DEFAULT_CELL_SIZE) if params["cell_size"] is None else params["cell_size"]
+    height, occupancy = image.grids(cell_size, params["grid_cells"])
+    distances = image.obstacle_distances(params["min_height"], params["max_height"]).astype(np.float32)
+    return ScanProducts(labels, distances, height, occupancy, cell_size, params)
+
+def scan_products(db, scan_id, recompute=False, **settings):
+    """ScanProducts of a stored scan, read from the scan_products table if cached with the same settings
+
+    Otherwise they are computed from the raw scan (levelled by its stored
+    pose, if any) and cached. Returns None for an unknown scan.
+    """
+    if not recompute:
+        cached = db.get_scan_products(scan_id)
+        if cached is not None and cached["params"] == dict(PRODUCT_SETTINGS, **settings):
+            return ScanProducts(cached["labels"], cached["obstacle_distance"], cached["height"],
+                                cached["occupancy"], cached["cell_size"], cached["params"])
+    scan = db.get_raw_scan_data(scan_id)
+    if scan is None:
+        return None
+    products = compute_products(scan, db.get_sensor_model(scan_id), db.get_pose(scan_id), **settings)
+    db.store_scan_products(scan_id, products.params, products.cell_size, products.labels,
+                           products.obstacle_distance, products.height, products.occupancy)
+    return products
+
+def obstacle_distance_at(products, sensor_model, bearings):
+    """Obstacle distance at each bearing (radians, sensor frame) from ScanProducts; NaN outside the scan"""
+    distances = products.obstacle_distance
+    columns = bearing_columns(sensor_model, len(distances), bearings)
+    return np.where(columns >= 0, distances[columns], np.nan)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute and cache ground labels, 2.5D grids and obstacle "
+                                                 "distances of stored scans")
+    parser.add_argument("--db", default="lidar_data.db", help="Database with the raw scans")
+    parser.add_argument("--scans", type=int, nargs="+", help="Scan ids (default: every stored scan)")
+    parser.add_argument("--recompute", action="store_true", help="Recompute even if cached with these settings")
+    parser.add_argument("--min-range", type=float, help="Readings closer than this are no-returns")
+    parser.add_argument("--max-range", type=float,
+                        help="Readings at or beyond this are no-returns (the sensor maximum distance)")
+    parser.add_argument("--max-slope", type=float, default=DEFAULT_MAX_SLOPE_DEG,
+                        help="Steepest slope in degrees still counted as ground")
+    parser.add_argument("--sensor-height", type=float,
+                        help="Sensor height above the ground (default: estimated from the lowest ring)")
+    parser.add_argument("--height-tolerance", type=float,
+                        help=f"How far a column's first ground return may be from the ground level, in range "
+                             f"units (default: {DEFAULT_HEIGHT_TOLERANCE:g} m in the scan's units)")
+    parser.add_argument("--min-height", type=float,
+                        help="Ignore obstacle returns lower than this relative to the sensor")
+    parser.add_argument("--max-height", type=float,
+                        help="Ignore obstacle returns higher than this relative to the sensor")
+    parser.add_argument("--cell-size", type=float,
+                        help=f"2.5D grid cell size in range units (default: {DEFAULT_CELL_SIZE:g} m in the scan's "
+                             f"units, {DEFAULT_CELL_SIZE * 1000:g} for the sensor's millimetre scans)")
+    parser.add_argument("--grid-cells", type=int, default=DEFAULT_GRID_CELLS, help="2.5D grid cells per side")
+    parser.add_argument("--bearing", type=float, nargs="+",
+                        help="Print the obstacle distance at these bearings (degrees) for each scan")
+    args = parser.parse_args()
+
+    settings = {"min_range": args.min_range, "max_range": args.max_range, "max_slope_deg": args.max_slope,
+                "sensor_height": args.sensor_height, "height_tolerance": args.height_tolerance,
+                "min_height": args.min_height, "max_height": args.max_height,
+                "cell_size": args.cell_size, "grid_cells": args.grid_cells}
+    with LiDARDatabase(args.db) as db:
+        for scan_id in args.scans or db.get_scan_ids():
+            products = scan_products(db, scan_id, args.recompute, **settings)
+            if products is None:
+                print(f"Scan {scan_id}: not found")
+                continue
+            labels = products.labels
+            line = (f"Scan {scan_id}: {np.count_nonzero(labels == GROUND)} ground, "
+                    f"{np.count_nonzero(labels == OBSTACLE)} obstacle, "
+                    f"{np.count_nonzero(labels == NO_RETURN)} no-return beams; "
+                    f"{np.count_nonzero(products.occupancy == OCCUPIED)} occupied cells")
+            if args.bearing:
+                distances = obstacle_distance_at(products, db.get_sensor_model(scan_id), np.radians(args.bearing))
+                line += "; " + ", ".join(f"{bearing:g} deg: {distance:.2f}"
+                                         for bearing, distance in zip(args.bearing, distances))
+            print(line)
+
+if __name__ == "__main__":
+    main()
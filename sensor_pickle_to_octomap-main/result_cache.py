@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from db_utils import LiDARDatabase
+
+DEFAULT_CACHE_BYTES = 1 << 30
+# Part of every key; bump it when a cached stage changes what it produces
+CACHE_VERSION = 1
+
+def cache_key(*parts):
+    """Hex SHA-1 of the JSON form of parts (bytes are hashed as they are)"""
+    digest = hashlib.sha1(str(CACHE_VERSION).encode("ascii"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def file_digest(path, chunk_size=1 << 20):
+    """Hex SHA-1 of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ResultCache:
+    """Content-addressed on-disk store of stage outputs, bounded in size
+
+    Entries are files named after their key (see cache_key) in a two-level
+    directory tree, written atomically, so worker processes can read and add
+    entries at the same time. Reading an entry marks it as used; evict()
+    removes the least recently used files until the cache fits in max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def _hit(self, path):
+        if not os.path.exists(path):
+            self.stats["misses"] += 1
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            self.stats["misses"] += 1
+            return False
+        self.stats["hits"] += 1
+        return True
+
+    def _store(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.partial"
+        with open(partial, "wb") as f:
+            write(f)
+        os.replace(partial, path)
+        self.stats["stores"] += 1
+
+    def load_array(self, key):
+        """Cached array of key, or None"""
+        path = self.path(key, ".npy")
+        if not self._hit(path):
+            return None
+        try:
+            return np.load(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store_array(self, key, array):
+        self._store(self.path(key, ".npy"), lambda f: np.save(f, np.asarray(array)))
+
+    def load_json(self, key):
+        """Cached JSON value of key, or None"""
+        path = self.path(key, ".json")
+        if not self._hit(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store_json(self, key, value):
+        self._store(self.path(key, ".json"), lambda f: f.write(json.dumps(value).encode("utf-8")))
+
+    def fetch_file(self, key, suffix, destination):
+        """Copy the cached file of key to destination; False if it is not cached"""
+        path = self.path(key, suffix)
+        if not self._hit(path):
+            return False
+        try:
+            shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store_file(self, key, suffix, source):
+        with open(source, "rb") as src:
+            self._store(self.path(key, suffix), lambda f: shutil.copyfileobj(src, f))
+
+    def entries(self):
+        """(path, size, last used) of every cached file"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".partial"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used files until the cache holds at most max_bytes; returns files removed"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self.stats["evictions"] += removed
+        return removed
+
+def add_cache_arguments(parser):
+    """Add the result cache options to an argparse parser"""
+    group = parser.add_argument_group("result caching")
+    group.add_argument("--cache-dir", help="Reuse results of unchanged inputs and settings from this directory")
+    group.add_argument("--cache-mb", type=float, default=DEFAULT_CACHE_BYTES / (1 << 20),
+                       help="Size the cache directory is trimmed to, least recently used first")
+
+def result_cache_from_args(args):
+    """ResultCache for the options added by add_cache_arguments, or None without --cache-dir"""
+    if not args.cache_dir:
+        return None
+    return ResultCache(args.cache_dir, int(args.cache_mb * (1 << 20)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and trim the result cache, and remove duplicate scans")
+    parser.add_argument("--cache-dir", help="Cache directory to report on and trim")
+    parser.add_argument("--cache-mb", type=float, help="Trim the cache to this size")
+    parser.add_argument("--clear", action="store_true", help="Remove every cached result")
+    parser.add_argument("--db", help="Hash the scans of this database and remove duplicate scans from it")
+    args = parser.parse_args()
+    if not args.cache_dir and not args.db:
+        parser.error("give --cache-dir and/or --db")
+
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir)
+        if args.clear or args.cache_mb is not None:
+            removed = cache.evict(0 if args.clear else int(args.cache_mb * (1 << 20)))
+            print(f"Removed {removed} cached files")
+        entries = cache.entries()
+        print(f"{args.cache_dir}: {len(entries)} files, {sum(size for _, size, _ in entries) / (1 << 20):.1f} MiB")
+
+    if args.db:
+        with LiDARDatabase(args.db) as db:
+            hashed = db.hash_raw_scans()
+            removed = db.remove_duplicate_scans()
+        print(f"{args.db}: hashed {hashed} scans, removed {removed} duplicates")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import collections
+import json
+import os
+import pickle
+import struct
+import numpy as np
+from pose import read_pose_file, read_trajectory
+from sensor_model import SensorModel
+
+# .scans layout (little endian):
+#   header: magic "LSCN", uint32 version, uint64 scan count,
+#           uint64 index offset, uint64 metadata offset, uint64 metadata size
+#   scan data: each (altitude, encoder) range array stored contiguously,
+#              starting on a 64 byte boundary
+#   index: one SCAN_INDEX_RECORD per scan
+#   metadata: UTF-8 JSON {"names": [...], "sensor_models": [...]}
+# The header is written last, so a file whose writer died has scan count 0.
+SCAN_CONTAINER_MAGIC = b"LSCN"
+SCAN_CONTAINER_VERSION = 1
+SCAN_CONTAINER_HEADER = struct.Struct("<4sIQQQQ")
+SCAN_INDEX_RECORD = np.dtype([
+    ("offset", "<u8"),
+    ("altitude_angle_count", "<u4"),
+    ("encoder_angle_count", "<u4"),
+    ("dtype", "S4"),
+    ("sensor_model", "<i4"),  # index into metadata sensor_models, -1 for the default geometry
+    ("timestamp", "<f8"),     # sensor time in seconds, NaN if unknown
+    ("pose", "<f8", 7),       # tx, ty, tz, qw, qx, qy, qz; NaN if unknown
+])
+SCAN_DTYPES = ("<f8", "<f4", "<u2", "<u4")
+_ALIGNMENT = 64
+
+ScanRecord = collections.namedtuple("ScanRecord", "name scan timestamp pose sensor_model")
+
+def is_scan_container(path):
+    """True if path starts with the .scans magic"""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SCAN_CONTAINER_MAGIC)) == SCAN_CONTAINER_MAGIC
+    except OSError:
+        return False
+
+class ScanContainerWriter:
+    """Appends range scans to a new .scans file; the index is written on close"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(SCAN_CONTAINER_HEADER.pack(SCAN_CONTAINER_MAGIC, SCAN_CONTAINER_VERSION, 0, 0, 0, 0))
+        self._records = []
+        self._names = []
+        self._models = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, scan, name=None, timestamp=None, pose=None, sensor_model=None):
+        """Append one (altitude, encoder) range scan with its optional metadata"""
+        scan = np.asarray(scan)
+        if scan.ndim != 2:
+            raise ValueError(f"Expected an (altitude, encoder) array, got shape {scan.shape}")
+        dtype = scan.dtype.newbyteorder("<").str if scan.dtype.byteorder == ">" else scan.dtype.str
+        if dtype not in SCAN_DTYPES:
+            scan, dtype = scan.astype("<f8"), "<f8"
+        scan = np.ascontiguousarray(scan, dtype=dtype)
+
+        padding = -self._file.tell() % _ALIGNMENT
+        self._file.write(b"\0" * padding)
+        record = np.zeros((), dtype=SCAN_INDEX_RECORD)
+        record["offset"] = self._file.tell()
+        record["altitude_angle_count"], record["encoder_angle_count"] = scan.shape
+        record["dtype"] = dtype.encode("ascii")
+        record["sensor_model"] = self._model_index(sensor_model)
+        record["timestamp"] = np.nan if timestamp is None else timestamp
+        record["pose"] = np.nan if pose is None else pose
+        self._file.write(memoryview(scan).cast("B"))
+        self._records.append(record)
+        self._names.append(name if name is not None else f"scan_{len(self._names)}")
+
+    def _model_index(self, sensor_model):
+        if sensor_model is None:
+            return -1
+        definition = sensor_model.to_json()
+        if definition not in self._models:
+            self._models.append(definition)
+        return self._models.index(definition)
+
+    def close(self):
+        if self._file.closed:
+            return
+        padding = -self._file.tell() % 8
+        self._file.write(b"\0" * padding)
+        index_offset = self._file.tell()
+        self._file.write(np.array(self._records, dtype=SCAN_INDEX_RECORD).tobytes())
+        metadata = json.dumps({"names": self._names,
+                               "sensor_models": [json.loads(model) for model in self._models]}).encode("utf-8")
+        metadata_offset = self._file.tell()
+        self._file.write(metadata)
+        self._file.seek(0)
+        self._file.write(SCAN_CONTAINER_HEADER.pack(SCAN_CONTAINER_MAGIC, SCAN_CONTAINER_VERSION, len(self._records),
+                                                    index_offset, metadata_offset, len(metadata)))
+        self._file.close()
+
+class ScanContainer:
+    """Read-only, memory-mapped access to the scans of a .scans file
+
+    container[i] is a zero-copy view of scan i; only the pages that are
+    touched are read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        if len(self._data) < SCAN_CONTAINER_HEADER.size:
+            raise ValueError(f"{path} is too short to be a .scans file")
+        magic, version, count, index_offset, metadata_offset, metadata_size = \
+            SCAN_CONTAINER_HEADER.unpack_from(self._data, 0)
+        if magic != SCAN_CONTAINER_MAGIC:
+            raise ValueError(f"{path} is not a .scans file")
+        if version != SCAN_CONTAINER_VERSION:
+            raise ValueError(f"{path} has unsupported .scans version {version}")
+        self.index = np.frombuffer(self._data, dtype=SCAN_INDEX_RECORD, count=count, offset=index_offset)
+        metadata = json.loads(bytes(self._data[metadata_offset:metadata_offset + metadata_size]) or b"{}")
+        self.names = metadata.get("names", [])
+        self.sensor_models = [SensorModel.from_dict(model) for model in metadata.get("sensor_models", [])]
+        dtypes, inverse = np.unique(self.index["dtype"], return_inverse=True)
+        for dtype in dtypes:
+            if dtype.decode("ascii") not in SCAN_DTYPES:
+                raise ValueError(f"{path}: unsupported scan dtype {dtype!r}")
+        itemsizes = np.array([np.dtype(dtype.decode("ascii")).itemsize for dtype in dtypes], dtype=np.uint64)
+        ends = self.index["offset"] + (self.index["altitude_angle_count"].astype(np.uint64)
+                                       * self.index["encoder_angle_count"] * itemsizes[inverse.reshape(-1)])
+        if count and int(ends.max()) > index_offset:
+            raise ValueError(f"{path}: scan data overlaps the index")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        record = self.index[i]
+        shape = (int(record["altitude_angle_count"]), int(record["encoder_angle_count"]))
+        return np.frombuffer(self._data, dtype=record["dtype"].decode("ascii"), count=shape[0] * shape[1],
+                             offset=int(record["offset"])).reshape(shape)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def record(self, i):
+        """ScanRecord of scan i; timestamp, pose and sensor_model are None when not recorded"""
+        entry = self.index[i]
+        timestamp = float(entry["timestamp"])
+        pose = entry["pose"]
+        model = int(entry["sensor_model"])
+        return ScanRecord(
+            self.names[i] if i < len(self.names) else f"scan_{i}",
+            self[i],
+            None if np.isnan(timestamp) else timestamp,
+            None if np.isnan(pose).any() else tuple(pose.tolist()),
+            self.sensor_models[model] if model >= 0 else None,
+        )
+
+    def records(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def find(self, name):
+        """Position of the scan called name"""
+        return self.names.index(name)
+
+def convert_pickles(pickle_paths, out_path, poses=None, timestamps=None, sensor_model=None):
+    """Pack trusted scan pickles into one .scans file; returns the number of scans
+
+    poses and timestamps are dicts keyed by pickle path, as read by
+    pose.read_pose_file. Scans are named by their pickle path, so pose files
+    written for the pickles keep working.
+    """
+    poses = poses or {}
+    timestamps = timestamps or {}
+    with ScanContainerWriter(out_path) as writer:
+        for path in pickle_paths:
+            with open(path, "rb") as f:
+                scan = np.asarray(pickle.load(f))
+            writer.add(scan, path, timestamps.get(path), poses.get(path), sensor_model)
+    return len(pickle_paths)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack scan pickles into a .scans container")
+    parser.add_argument("out", help="Output .scans file")
+    parser.add_argument("pickle_files", nargs="+", help="Scan pickles (only convert files you trust)")
+    parser.add_argument("--poses", help="CSV of file_name,tx,ty,tz,qw,qx,qy,qz (or file_name,timestamp "
+                                        "with --trajectory) recorded with each scan")
+    parser.add_argument("--trajectory", help="CSV of timestamp,tx,ty,tz,qw,qx,qy,qz poses to interpolate from")
+    parser.add_argument("--calibration", help="Sensor model calibration JSON recorded with each scan")
+    args = parser.parse_args()
+
+    poses, timestamps = None, None
+    if args.poses:
+        poses, timestamps = read_pose_file(args.poses, read_trajectory(args.trajectory) if args.trajectory else None)
+    sensor_model = SensorModel.from_calibration_file(args.calibration) if args.calibration else None
+    count = convert_pickles(args.pickle_files, args.out, poses, timestamps, sensor_model)
+    size = os.path.getsize(args.out)
+    print(f"Packed {count} scans into {args.out} ({size / 1e6:.1f} MB)")
+
+if __name__ == "__main__":
+    main()
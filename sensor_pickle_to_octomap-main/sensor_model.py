@@ -0,0 +1,142 @@
+import json
+import math
+from functools import lru_cache
+import numpy as np
+
+class SensorModel:
+    """Beam geometry of a scanning LiDAR
+
+    A scan is an (altitude, encoder) array of ranges. Ring i points at
+    altitude_angles_deg[i]; encoder step j points at
+    offset_deg + direction * j * 360 / counts_per_revolution degrees. When
+    counts_per_revolution is None one scan row covers a full revolution.
+    z_sign is -1 for sensors whose positive altitude angles look down.
+    """
+
+    def __init__(self, altitude_angles_deg, counts_per_revolution=None,
+                 encoder_offset_deg=0.0, encoder_direction=1, z_sign=-1.0, name="custom"):
+        self.name = name
+        self.altitude_angles_deg = tuple(float(a) for a in altitude_angles_deg)
+        self.counts_per_revolution = None if counts_per_revolution is None else int(counts_per_revolution)
+        self.encoder_offset_deg = float(encoder_offset_deg)
+        self.encoder_direction = 1 if encoder_direction >= 0 else -1
+        self.z_sign = -1.0 if z_sign < 0 else 1.0
+        self._directions = {}
+
+        if not self.altitude_angles_deg:
+            raise ValueError("Sensor model needs at least one altitude angle")
+        if self.counts_per_revolution is not None and self.counts_per_revolution <= 0:
+            raise ValueError("counts_per_revolution must be positive")
+
+    @property
+    def altitude_angle_count(self):
+        return len(self.altitude_angles_deg)
+
+    def altitude_angles(self):
+        """Per-ring altitude angles in radians"""
+        return np.array([a * math.pi / 180 for a in self.altitude_angles_deg])
+
+    def encoder_angles(self, encoder_angle_count):
+        """Encoder angles in radians for a scan with encoder_angle_count columns"""
+        counts = self.counts_per_revolution or encoder_angle_count
+        step = self.encoder_direction * 2 * math.pi / counts
+        offset = self.encoder_offset_deg * math.pi / 180
+        return np.array([offset + j * step for j in range(encoder_angle_count)])
+
+    def direction_table(self, encoder_angle_count):
+        """Cached (altitude * encoder, 3) unit beam directions, row-major like the scan"""
+        directions = self._directions.get(encoder_angle_count)
+        if directions is None:
+            altitude = self.altitude_angles()
+            encoder = self.encoder_angles(encoder_angle_count)
+            cos_alt = np.cos(altitude)[:, np.newaxis]
+            sin_alt = np.sin(altitude)[:, np.newaxis]
+
+            directions = np.empty((len(altitude), encoder_angle_count, 3))
+            directions[..., 0] = np.cos(encoder)[np.newaxis, :] * cos_alt
+            directions[..., 1] = np.sin(encoder)[np.newaxis, :] * cos_alt
+            directions[..., 2] = self.z_sign * sin_alt
+            directions = directions.reshape(-1, 3)
+            directions.setflags(write=False)
+            self._directions[encoder_angle_count] = directions
+        return directions
+
+    def check_scan_shape(self, altitude_angle_count, encoder_angle_count):
+        if altitude_angle_count != self.altitude_angle_count:
+            raise ValueError(
+                f"Sensor model '{self.name}' has {self.altitude_angle_count} rings, "
+                f"scan has {altitude_angle_count}")
+        if self.counts_per_revolution is not None and encoder_angle_count > self.counts_per_revolution:
+            raise ValueError(
+                f"Sensor model '{self.name}' has {self.counts_per_revolution} encoder counts "
+                f"per revolution, scan has {encoder_angle_count}")
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "altitude_angles_deg": list(self.altitude_angles_deg),
+            "encoder": {
+                "counts_per_revolution": self.counts_per_revolution,
+                "offset_deg": self.encoder_offset_deg,
+                "direction": self.encoder_direction,
+            },
+            "z_sign": self.z_sign,
+        }
+
+    def to_json(self):
+        """Canonical JSON form, used as the stored definition in the database"""
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def from_dict(cls, definition):
+        encoder = definition.get("encoder", {})
+        return cls(
+            definition["altitude_angles_deg"],
+            counts_per_revolution=encoder.get("counts_per_revolution"),
+            encoder_offset_deg=encoder.get("offset_deg", 0.0),
+            encoder_direction=encoder.get("direction", 1),
+            z_sign=definition.get("z_sign", -1.0),
+            name=definition.get("name", "custom"),
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    @classmethod
+    def from_calibration_file(cls, path):
+        """Load a sensor model from a JSON calibration file"""
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    def save_calibration_file(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def __eq__(self, other):
+        return isinstance(other, SensorModel) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(self.to_json())
+
+    def __repr__(self):
+        return (f"SensorModel(name={self.name!r}, rings={self.altitude_angle_count}, "
+                f"counts_per_revolution={self.counts_per_revolution})")
+
+@lru_cache(maxsize=8)
+def default_sensor_model(altitude_angle_count=32):
+    """Calibrated geometry of our 32-ring sensor: -22 deg up in 43.9528/32 deg steps"""
+    return SensorModel(
+        [-22 + i * ((21.4764 * 2 + 1) / 32) for i in range(altitude_angle_count)],
+        name="default",
+    )
+
+@lru_cache(maxsize=8)
+def symmetric_sensor_model(altitude_angle_count=32):
+    """Rings spread evenly over -90..90 deg with z up (former synthetic geometry)"""
+    return SensorModel(
+        [(i - altitude_angle_count / 2) * (180 / altitude_angle_count)
+         for i in range(altitude_angle_count)],
+        z_sign=1.0,
+        name="symmetric",
+    )
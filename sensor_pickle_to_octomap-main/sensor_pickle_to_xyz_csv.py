@@ -1,73 +1,70 @@
 #!/bin/python3
-import sys
+import argparse
 import matplotlib.pyplot as plt
-import pickle
-import math
 import numpy
-from db_utils import LiDARDatabase
-
-def sensor_data_to_cartesian_coordinates(sensor_data):
-    cartesian_coordinates = [[],[],[]]
-    for altitude_angle_index, data in enumerate(sensor_data):
-        for encoder_angle_index, item in enumerate(data):
-
-            radius = item
-            encoder_angle = encoder_angle_index * math.pi / 512
-            # encoder_angle = 2 * math.pi * ( 1 - encoder_angle_index / 90112 )
-            altitude_angle = ( -22 + altitude_angle_index * ( ( 21.4764 * 2 + 1 ) / 32 ) ) * math.pi / 180
-            # altitude_angle = altitude_angle_index * 0.4 * math.pi / 180
-            # altitude_angle = altitude_angle_index * 0.5 * math.pi / 180
-            # altitude_angle = altitude_angle_index * ( 94 / 32 ) * math.pi / 180
-            # altitude_angle = altitude_angle_index * ( 1.4 ) * math.pi / 180
-
-            x = radius * math.cos(encoder_angle) * math.cos(altitude_angle)
-            y = radius * math.sin(encoder_angle) * math.cos(altitude_angle)
-            z = -1.0 * radius * math.sin(altitude_angle)
-
-            coordinates = [x,y,z]
-            # print(coordinates)
-            
-            cartesian_coordinates[0].append(x)
-            cartesian_coordinates[1].append(y)
-            cartesian_coordinates[2].append(z)
-
-
-    return cartesian_coordinates
+from db_utils import LiDARDatabase, POINT_STORAGE_MODES
+from filters import add_filter_arguments, point_filter_from_args
+from ingest import PointFileSink, ingest_files
+from point_io import POINT_FORMATS, open_point_stream
+from pose import read_pose_file, read_trajectory
+from projection import project_scan
+from range_codec import DEFAULT_RANGE_SCALE, RANGE_CODECS
+from result_cache import add_cache_arguments, result_cache_from_args
+from sensor_model import SensorModel
+
+def sensor_data_to_cartesian_coordinates(sensor_data, sensor_model=None):
+    """Convert a (altitude, encoder) range scan to [[x...], [y...], [z...]] lists"""
+    # Vectorized through the sensor model's cached direction table
+    points = project_scan(sensor_data, sensor_model, dtype=numpy.float64)
+    return points.T.tolist()
 
 
 def main():
-    file_names = sys.argv
-    file_names.pop(0)
-    cartesian_coordinates = [[],[],[]]
-    db = LiDARDatabase()
-
-    for file_name in file_names:
-
-        sensor_data_pickle = open(r"./" + file_name, "rb")
-        sensor_data = pickle.load(sensor_data_pickle)
-
-        # Store raw scan in database
-        scan_id = db.store_raw_scan(sensor_data, len(sensor_data), len(sensor_data[0]))
-
-        _cartesian_coordinates = sensor_data_to_cartesian_coordinates(sensor_data)
-        
-        # Prepare points for database storage
-        points = list(zip(_cartesian_coordinates[0], _cartesian_coordinates[1], _cartesian_coordinates[2]))
-        db.store_point_cloud(scan_id, points)
-
-        cartesian_coordinates[0].extend(_cartesian_coordinates[0])
-        cartesian_coordinates[1].extend(_cartesian_coordinates[1])
-        cartesian_coordinates[2].extend(_cartesian_coordinates[2])
-
-
-    xs = cartesian_coordinates[0]
-    ys = cartesian_coordinates[1]
-    zs = cartesian_coordinates[2]
-
-    print("x,y,z")
-    for index,x in enumerate(xs):
-        line = str(x) + "," + str(ys[index]) + "," + str(zs[index])
-        print(line)
+    parser = argparse.ArgumentParser(description="Convert sensor pickles to an x,y,z point file (CSV on stdout by default)")
+    parser.add_argument("file_names", nargs="+", help="Sensor data pickle files or .scans containers")
+    parser.add_argument("--calibration", help="Sensor model calibration JSON (default: built-in geometry)")
+    parser.add_argument("--point-storage", choices=POINT_STORAGE_MODES, default="rows",
+                        help="Store points as one row per point or one blob per scan")
+    parser.add_argument("--range-codec", choices=RANGE_CODECS, default="raw",
+                        help="Encoding of the stored raw scans (quantized codecs round to --range-scale)")
+    parser.add_argument("--range-scale", type=float, default=DEFAULT_RANGE_SCALE,
+                        help="Fixed-point step of the quantized range codecs, in range units "
+                             "(default: 1 for whole-number ranges such as millimetres, 0.001 otherwise)")
+    parser.add_argument("--batch-size", type=int, default=50, help="Scans stored per database commit")
+    parser.add_argument("--keep-duplicates", action="store_true",
+                        help="Store scans again even if the database already has the same scan")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Worker processes converting scans (0 converts in-process)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="Emit scans as soon as they are converted instead of in input order")
+    parser.add_argument("--format", choices=POINT_FORMATS, default="csv",
+                        help="Point file format; xyz.bin, pcd and npy are float32 binary")
+    parser.add_argument("--poses", help="CSV of file_name,tx,ty,tz,qw,qx,qy,qz sensor poses (or file_name,timestamp "
+                                        "with --trajectory); posed scans are written in the map frame")
+    parser.add_argument("--trajectory", help="CSV of timestamp,tx,ty,tz,qw,qx,qy,qz poses to interpolate from")
+    parser.add_argument("--output", default="-",
+                        help="Point file to write ('-' for stdout; pcd and npy need a real file)")
+    add_filter_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    sensor_model = SensorModel.from_calibration_file(args.calibration) if args.calibration else None
+    poses, timestamps = None, None
+    if args.poses:
+        poses, timestamps = read_pose_file(args.poses, read_trajectory(args.trajectory) if args.trajectory else None)
+    db = LiDARDatabase(point_storage=args.point_storage, range_codec=args.range_codec,
+                       range_scale=args.range_scale)
+
+    # Scans are streamed to the database and stdout as they are converted
+    # instead of being collected in memory first; throughput goes to stderr
+    output = open_point_stream(args.output, args.format)
+    ingest_files(args.file_names, db, PointFileSink(output, args.format), sensor_model, workers=args.workers,
+                 ordered=not args.unordered, batch_size=args.batch_size, progress_interval=0,
+                 poses=poses, timestamps=timestamps, point_filter=point_filter_from_args(args),
+                 cache=result_cache_from_args(args), dedupe=not args.keep_duplicates)
+    if args.output != "-":
+        output.close()
+    db.close()
 
 
     # fig = plt.figure()
@@ -76,4 +73,5 @@ def main():
 
     # plt.show()
 
-main()
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,374 @@
-import numpy as np
+import argparse
+import csv
+import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from db_utils import LiDARDatabase
-import os
+from ingest import ingest_files
+from pose import POSE_FIELDS, pose_rotations
+from projection import project_scan
+from scan_container import ScanContainerWriter
+from sensor_model import default_sensor_model
+
+# Rays intersected with the scene at a time in Scene.cast
+_CAST_CHUNK = 16384
+# Scans rendered at a time when writing a shard
+_SHARD_BATCH = 32
+# Hits closer than this to the sensor are ignored
+_EPSILON = 1e-6
+
+class Scene:
+    """Geometric scene for ray casting: planes, axis-aligned boxes and vertical cylinders
+
+    Planes are points x with normal . x = offset. Boxes are given by their
+    min and max corners, cylinders by the x, y of their axis, radius and
+    z extent.
+    """
+
+    def __init__(self, plane_normals=(), plane_offsets=(), box_mins=(), box_maxs=(),
+                 cylinder_centers=(), cylinder_radii=(), cylinder_z=()):
+        self.plane_normals = np.asarray(plane_normals, dtype=np.float64).reshape(-1, 3)
+        self.plane_offsets = np.asarray(plane_offsets, dtype=np.float64).reshape(-1)
+        self.box_mins = np.asarray(box_mins, dtype=np.float64).reshape(-1, 3)
+        self.box_maxs = np.asarray(box_maxs, dtype=np.float64).reshape(-1, 3)
+        self.cylinder_centers = np.asarray(cylinder_centers, dtype=np.float64).reshape(-1, 2)
+        self.cylinder_radii = np.asarray(cylinder_radii, dtype=np.float64).reshape(-1)
+        self.cylinder_z = np.asarray(cylinder_z, dtype=np.float64).reshape(-1, 2)
+
+        # Bounding spheres, used to skip the exact test for rays that miss them
+        self._box_spheres = ((self.box_mins + self.box_maxs) / 2,
+                             np.linalg.norm(self.box_maxs - self.box_mins, axis=1) / 2)
+        half_heights = (self.cylinder_z[:, 1] - self.cylinder_z[:, 0]) / 2
+        self._cylinder_spheres = (np.column_stack([self.cylinder_centers, self.cylinder_z[:, 0] + half_heights]),
+                                  np.hypot(self.cylinder_radii, half_heights))
+
+    @classmethod
+    def random(cls, rng, size=40.0, boxes=20, cylinders=10, clear_radius=None, clearance=2.0):
+        """Ground, four walls and random boxes and poles in a size x size area around the origin
+
+        Objects keep clearance away from the circle of clear_radius around
+        the origin, so a sensor driving along it never ends up inside one.
+        """
+        half = size / 2
+
+        def positions(count, extent):
+            candidates = rng.uniform(-half + extent, half - extent, size=(8 * count + 8, 2))
+            if clear_radius is not None:
+                distance = np.abs(np.hypot(candidates[:, 0], candidates[:, 1]) - clear_radius)
+                candidates = candidates[distance > clearance + extent]
+            return candidates[:count]
+
+        box_sizes = rng.uniform([0.5, 0.5, 0.5], [4.0, 4.0, 3.0], size=(boxes, 3))
+        box_centers = positions(boxes, 2.0)
+        box_sizes = box_sizes[:len(box_centers)]
+        box_mins = np.column_stack([box_centers - box_sizes[:, :2] / 2, np.zeros(len(box_centers))])
+        box_maxs = box_mins + box_sizes
+
+        cylinder_centers = positions(cylinders, 0.5)
+        radii = rng.uniform(0.1, 0.5, size=len(cylinder_centers))
+        heights = rng.uniform(1.0, 6.0, size=len(cylinder_centers))
+
+        return cls(
+            plane_normals=[(0, 0, 1), (1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0)],
+            plane_offsets=[0.0, -half, -half, -half, -half],
+            box_mins=box_mins, box_maxs=box_maxs,
+            cylinder_centers=cylinder_centers, cylinder_radii=radii,
+            cylinder_z=np.column_stack([np.zeros(len(heights)), heights]),
+        )
+
+    def _plane_hits(self, origins, directions):
+        facing = directions @ self.plane_normals.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (self.plane_offsets - origins @ self.plane_normals.T) / facing
+        return np.where(t > _EPSILON, t, np.inf).min(axis=1, initial=np.inf)
+
+    @staticmethod
+    def _candidates(origins, directions, spheres):
+        """(ray, primitive) index pairs of rays that pass through the primitive's bounding sphere"""
+        centers, radii = spheres
+        if origins.ndim == 1:
+            # Shared origin: one matrix product of cosines against each sphere's angular radius
+            offsets = centers - origins
+            distances = np.linalg.norm(offsets, axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                limits = np.where(distances > radii, np.sqrt(1 - (radii / distances) ** 2), -np.inf)
+                cosines = directions @ (offsets / distances[:, np.newaxis]).T
+            return np.nonzero(cosines >= limits)
+        offsets = centers - origins[:, np.newaxis, :]
+        along = np.einsum("rpk,rk->rp", offsets, directions)
+        miss = np.einsum("rpk,rpk->rp", offsets, offsets) - np.maximum(along, 0) ** 2
+        return np.nonzero(miss <= radii ** 2)
+
+    def _box_hits(self, origins, directions, boxes):
+        """Slab test of each ray against one box"""
+        # Zero components are nudged so 1/d stays finite
+        inverse = 1.0 / np.where(directions == 0, 1e-300, directions)
+        t1 = (self.box_mins[boxes] - origins) * inverse
+        t2 = (self.box_maxs[boxes] - origins) * inverse
+        near = np.minimum(t1, t2).max(axis=1)
+        far = np.maximum(t1, t2).min(axis=1)
+        t = np.where(near > _EPSILON, near, far)
+        return np.where((near <= far) & (t > _EPSILON), t, np.inf)
+
+    def _cylinder_hits(self, origins, directions, cylinders):
+        """Intersection of each ray with one cylinder's side or caps"""
+        dx, dy, dz = directions.T
+        ox = origins[:, 0] - self.cylinder_centers[cylinders, 0]
+        oy = origins[:, 1] - self.cylinder_centers[cylinders, 1]
+        oz = origins[:, 2]
+        z0, z1 = self.cylinder_z[cylinders].T
+        r2 = self.cylinder_radii[cylinders] ** 2
+
+        # Side: |o + t d|^2 = r^2 in the xy plane, nearest root in front of the sensor
+        a = dx * dx + dy * dy
+        b = ox * dx + oy * dy
+        c = ox * ox + oy * oy - r2
+        discriminant = b * b - a * c
+        with np.errstate(divide="ignore", invalid="ignore"):
+            root = np.sqrt(discriminant)
+            t_near = (-b - root) / a
+            t_far = (-b + root) / a
+        t_side = np.where(t_near > _EPSILON, t_near, t_far)
+        z_side = oz + t_side * dz
+        side = (discriminant >= 0) & (t_side > _EPSILON) & (z_side >= z0) & (z_side <= z1)
+        best = np.where(side, t_side, np.inf)
+
+        # Caps: a ray from outside can only enter through the top disc going
+        # down or the bottom disc going up
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_cap = (np.where(dz < 0, z1, z0) - oz) / dz
+        cx = ox + t_cap * dx
+        cy = oy + t_cap * dy
+        cap = (t_cap > _EPSILON) & (cx * cx + cy * cy <= r2)
+        return np.minimum(best, np.where(cap, t_cap, np.inf))
+
+    def cast(self, origins, directions, max_distance=np.inf):
+        """Distance along each ray to the nearest surface, max_distance where nothing is hit
+
+        origins is one (3,) point shared by all rays, or (R, 3); directions
+        are (R, 3) unit vectors.
+        """
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        origins = np.asarray(origins, dtype=np.float64)
+        shared = origins.ndim == 1
+        distances = np.empty(len(directions))
+        for start in range(0, len(directions), _CAST_CHUNK):
+            d = directions[start:start + _CAST_CHUNK]
+            o = origins if shared else origins[start:start + _CAST_CHUNK]
+            t = self._plane_hits(np.broadcast_to(o, d.shape), d) if len(self.plane_offsets) else np.full(len(d), np.inf)
+            for spheres, hits in ((self._box_spheres, self._box_hits),
+                                  (self._cylinder_spheres, self._cylinder_hits)):
+                if len(spheres[1]):
+                    rays, primitives = self._candidates(o, d, spheres)
+                    ray_origins = np.broadcast_to(o, (len(rays), 3)) if shared else o[rays]
+                    np.minimum.at(t, rays, hits(ray_origins, d[rays], primitives))
+            distances[start:start + _CAST_CHUNK] = np.minimum(t, max_distance)
+        return distances
+
+def circular_trajectory(count, radius=10.0, height=1.8, speed=2.0, rate=10.0):
+    """Timestamps and (count, 7) poses of a sensor driving counterclockwise round a circle
+
+    Scans are taken rate times per second at speed m/s, facing the
+    direction of travel.
+    """
+    times = np.arange(count) / rate
+    angle = speed * times / radius
+    yaw = angle + np.pi / 2
+    poses = np.zeros((count, 7))
+    poses[:, 0] = radius * np.cos(angle)
+    poses[:, 1] = radius * np.sin(angle)
+    poses[:, 2] = height
+    poses[:, 3] = np.cos(yaw / 2)
+    poses[:, 6] = np.sin(yaw / 2)
+    return times, poses
 
 class SyntheticLiDARGenerator:
-    def __init__(self, altitude_angles=32, encoder_angles=512):
+    """Synthetic range scans from a seedable np.random.Generator
+
+    The same seed gives the same scans.
+    """
+
+    def __init__(self, altitude_angles=32, encoder_angles=512, seed=None, sensor_model=None):
         self.altitude_angles = altitude_angles
         self.encoder_angles = encoder_angles
-        
+        self.rng = np.random.default_rng(seed)
+        self.sensor_model = sensor_model or default_sensor_model(altitude_angles)
+
     def generate_environment(self, num_objects=5, max_distance=10.0):
         """Generate a synthetic environment with random objects"""
         # Initialize empty environment
-        scan_data = np.ones((self.altitude_angles, self.encoder_angles)) * max_distance
-        
-        # Add random "objects" by modifying distances
-        for _ in range(num_objects):
-            # Random object position
-            alt_idx = np.random.randint(0, self.altitude_angles)
-            enc_idx = np.random.randint(0, self.encoder_angles)
-            
-            # Random object size
-            size = np.random.randint(3, 10)
-            distance = np.random.uniform(1.0, max_distance-1)
-            
-            # Create object by setting distances
-            for i in range(max(0, alt_idx-size), min(self.altitude_angles, alt_idx+size)):
-                for j in range(max(0, enc_idx-size), min(self.encoder_angles, enc_idx+size)):
-                    # Add some noise to make it more realistic
-                    noise = np.random.normal(0, 0.1)
-                    scan_data[i, j] = distance + noise
-        
+        scan_data = np.full((self.altitude_angles, self.encoder_angles), max_distance)
+
+        # Add random "objects": noisy patches of constant distance, later ones on top
+        alt_idx = self.rng.integers(0, self.altitude_angles, size=num_objects)
+        enc_idx = self.rng.integers(0, self.encoder_angles, size=num_objects)
+        sizes = self.rng.integers(3, 10, size=num_objects)
+        distances = self.rng.uniform(1.0, max_distance - 1, size=num_objects)
+        for i, j, size, distance in zip(alt_idx, enc_idx, sizes, distances):
+            patch = scan_data[max(0, i - size):i + size, max(0, j - size):j + size]
+            patch[...] = distance + self.rng.normal(0, 0.1, size=patch.shape)
+
         return scan_data
 
     def generate_multiple_scans(self, num_scans=5):
         """Generate multiple synthetic scans"""
-        scans = []
-        for _ in range(num_scans):
-            scan = self.generate_environment()
-            scans.append(scan)
+        return [self.generate_environment() for _ in range(num_scans)]
+
+    def render_scans(self, scene, poses, max_distance=100.0, noise=0.02):
+        """Ray-cast one (altitude, encoder) scan per (tx, ty, tz, qw, qx, qy, qz) pose
+
+        Hits get Gaussian range noise; rays that hit nothing read max_distance.
+        Returns an (S, altitude, encoder) float64 array.
+        """
+        poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+        directions = self.sensor_model.direction_table(self.encoder_angles)
+        rotations = pose_rotations(poses)
+        scans = np.empty((len(poses), self.altitude_angles, self.encoder_angles))
+        for scan, pose, rotation in zip(scans, poses, rotations):
+            ranges = scene.cast(pose[:3], directions @ rotation.T, max_distance)
+            hit = ranges < max_distance
+            ranges[hit] += self.rng.normal(0, noise, size=int(hit.sum()))
+            scan[...] = np.clip(ranges, 0.0, max_distance).reshape(scan.shape)
         return scans
 
-def save_synthetic_data(scans, output_dir="synthetic_data"):
-    """Save synthetic scans as pickle files"""
+def save_synthetic_data(scans, output_dir="synthetic_data", first_index=0):
+    """Save synthetic scans as pickle files, returning their paths"""
     os.makedirs(output_dir, exist_ok=True)
-    
-    for i, scan in enumerate(scans):
+
+    paths = []
+    for i, scan in enumerate(scans, first_index):
         filename = os.path.join(output_dir, f"synthetic_scan_{i}.pickle")
         with open(filename, "wb") as f:
             pickle.dump(scan, f)
         print(f"Saved scan to {filename}")
+        paths.append(filename)
+    return paths
 
-def store_synthetic_data_in_db(scans):
-    """Store synthetic scans in the database"""
+def store_synthetic_data_in_db(scans, sensor_model=None, poses=None):
+    """Store synthetic scans, and their poses if given, in the database"""
     db = LiDARDatabase()
-    
-    for scan in scans:
-        # Store raw scan
-        scan_id = db.store_raw_scan(scan, scan.shape[0], scan.shape[1])
-        
-        # Generate and store point cloud data
-        points = []
-        for alt_idx in range(scan.shape[0]):
-            for enc_idx in range(scan.shape[1]):
-                # Convert to cartesian coordinates (simplified version)
-                radius = scan[alt_idx, enc_idx]
-                encoder_angle = enc_idx * (2 * np.pi / scan.shape[1])
-                altitude_angle = (alt_idx - scan.shape[0]/2) * (np.pi / scan.shape[0])
-                
-                x = radius * np.cos(encoder_angle) * np.cos(altitude_angle)
-                y = radius * np.sin(encoder_angle) * np.cos(altitude_angle)
-                z = radius * np.sin(altitude_angle)
-                
-                points.append((x, y, z))
-        
-        # Store point cloud
-        db.store_point_cloud(scan_id, points)
-        print(f"Stored scan {scan_id} in database")
+
+    # Store every scan in a single transaction
+    with db.transaction():
+        for i, scan in enumerate(scans):
+            # Store raw scan
+            scan_id = db.store_raw_scan(scan, scan.shape[0], scan.shape[1], sensor_model)
+            if poses is not None:
+                db.store_pose(scan_id, poses[i])
+
+            # Convert to cartesian coordinates with the same geometry as real scans
+            points = project_scan(scan, sensor_model)
+
+            # Store point cloud
+            db.store_point_cloud(scan_id, points)
+            print(f"Stored scan {scan_id} in database")
+
+def _generate_shard(task):
+    """Write scans [start, stop) of a dataset; runs in a worker process"""
+    (shard, start, stop, seed, scene, times, poses, output_dir, fmt,
+     altitude_angles, encoder_angles, max_distance, noise) = task
+    generator = SyntheticLiDARGenerator(altitude_angles, encoder_angles, seed)
+    if fmt == "scans":
+        path = os.path.join(output_dir, f"synthetic_{shard:04d}.scans")
+        with ScanContainerWriter(path) as writer:
+            for batch in range(start, stop, _SHARD_BATCH):
+                end = min(stop, batch + _SHARD_BATCH)
+                if scene is None:
+                    scans = generator.generate_multiple_scans(end - batch)
+                else:
+                    scans = generator.render_scans(scene, poses[batch:end], max_distance, noise)
+                for i, scan in enumerate(scans, batch):
+                    writer.add(scan, f"synthetic_scan_{i}",
+                               None if times is None else times[i], None if poses is None else poses[i])
+        return [path]
+
+    paths = []
+    for i in range(start, stop):
+        if scene is None:
+            scan = generator.generate_environment()
+        else:
+            scan = generator.render_scans(scene, poses[i:i + 1], max_distance, noise)[0]
+        path = os.path.join(output_dir, f"synthetic_scan_{i}.pickle")
+        with open(path, "wb") as f:
+            pickle.dump(scan, f)
+        paths.append(path)
+    return paths
+
+def generate_dataset(output_dir, scan_count, shards=1, workers=0, seed=None, scene="raycast", fmt="scans",
+                     altitude_angles=32, encoder_angles=512, max_distance=100.0, noise=0.02, speed=2.0):
+    """Generate scan_count scans into output_dir, split into shards generated in parallel
+
+    scene is "raycast" (scans along a circular trajectory through a random
+    Scene, with poses and timestamps) or "objects" (independent scans of
+    random patches). fmt "scans" writes one .scans container per shard,
+    "pickle" one pickle per scan plus poses.csv for ray-cast scans. Each
+    shard has its own seed derived from seed, so the output only depends on
+    seed and shards, not on workers. Returns (paths, poses, timestamps) with
+    the poses and timestamps of pickles keyed by path.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    scene_seed, *shard_seeds = np.random.SeedSequence(seed).spawn(shards + 1)
+    times = poses = world = None
+    if scene == "raycast":
+        radius = 10.0
+        world = Scene.random(np.random.default_rng(scene_seed), size=4 * radius, clear_radius=radius)
+        times, poses = circular_trajectory(scan_count, radius, speed=speed)
+    elif scene != "objects":
+        raise ValueError(f"Unknown scene: {scene}")
+
+    bounds = np.linspace(0, scan_count, shards + 1).astype(int)
+    tasks = [(shard, bounds[shard], bounds[shard + 1], shard_seeds[shard], world, times, poses, output_dir, fmt,
+              altitude_angles, encoder_angles, max_distance, noise)
+             for shard in range(shards) if bounds[shard + 1] > bounds[shard]]
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shard_paths = list(executor.map(_generate_shard, tasks))
+    else:
+        shard_paths = [_generate_shard(task) for task in tasks]
+    paths = [path for shard in shard_paths for path in shard]
+
+    pickle_poses, pickle_timestamps = {}, {}
+    if fmt == "pickle" and poses is not None:
+        pickle_poses = {path: tuple(pose) for path, pose in zip(paths, poses.tolist())}
+        pickle_timestamps = dict(zip(paths, times.tolist()))
+        with open(os.path.join(output_dir, "poses.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(("file_name", "timestamp") + POSE_FIELDS)
+            for path, time, pose in zip(paths, times.tolist(), poses.tolist()):
+                writer.writerow([path, time] + pose)
+    return paths, pickle_poses, pickle_timestamps
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic LiDAR scans and store them in the database")
+    parser.add_argument("--scans", type=int, default=10, help="Number of scans")
+    parser.add_argument("--scene", choices=("objects", "raycast"), default="objects",
+                        help="Random patches per scan, or ray casting along a trajectory through boxes and poles")
+    parser.add_argument("--format", choices=("pickle", "scans"), default="pickle",
+                        help="One pickle per scan or one .scans container per shard")
+    parser.add_argument("--output-dir", default="synthetic_data", help="Directory for the generated files")
+    parser.add_argument("--seed", type=int, help="Seed for reproducible scans (default: random)")
+    parser.add_argument("--shards", type=int, default=1, help="Independent chunks the scans are generated in")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes generating shards")
+    parser.add_argument("--encoder-angles", type=int, default=512, help="Encoder columns per scan")
+    parser.add_argument("--max-distance", type=float, default=100.0,
+                        help="Range of ray-cast readings that hit nothing")
+    parser.add_argument("--noise", type=float, default=0.02, help="Standard deviation of ray-cast range noise")
+    parser.add_argument("--no-db", action="store_true", help="Only write the files, do not ingest them")
+    parser.add_argument("--db", default="lidar_data.db", help="Database the generated scans are ingested into")
+    args = parser.parse_args()
+
+    paths, poses, timestamps = generate_dataset(
+        args.output_dir, args.scans, args.shards, args.workers, args.seed, args.scene, args.format,
+        encoder_angles=args.encoder_angles, max_distance=args.max_distance, noise=args.noise)
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f"Generated {args.scans} scans in {len(paths)} files under {args.output_dir} ({size / 1e6:.1f} MB)")
+
+    if not args.no_db:
+        db = LiDARDatabase(args.db)
+        ingest_files(paths, db, workers=args.workers, poses=poses, timestamps=timestamps)
+        db.close()
+        print("Synthetic data generation and storage complete!")
 
 if __name__ == "__main__":
-    # Generate synthetic data
-    generator = SyntheticLiDARGenerator()
-    synthetic_scans = generator.generate_multiple_scans(num_scans=10)  # Increased from 3 to 10
-    
-    # Save to files
-    save_synthetic_data(synthetic_scans)
-    
-    # Store in database
-    store_synthetic_data_in_db(synthetic_scans)
-    print("Synthetic data generation and storage complete!")
+    main()
@@ -1,5 +1,6 @@
 #!/bin/sh
 
-./sensor_pickle_to_xyz_csv.py ./test.pickle > test_xyz.csv
-./my_point_cloud_reader --xyz_csv ./test_xyz.csv --out test.bt
+# Re-runs reuse converted scans and maps from .result_cache and do not store the scans again
+./sensor_pickle_to_xyz_csv.py ./test.pickle --cache-dir .result_cache > test_xyz.csv
+python3 octomap_builder.py test_xyz.csv --out test.bt --cache-dir .result_cache
 octovis test.bt
@@ -1,10 +1,323 @@
+import argparse
+import asyncio
+import contextlib
+import io
 import os
+import sqlite3
+import tempfile
+from point_io import POINT_FORMATS, read_points, write_points
 from synthetic_data_generator import SyntheticLiDARGenerator, save_synthetic_data, store_synthetic_data_in_db
-from db_utils import LiDARDatabase
-import subprocess
+from db_utils import SCAN_CHANGE_COLUMNS, LiDARDatabase
+from octomap_builder import build_octomaps, register_octomaps, update_octomap
 import numpy as np
+from analyze_lidar_data import LiDARDataAnalyzer
+from ingest_service import IngestService, encode_frame
+from range_codec import NO_RETURN_RANGE, RANGE_CODECS, decode_ranges, encode_ranges
+from range_image import NO_RETURN, RangeImage, compute_products
+from change_detection import diff_ranges, valid_ranges
+from result_cache import ResultCache, cache_key
+from tiled_map import TiledMap
+from voxel_map import FREE, UNKNOWN, VoxelMap
+from sensor_model import default_sensor_model
 
-def run_pipeline_test():
+QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lidar_analysis_queries.sql")
+
+# The tables of databases written before scan statistics, indexes and write counting existed
+OLD_SCHEMA = """
+CREATE TABLE raw_scans (
+    scan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    altitude_angle_count INTEGER NOT NULL,
+    encoder_angle_count INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE point_clouds (
+    point_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scan_id INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    z REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    FOREIGN KEY (scan_id) REFERENCES raw_scans (scan_id)
+);
+CREATE TABLE octomaps (
+    map_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    resolution REAL NOT NULL,
+    file_path TEXT NOT NULL,
+    point_count INTEGER NOT NULL
+);
+"""
+
+def create_old_database(path, scan_count=2):
+    """Database with the original schema holding scan_count small scans and their points"""
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    rng = np.random.default_rng(0)
+    for scan_id in range(1, scan_count + 1):
+        conn.execute("INSERT INTO raw_scans (timestamp, altitude_angle_count, encoder_angle_count, data) "
+                     "VALUES ('2025-01-22T12:00:00', 4, 8, ?)", (rng.uniform(1, 20, (4, 8)).tobytes(),))
+        conn.executemany("INSERT INTO point_clouds (scan_id, x, y, z, timestamp) "
+                         "VALUES (?, ?, ?, ?, '2025-01-22T12:00:00')",
+                         [(scan_id, *point) for point in rng.uniform(-20, 20, (32, 3)).tolist()])
+    conn.commit()
+    conn.close()
+
+def check_analyzer_on_old_database(workdir):
+    """The read-only analyzer runs, uncached, on a database created before data_writes"""
+    path = os.path.join(workdir, "old_schema.db")
+    create_old_database(path)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        analyzer = LiDARDataAnalyzer(path, QUERIES_PATH)
+        results = analyzer.run_all_analyses(save_plots=False, workers=0)
+    assert analyzer.db.data_version() is None
+    assert results[0]["rows"] == 2, results[0]["report"]
+    # The queries on tables the old schema lacks are skipped with the command that adds them
+    assert analyzer.missing_tables() == dict.fromkeys(("scan_stats", "point_density", "scan_changes",
+                                                       "octomap_scans"), "missing")
+    assert "--rebuild-scan-stats" in output.getvalue()
+
+    # A read-write open adds the tables; the statistics are then empty until rebuilt
+    with LiDARDatabase(path) as db:
+        assert analyzer.missing_tables()["scan_stats"] == "empty"
+        assert db.rebuild_scan_stats() == 2
+    assert analyzer.missing_tables() == {"scan_changes": "empty"}
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert len(analyzer.run_query(2)) == 2
+
+def check_analyzer_without_database(workdir):
+    """The analyzer refuses a database path that does not exist instead of failing to open it"""
+    path = os.path.join(workdir, "missing.db")
+    try:
+        LiDARDataAnalyzer(path, QUERIES_PATH)
+    except FileNotFoundError as e:
+        assert path in str(e)
+    else:
+        raise AssertionError("analyzer opened a missing database")
+    assert not os.path.exists(path)
+
+def serve_frames(service, path, connections, received):
+    """Run service on the Unix socket path, sending each list of encoded frames over its own connection
+
+    Each connection's frames are received or rejected before the next one
+    opens, so they arrive in the order given. The service stops once it has
+    received the given number of (well-formed) frames; returns its final stats.
+    """
+    async def run():
+        server = asyncio.create_task(service.serve(path=path, max_scans=received, stats_interval=0))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        sent = 0
+        writers = []
+        for frames in connections:
+            _, writer = await asyncio.open_unix_connection(path)
+            writer.writelines(frames)
+            await writer.drain()
+            writers.append(writer)
+            sent += len(frames)
+            # Not EOF: forked worker processes hold copies of this process's sockets
+            while service.counts["received"] + service.counts["bad_frames"] < sent and not server.done():
+                await asyncio.sleep(0.01)
+        stats = await asyncio.wait_for(server, 60)
+        for writer in writers:
+            writer.close()
+        return stats
+
+    return asyncio.run(run())
+
+def check_service_order_and_bad_frames(workdir):
+    """Scans are stored in receipt order; empty frames and scans that fail to convert are skipped"""
+    path = os.path.join(workdir, "service.db")
+    rng = np.random.default_rng(0)
+    # Large and small scans alternate so the worker processes finish out of order;
+    # the encoder count identifies each scan, and scan 3 does not fit the 16-ring sensor model
+    shapes = [(8 if i == 3 else 16, (2048 if i % 2 else 64) + i) for i in range(9)]
+    frames = [encode_frame(rng.uniform(1, 50, shape), f"scan{i}") for i, shape in enumerate(shapes)]
+    empty = encode_frame(np.zeros((0, 64)), "empty")
+    with LiDARDatabase(path, point_storage="blob") as db:
+        service = IngestService(db, None, default_sensor_model(16), workers=2, log=None)
+        stats = serve_frames(service, os.path.join(workdir, "service.sock"), [frames[:6], [empty], frames[6:]],
+                             len(frames))
+        stored = [row[0] for row in db.connect().execute(
+            "SELECT encoder_angle_count FROM raw_scans ORDER BY scan_id")]
+    assert (stats["bad_frames"], stats["failed"], stats["stored"]) == (1, 1, 8), stats
+    assert stored == [encoders for i, (_, encoders) in enumerate(shapes) if i != 3], stored
+
+def check_range_image_no_returns(workdir):
+    """Zero and NO_RETURN_RANGE readings are labelled as no-returns and produce no points"""
+    scan = np.full((16, 64), 5.0)
+    scan[3, ::2] = 0
+    scan[7, 1::2] = NO_RETURN_RANGE
+    image = RangeImage(scan)
+    no_return = (scan == 0) | (scan == NO_RETURN_RANGE)
+    assert np.array_equal(image.valid, ~no_return)
+    assert np.all(image.segment_ground()[no_return] == NO_RETURN)
+    assert np.isnan(image.points[no_return]).all()
+
+def check_range_image_units(workdir):
+    """The default grid covers the same ground for a scan in metres and the same scan in millimetres"""
+    rng = np.random.default_rng(0)
+    millimetres = rng.integers(2000, 30000, (16, 256)).astype(np.float64)
+    in_metres = compute_products(millimetres / 1000)
+    in_millimetres = compute_products(millimetres)
+    assert in_millimetres.cell_size == 1000 * in_metres.cell_size
+    assert np.array_equal(in_millimetres.labels, in_metres.labels)
+    assert np.array_equal(in_millimetres.occupancy, in_metres.occupancy)
+    assert np.count_nonzero(in_metres.occupancy != UNKNOWN) > 0
+
+def check_points_to_stdout(workdir):
+    """Writing points to '-' flushes stdout but leaves it open for the caller"""
+    points = np.arange(12, dtype=np.float32).reshape(4, 3)
+    for fmt in ("csv", "xyz.bin"):
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding="ascii")
+        with contextlib.redirect_stdout(stdout):
+            write_points("-", [points], fmt=fmt)
+        assert not stdout.closed and not stdout.buffer.closed
+        path = os.path.join(workdir, "stdout." + fmt)
+        with open(path, "wb") as f:
+            f.write(stdout.buffer.getvalue())
+        assert np.array_equal(read_points(path), points)
+
+def check_range_codec_round_trips(workdir):
+    """Every codec gives back zero, NO_RETURN_RANGE and NaN readings, millimetres exactly and metres to the millimetre"""
+    rng = np.random.default_rng(0)
+    metres = np.round(rng.uniform(0.5, 60, (16, 64)), 3)
+    for scan, tolerance in ((np.rint(metres * 1000), 0), (metres, 5e-4)):
+        scan[0, :3] = 0, NO_RETURN_RANGE, np.nan
+        for codec in RANGE_CODECS:
+            used, scale, payload = encode_ranges(scan, codec)
+            decoded = decode_ranges(payload, scan.shape, used, scale, scan.dtype)
+            assert used == codec, (codec, used)
+            assert decoded[0, 0] == 0 and decoded[0, 1] == NO_RETURN_RANGE and np.isnan(decoded[0, 2]), codec
+            assert np.allclose(decoded, scan, rtol=0, atol=tolerance, equal_nan=True), codec
+
+def check_queue_policies(workdir):
+    """A full frame queue drops the frame just received or the oldest queued one"""
+    async def submit(policy):
+        service = IngestService(policy=policy, queue_size=2, log=None)
+        service._frames = asyncio.Queue(service.queue_size)
+        for frame in range(5):
+            await service._submit(frame)
+        queued = [service._frames.get_nowait() for _ in range(service._frames.qsize())]
+        return queued, service.counts["received"], service.counts["dropped"]
+
+    assert asyncio.run(submit("drop-newest")) == ([0, 1], 5, 3)
+    assert asyncio.run(submit("drop-oldest")) == ([3, 4], 5, 3)
+
+def check_change_masks(workdir):
+    """No-returns on both sides are not changes; a return on one side only is, as is a move beyond tolerance"""
+    reference = np.full((4, 8), 10.0)
+    current = reference.copy()
+    reference[0, 0] = 0                               # appeared
+    current[0, 1] = NO_RETURN_RANGE                   # vanished
+    current[0, 2] = np.nan                            # vanished
+    reference[0, 3], current[0, 3] = NO_RETURN_RANGE, 0
+    current[1, 0] = 9.0                               # moved closer
+    current[1, 1] = 10.2                              # within tolerance
+    current[2, 0] = 12.0                              # beyond max_range: vanished
+    valid = np.ones(current.shape, dtype=bool)
+    valid[[0, 0, 0, 2], [1, 2, 3, 0]] = False
+    assert np.array_equal(valid_ranges(current, max_range=11.0), valid)
+
+    changed, closer, difference = diff_ranges(reference, current, max_range=11.0)
+    assert sorted(zip(*np.nonzero(changed))) == [(0, 0), (0, 1), (0, 2), (1, 0), (2, 0)]
+    assert sorted(zip(*np.nonzero(closer))) == [(0, 0), (1, 0)]
+    assert difference[1, 0] == -1.0 and np.isnan(difference[0, 3])
+
+def check_tiled_map_matches_voxel_map(workdir):
+    """A tiled map that keeps evicting tiles holds the same log-odds as one VoxelMap, also after reopening"""
+    rng = np.random.default_rng(0)
+    scans = [np.column_stack([rng.uniform(-20, 20, (500, 2)), rng.uniform(0, 5, 500)]) for _ in range(2)]
+    origins = [(1.0, 2.0, 1.0), (-3.0, 0.5, 1.5)]
+    voxel_map = VoxelMap(0.5)
+    voxel_map.insert_scans(scans, origins, max_range=25.0)
+    queries = np.concatenate([voxel_map.voxels(), voxel_map.voxels(FREE), rng.uniform(-25, 25, (500, 3))])
+    expected = voxel_map.log_odds_at(queries)
+
+    with LiDARDatabase(os.path.join(workdir, "tiles.db")) as db:
+        directory = os.path.join(workdir, "tiles")
+        with TiledMap(db, directory, resolution=0.5, tile_size=4.0, memory_budget=64 << 10) as tiled:
+            tiled.insert_scans(scans, origins, max_range=25.0)
+            assert tiled.stats["evictions"] > 0
+            assert np.array_equal(tiled.log_odds_at(queries), expected, equal_nan=True)
+        reopened = TiledMap(db, directory, resolution=0.5)
+        assert np.array_equal(reopened.log_odds_at(queries), expected, equal_nan=True)
+
+def check_result_cache_eviction(workdir):
+    """Eviction removes the least recently used entries first, and a read counts as a use"""
+    cache = ResultCache(os.path.join(workdir, "cache"))
+    keys = [cache_key("entry", index) for index in range(3)]
+    for when, key in enumerate(keys, start=1):
+        cache.store_array(key, np.full(1000, when))
+        os.utime(cache.path(key, ".npy"), (when * 1000, when * 1000))
+    assert cache.load_array(keys[0]) is not None
+    entry_size = os.path.getsize(cache.path(keys[0], ".npy"))
+
+    assert cache.evict(2 * entry_size) == 1
+    assert cache.load_array(keys[1]) is None
+    assert cache.load_array(keys[0])[0] == 1 and cache.load_array(keys[2])[0] == 3
+
+def check_data_writes_triggers(workdir):
+    """data_version changes on every write, replacements included, but not on reads; new poses or ranges drop products"""
+    with LiDARDatabase(os.path.join(workdir, "writes.db")) as db:
+        scan_id = db.store_raw_scan(np.full((16, 64), 5.0), 16, 64)
+        points = np.arange(30, dtype=np.float64).reshape(10, 3)
+        change = dict.fromkeys(SCAN_CHANGE_COLUMNS, 0)
+        writes = [
+            lambda: db.store_pose(scan_id, (0, 0, 0, 1, 0, 0, 0)),
+            lambda: db.store_pose(scan_id, (1, 0, 0, 1, 0, 0, 0)),
+            lambda: db.store_point_cloud(scan_id, points),
+            lambda: db.store_point_cloud(scan_id, points + 1),
+            lambda: db.store_scan_change(scan_id, change, points),
+            lambda: db.store_scan_change(scan_id, change, points),
+            lambda: db.delete_pose(scan_id),
+        ]
+        for write in writes:
+            version = db.data_version()
+            write()
+            assert db.data_version() != version, write
+        version = db.data_version()
+        db.get_poses([scan_id])
+        db.get_point_array(scan_id)
+        assert db.data_version() == version
+
+        def store_products():
+            grid = np.zeros((4, 4))
+            db.store_scan_products(scan_id, {}, 0.5, np.zeros((16, 64)), np.zeros(16), grid, grid)
+            assert db.get_scan_products(scan_id) is not None
+
+        store_products()
+        db.store_pose(scan_id, (0, 0, 0, 1, 0, 0, 0))
+        assert db.get_scan_products(scan_id) is None
+        store_products()
+        with db.transaction() as c:
+            c.execute("UPDATE raw_scans SET data = data WHERE scan_id = ?", (scan_id,))
+        assert db.get_scan_products(scan_id) is None
+
+CHECKS = [
+    ("analyzer on an old database", check_analyzer_on_old_database),
+    ("analyzer without a database", check_analyzer_without_database),
+    ("ingest service order and bad frames", check_service_order_and_bad_frames),
+    ("range image no-returns", check_range_image_no_returns),
+    ("range image units", check_range_image_units),
+    ("points to stdout", check_points_to_stdout),
+    ("range codec round trips", check_range_codec_round_trips),
+    ("queue policies", check_queue_policies),
+    ("change masks", check_change_masks),
+    ("tiled map matches voxel map", check_tiled_map_matches_voxel_map),
+    ("result cache eviction", check_result_cache_eviction),
+    ("data_writes triggers", check_data_writes_triggers),
+]
+
+def run_checks():
+    """Run the focused checks of CHECKS in a scratch directory; a failing one raises"""
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, check in CHECKS:
+            check(workdir)
+            print(f"  {name}: ok")
+
+def run_pipeline_test(point_format="xyz.bin", insert_mode="rays", resolutions=(1.0, 0.2)):
     print("=== Starting LiDAR Data Pipeline Test ===")
     
     # 1. Generate synthetic data
@@ -41,32 +354,56 @@ def run_pipeline_test():
     
     # 4. Create and store octomap
     print("\n4. Creating OctoMap from point cloud data...")
-    # Write points to temporary CSV
-    with open("temp_points.csv", "w") as f:
-        f.write("x,y,z\n")
-        for scan in latest_scans:
-            points = db.get_point_cloud_by_scan_id(scan[0])
-            for x, y, z in points:
-                f.write(f"{x},{y},{z}\n")
+    # Write points to a temporary point file, one block per scan
+    points_file = f"temp_points.{point_format}"
+    scan_ids = [scan[0] for scan in latest_scans]
+    scan_points = [db.get_point_array(scan_id) for scan_id in scan_ids]
+    stored_poses = db.get_poses(scan_ids)
+    write_points(points_file, scan_points, [stored_poses.get(scan_id) for scan_id in scan_ids], fmt=point_format)
     
-    # Create octomap using the C++ tool
-    octomap_file = "test_output.bt"
+    # Create one octomap per resolution in a single run of the C++ tool
     try:
-        subprocess.run(["./my_point_cloud_reader", "--xyz_csv", "temp_points.csv", "--out", octomap_file])
-        print(f"Successfully created OctoMap: {octomap_file}")
+        maps = build_octomaps(points_file, "test_output_{res}.bt", resolutions, insert_mode, fmt=point_format)
+        for m in maps:
+            print(f"Successfully created OctoMap: {m['file_path']} "
+                  f"({m['resolution']} m, {m['node_count']} nodes, {m['file_size']} bytes)")
         
-        # Store octomap metadata in database
-        point_count = sum(len(db.get_point_cloud_by_scan_id(scan[0])) for scan in latest_scans)
-        db.store_octomap(resolution=10.0, file_path=octomap_file, point_count=point_count)
+        # Store octomap metadata in database, linked to the scans it was built from
+        register_octomaps(db, maps, scan_ids)
         
     except Exception as e:
         print(f"Error creating OctoMap: {e}")
     
     # Cleanup
-    if os.path.exists("temp_points.csv"):
-        os.remove("temp_points.csv")
+    if os.path.exists(points_file):
+        os.remove(points_file)
+
+    # 5. Keep a running map up to date: only scans it does not contain yet are inserted
+    print("\n5. Updating the incremental OctoMap...")
+    try:
+        for attempt in range(2):
+            map_id, added = update_octomap(db, "test_incremental.ot", resolutions[-1], insert_mode)
+            print(f"Map {map_id}: added {added} new scans")
+    except Exception as e:
+        print(f"Error updating OctoMap: {e}")
+
+    # 6. Focused checks of upgrades and edge cases
+    print("\n6. Running focused checks...")
+    run_checks()
     
     print("\n=== Pipeline Test Complete ===")
 
 if __name__ == "__main__":
-    run_pipeline_test()
+    parser = argparse.ArgumentParser(description="Run the LiDAR pipeline end to end on synthetic data")
+    parser.add_argument("--format", choices=POINT_FORMATS, default="xyz.bin",
+                        help="Point file format handed to my_point_cloud_reader")
+    parser.add_argument("--insert", choices=("points", "rays"), default="rays",
+                        help="Insert bare endpoints or whole rays (free space) into the OctoMap")
+    parser.add_argument("--resolutions", default="1.0,0.2",
+                        help="Comma separated OctoMap resolutions built in one pass")
+    parser.add_argument("--checks-only", action="store_true", help="Only run the focused checks (step 6)")
+    args = parser.parse_args()
+    if args.checks_only:
+        run_checks()
+    else:
+        run_pipeline_test(args.format, args.insert, [float(r) for r in args.resolutions.split(",")])
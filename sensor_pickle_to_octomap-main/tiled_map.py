@@ -0,0 +1,301 @@
+import argparse
+import collections
+import os
+import numpy as np
+from db_utils import LiDARDatabase
+from instrumentation import add_metrics_arguments, enable_from_args, span, write_metrics_from_args
+from point_io import write_points
+from voxel_map import FREE, OCCUPIED, TREE_MAX_VAL, UNKNOWN, VoxelMap, pack_keys, unpack_keys
+
+# Tile edge in voxels when no tile size is given
+DEFAULT_TILE_VOXELS = 64
+DEFAULT_MEMORY_BUDGET = 256 << 20
+
+def _groups(packed):
+    """(value, indices) for each distinct value of a packed int64 array"""
+    if not len(packed):
+        return
+    order = np.argsort(packed, kind="stable")
+    ordered = packed[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+        yield ordered[start], order[start:end]
+
+class TiledMap:
+    """Occupancy map split into fixed-size tiles, each a VoxelMap in its own file
+
+    Tiles share OctoMap's global voxel keys, so a tile boundary never cuts a
+    voxel and every tile can be written as a stand-alone .bt in map
+    coordinates. The map_tiles table indexes each tile's bounds, file and
+    version. Only the tiles an insert, lookup or box query touches are
+    loaded; they stay in an LRU cache, and once the cache holds more than
+    memory_budget bytes the least recently used tiles are written back (if
+    changed) and dropped.
+    """
+
+    def __init__(self, db, directory, name="map", resolution=10.0, tile_size=None,
+                 memory_budget=DEFAULT_MEMORY_BUDGET, **voxel_options):
+        self.db = db
+        self.directory = directory
+        self.name = name
+        self.resolution = float(resolution)
+        self.memory_budget = memory_budget
+        self.voxel_options = voxel_options
+        self.template = VoxelMap(self.resolution, **voxel_options)
+
+        stored = [row[2] for row in db.get_tiled_maps() if row[:2] == (name, self.resolution)]
+        if tile_size is None:
+            tile_size = stored[0] if stored else DEFAULT_TILE_VOXELS * self.resolution
+        self.tile_voxels = max(1, int(round(tile_size / self.resolution)))
+        self.tile_size = self.tile_voxels * self.resolution
+        if stored and not np.isclose(stored[0], self.tile_size):
+            raise ValueError(f"Map {name!r} at {self.resolution} m uses {stored[0]} m tiles, not {self.tile_size}")
+
+        self._cache = collections.OrderedDict()
+        self._versions = {}
+        self._dirty = set()
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0, "writes": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def tile_path(self, tile):
+        x, y, z = tile
+        return os.path.join(self.directory, f"{self.name}_{self.resolution:g}_{x}_{y}_{z}.npz")
+
+    def tile_bounds(self, tile):
+        """(min corner, max corner) of a tile"""
+        low = np.asarray(tile, dtype=np.float64) * self.tile_size
+        return low, low + self.tile_size
+
+    def _key_tiles(self, keys):
+        """Packed tile index of each (N, 3) voxel key"""
+        return pack_keys((keys - TREE_MAX_VAL) // self.tile_voxels + TREE_MAX_VAL)
+
+    def _unpack_tile(self, packed):
+        return tuple(int(i) for i in unpack_keys([packed])[0] - TREE_MAX_VAL)
+
+    def _split_keys(self, packed):
+        """{tile: packed voxel keys in it}"""
+        tiles = self._key_tiles(unpack_keys(packed))
+        return {self._unpack_tile(tile): packed[index] for tile, index in _groups(tiles)}
+
+    @property
+    def memory_used(self):
+        """Bytes held by the cached tiles"""
+        return sum(tile_map.nbytes for tile_map in self._cache.values())
+
+    def tile(self, tile, create=False):
+        """The VoxelMap of a tile, loading it if needed; None if it does not exist and create is not set"""
+        tile_map = self._cache.get(tile)
+        if tile_map is not None:
+            self._cache.move_to_end(tile)
+            self.stats["hits"] += 1
+            return tile_map
+        self.stats["misses"] += 1
+
+        row = self.db.get_map_tile(self.name, self.resolution, tile)
+        if row is not None:
+            with span("tile_load"):
+                tile_map = VoxelMap.load(row["file_path"])
+            self._versions[tile] = row["version"]
+            self.stats["loads"] += 1
+        elif create:
+            tile_map = VoxelMap(self.resolution, **self.voxel_options)
+        else:
+            return None
+        self._cache[tile] = tile_map
+        self._enforce_budget(keep=tile)
+        return tile_map
+
+    def _enforce_budget(self, keep=None):
+        """Write back and drop least recently used tiles until the cache fits the budget"""
+        used = self.memory_used
+        while used > self.memory_budget and len(self._cache) > 1:
+            tile = next(iter(self._cache))
+            if tile == keep:
+                self._cache.move_to_end(tile)
+                tile = next(iter(self._cache))
+            if tile in self._dirty:
+                self._save(tile)
+            used -= self._cache.pop(tile).nbytes
+            self.stats["evictions"] += 1
+
+    def _save(self, tile):
+        tile_map = self._cache[tile]
+        path = self.tile_path(tile)
+        with span("tile_save"):
+            tile_map.save(path)
+        self._versions[tile] = self.db.store_map_tile(self.name, self.resolution, self.tile_size, tile,
+                                                      self.tile_bounds(tile), path, len(tile_map),
+                                                      os.path.getsize(path))
+        self._dirty.discard(tile)
+        self.stats["writes"] += 1
+
+    def flush(self):
+        """Write every changed tile and update the tile index in one transaction"""
+        with self.db.transaction():
+            for tile in sorted(self._dirty):
+                self._save(tile)
+
+    def refresh(self):
+        """Drop unchanged cached tiles that another writer has since rewritten; returns how many"""
+        stored = {(row["tile_x"], row["tile_y"], row["tile_z"]): row["version"]
+                  for row in self.db.get_map_tiles(self.name, self.resolution)}
+        stale = [tile for tile in self._cache
+                 if tile not in self._dirty and tile in stored and stored[tile] != self._versions.get(tile)]
+        for tile in stale:
+            del self._cache[tile]
+        return len(stale)
+
+    def _insert(self, free, occupied):
+        free = self._split_keys(free)
+        occupied = self._split_keys(occupied)
+        empty = np.empty(0, dtype=np.int64)
+        for tile in sorted(free.keys() | occupied.keys()):
+            self.tile(tile, create=True).insert_keys(free.get(tile, empty), occupied.get(tile, empty))
+            self._dirty.add(tile)
+            self._enforce_budget(keep=tile)
+
+    def insert_points(self, points):
+        """Mark the voxels of all endpoints occupied, once per voxel"""
+        keys, valid = self.template.coord_keys(points)
+        self._insert(np.empty(0, dtype=np.int64), np.unique(pack_keys(keys[valid])))
+
+    def insert_scan(self, points, origin=(0.0, 0.0, 0.0), max_range=None):
+        """Insert one scan as rays from the sensor origin (see VoxelMap.insert_scan), across tiles"""
+        self._insert(*self.template.scan_keys(points, origin, max_range))
+
+    def insert_scans(self, scans, origins=None, max_range=None):
+        for index, points in enumerate(scans):
+            self.insert_scan(points, (0.0, 0.0, 0.0) if origins is None else origins[index], max_range)
+
+    def log_odds_at(self, points):
+        """Log-odds of the voxels holding each point; NaN where unknown. Loads only the tiles hit"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        keys, valid = self.template.coord_keys(points)
+        result = np.full(len(points), np.nan, dtype=np.float32)
+        rows = np.flatnonzero(valid)
+        for packed, index in _groups(self._key_tiles(keys[valid])):
+            tile_map = self.tile(self._unpack_tile(packed))
+            if tile_map is not None:
+                result[rows[index]] = tile_map.log_odds_at(points[rows[index]])
+        return result
+
+    def occupancy(self, points):
+        return 1.0 / (1.0 + np.exp(-self.log_odds_at(points)))
+
+    def lookup(self, points):
+        """OCCUPIED, FREE or UNKNOWN for each point"""
+        values = self.log_odds_at(points)
+        result = np.full(len(values), UNKNOWN, dtype=np.int8)
+        known = ~np.isnan(values)
+        result[known] = np.where(values[known] >= self.template.threshold, OCCUPIED, FREE)
+        return result
+
+    def tiles_in_box(self, min_corner, max_corner):
+        """Indices of the stored or unsaved tiles intersecting a box"""
+        tiles = {(row["tile_x"], row["tile_y"], row["tile_z"])
+                 for row in self.db.get_map_tiles(self.name, self.resolution, min_corner, max_corner)}
+        for tile in self._dirty:
+            low, high = self.tile_bounds(tile)
+            if np.all(high >= min_corner) and np.all(low <= max_corner):
+                tiles.add(tile)
+        return sorted(tiles)
+
+    def voxels(self, min_corner, max_corner, state=OCCUPIED):
+        """(N, 3) centers of the voxels in the given state inside a box, loading only the tiles it touches"""
+        min_corner = np.asarray(min_corner, dtype=np.float64)
+        max_corner = np.asarray(max_corner, dtype=np.float64)
+        found = [np.empty((0, 3))]
+        for tile in self.tiles_in_box(min_corner, max_corner):
+            centers = self.tile(tile).voxels(state)
+            found.append(centers[np.all((centers >= min_corner) & (centers <= max_corner), axis=1)])
+        return np.concatenate(found)
+
+    def export_bt(self, directory):
+        """Write every tile as a stand-alone .bt (in map coordinates) into directory; returns the paths"""
+        self.flush()
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for row in self.db.get_map_tiles(self.name, self.resolution):
+            tile = (row["tile_x"], row["tile_y"], row["tile_z"])
+            path = os.path.join(directory, os.path.splitext(os.path.basename(row["file_path"]))[0] + ".bt")
+            self.tile(tile).write_bt(path)
+            paths.append(path)
+        return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query an occupancy map stored as tiles loaded on demand")
+    parser.add_argument("--db", default="lidar_data.db", help="Database with the scans and the tile index")
+    parser.add_argument("--dir", default="tiles", help="Directory of the tile files")
+    parser.add_argument("--name", default="map", help="Map name in the tile index")
+    parser.add_argument("--resolution", type=float, default=10.0, help="Leaf size")
+    parser.add_argument("--tile-size", type=float,
+                        help=f"Tile edge, rounded to whole voxels (default {DEFAULT_TILE_VOXELS} voxels, "
+                             "or the size the map was built with)")
+    parser.add_argument("--memory-mb", type=float, default=DEFAULT_MEMORY_BUDGET / (1 << 20),
+                        help="Memory budget of the tile cache")
+    parser.add_argument("--add-scans", action="store_true", help="Insert the stored scans into the map")
+    parser.add_argument("--after", type=int, help="With --add-scans, only scans after this scan_id")
+    parser.add_argument("--insert", choices=("points", "rays"), default="points",
+                        help="Insert bare endpoints or whole rays from each scan's pose")
+    parser.add_argument("--max-range", type=float, help="Truncate rays longer than this")
+    parser.add_argument("--box", type=float, nargs=6, metavar=("X0", "Y0", "Z0", "X1", "Y1", "Z1"),
+                        help="Print (or write with --out) the voxels inside this box")
+    parser.add_argument("--state", choices=("occupied", "free"), default="occupied", help="Voxels --box returns")
+    parser.add_argument("--out", help="Point file for the --box voxel centers")
+    parser.add_argument("--export-bt", metavar="DIR", help="Write each tile as a .bt file into DIR")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    enable_from_args(args)
+    try:
+        run(args)
+    finally:
+        write_metrics_from_args(args)
+
+def run(args):
+    """Update, query or export the tiled map as requested on the command line"""
+    with LiDARDatabase(args.db) as db:
+        tiled = TiledMap(db, args.dir, args.name, args.resolution, args.tile_size,
+                         int(args.memory_mb * (1 << 20)))
+        if args.add_scans:
+            scan_ids = db.get_scan_ids(args.after)
+            poses = db.get_poses(scan_ids)
+            with db.transaction():
+                for scan_id in scan_ids:
+                    # Stored points are in the map frame; the poses give the ray origins
+                    points = db.get_point_array(scan_id)
+                    if args.insert == "rays":
+                        pose = poses.get(scan_id)
+                        tiled.insert_scan(points, (0.0, 0.0, 0.0) if pose is None else pose[:3], args.max_range)
+                    else:
+                        tiled.insert_points(points)
+                tiled.flush()
+            print(f"Inserted {len(scan_ids)} scans")
+
+        if args.box:
+            state = OCCUPIED if args.state == "occupied" else FREE
+            centers = tiled.voxels(args.box[:3], args.box[3:], state)
+            if args.out:
+                write_points(args.out, [centers])
+                print(f"{len(centers)} {args.state} voxels -> {args.out}")
+            else:
+                for x, y, z in centers:
+                    print(f"{x:.3f} {y:.3f} {z:.3f}")
+
+        if args.export_bt:
+            paths = tiled.export_bt(args.export_bt)
+            print(f"Wrote {len(paths)} tiles to {args.export_bt}")
+
+        for name, resolution, tile_size, tiles, voxels, size in db.get_tiled_maps():
+            print(f"{name}: {resolution} m, {tile_size} m tiles, {tiles} tiles, {voxels} voxels, "
+                  f"{(size or 0) / 1024:.1f} KiB")
+        print("Tile cache: " + ", ".join(f"{count} {stat}" for stat, count in tiled.stats.items()))
+
+if __name__ == "__main__":
+    main()
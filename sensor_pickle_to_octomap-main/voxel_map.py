@@ -0,0 +1,406 @@
+import argparse
+import math
+import os
+import numpy as np
+from point_io import IDENTITY_POSE, point_format_for_path, read_points, read_xyz_bin
+
+# Voxel keys follow OctoMap: 16 bits per axis, key = floor(coord / resolution) + 32768
+TREE_DEPTH = 16
+TREE_MAX_VAL = 1 << (TREE_DEPTH - 1)
+
+# lookup() results
+UNKNOWN = -1
+FREE = 0
+OCCUPIED = 1
+
+_EMPTY = np.int64(-1)
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+def log_odds(probability):
+    return math.log(probability / (1.0 - probability))
+
+def pack_keys(keys):
+    """Pack (N, 3) voxel keys into int64 (x << 32 | y << 16 | z)"""
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys[:, 0] << 32) | (keys[:, 1] << 16) | keys[:, 2]
+
+def unpack_keys(packed):
+    packed = np.asarray(packed, dtype=np.int64)
+    return np.stack([(packed >> 32) & 0xFFFF, (packed >> 16) & 0xFFFF, packed & 0xFFFF], axis=1)
+
+class VoxelHashTable:
+    """Open-addressing hash table from packed voxel keys to float32 values
+
+    Lookups and inserts are vectorized: every pending key probes one slot
+    per round (linear probing), so a batch costs a few NumPy passes rather
+    than a Python loop per key. The table doubles once it is half full.
+    """
+
+    def __init__(self, capacity=1024):
+        capacity = 1 << max(4, int(capacity - 1).bit_length())
+        self.keys = np.full(capacity, _EMPTY, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _home_slots(self, packed):
+        bits = len(self.keys).bit_length() - 1
+        hashed = packed.astype(np.uint64) * _HASH_MULTIPLIER
+        return (hashed >> np.uint64(64 - bits)).astype(np.int64)
+
+    def find(self, packed):
+        """Slot of each key, or -1 where the key is absent"""
+        packed = np.asarray(packed, dtype=np.int64)
+        mask = len(self.keys) - 1
+        slots = np.full(len(packed), -1, dtype=np.int64)
+        pending = np.arange(len(packed))
+        probe = self._home_slots(packed)
+        while pending.size:
+            stored = self.keys[probe]
+            hit = stored == packed[pending]
+            slots[pending[hit]] = probe[hit]
+            keep = ~hit & (stored != _EMPTY)
+            pending = pending[keep]
+            probe = (probe[keep] + 1) & mask
+        return slots
+
+    def insert(self, packed):
+        """Slots of the keys, adding the missing ones with value 0; packed must be unique"""
+        packed = np.asarray(packed, dtype=np.int64)
+        if (self.count + len(packed)) * 2 > len(self.keys):
+            self._grow(self.count + len(packed))
+        slots = self.find(packed)
+        missing = np.flatnonzero(slots < 0)
+        if missing.size:
+            slots[missing] = self._place(packed[missing])
+            self.values[slots[missing]] = 0.0
+            self.count += missing.size
+        return slots
+
+    def _place(self, packed):
+        """Claim empty slots for keys known to be absent"""
+        mask = len(self.keys) - 1
+        slots = np.empty(len(packed), dtype=np.int64)
+        pending = np.arange(len(packed))
+        probe = self._home_slots(packed)
+        while pending.size:
+            free = self.keys[probe] == _EMPTY
+            # Several keys may want the same empty slot; the first one wins
+            candidates = np.flatnonzero(free)
+            _, first = np.unique(probe[candidates], return_index=True)
+            winners = candidates[first]
+            self.keys[probe[winners]] = packed[pending[winners]]
+            slots[pending[winners]] = probe[winners]
+            keep = np.ones(len(pending), dtype=bool)
+            keep[winners] = False
+            pending = pending[keep]
+            probe = (probe[keep] + 1) & mask
+        return slots
+
+    def _grow(self, needed):
+        occupied = self.keys != _EMPTY
+        keys, values = self.keys[occupied], self.values[occupied]
+        capacity = len(self.keys)
+        while needed * 2 > capacity:
+            capacity *= 2
+        self.keys = np.full(capacity, _EMPTY, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.values[self._place(keys)] = values
+
+    def items(self):
+        occupied = self.keys != _EMPTY
+        return self.keys[occupied], self.values[occupied]
+
+class VoxelMap:
+    """Sparse log-odds occupancy grid with OctoMap's keys, sensor model and .bt output
+
+    Feed it (N, 3) point arrays straight from projection.project_scans:
+    insert_points marks endpoints occupied, insert_scan also clears the free
+    space along each ray (same voxel traversal and per-scan deduplication as
+    OctoMap's insertPointCloud). lookup answers thousands of query points
+    with a handful of vectorized passes.
+    """
+
+    def __init__(self, resolution=0.1, prob_hit=0.7, prob_miss=0.4, clamp_min=0.1192, clamp_max=0.971,
+                 occupancy_threshold=0.5):
+        self.resolution = float(resolution)
+        self.hit = np.float32(log_odds(prob_hit))
+        self.miss = np.float32(log_odds(prob_miss))
+        self.clamp_min = np.float32(log_odds(clamp_min))
+        self.clamp_max = np.float32(log_odds(clamp_max))
+        self.threshold = np.float32(log_odds(occupancy_threshold))
+        self.table = VoxelHashTable()
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def nbytes(self):
+        """Memory held by the hash table"""
+        return self.table.keys.nbytes + self.table.values.nbytes
+
+    def coord_keys(self, points):
+        """(N, 3) voxel keys of points and a mask of those inside the 16-bit key range"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        with np.errstate(invalid="ignore"):
+            scaled = np.floor(points * (1.0 / self.resolution))
+            valid = np.all((scaled >= -TREE_MAX_VAL) & (scaled < TREE_MAX_VAL), axis=1)
+        keys = np.zeros(points.shape, dtype=np.int64)
+        keys[valid] = scaled[valid].astype(np.int64) + TREE_MAX_VAL
+        return keys, valid
+
+    def key_centers(self, keys):
+        return (np.asarray(keys, dtype=np.float64) - TREE_MAX_VAL + 0.5) * self.resolution
+
+    def _update(self, packed, delta):
+        slots = self.table.insert(packed)
+        values = self.table.values
+        values[slots] = np.clip(values[slots] + delta, self.clamp_min, self.clamp_max)
+
+    def insert_points(self, points):
+        """Mark the voxels of all endpoints occupied, once per voxel"""
+        keys, valid = self.coord_keys(points)
+        self._update(np.unique(pack_keys(keys[valid])), self.hit)
+
+    def insert_keys(self, free=(), occupied=()):
+        """Update unique packed keys as free and as occupied (e.g. from scan_keys)"""
+        self._update(np.asarray(free, dtype=np.int64), self.miss)
+        self._update(np.asarray(occupied, dtype=np.int64), self.hit)
+
+    def insert_scan(self, points, origin=(0.0, 0.0, 0.0), max_range=None):
+        """Insert one scan as rays from the sensor origin
+
+        Every voxel a ray passes through is updated as free and every
+        endpoint voxel as occupied, each at most once per scan; occupied
+        wins where a voxel is both. Rays longer than max_range only clear
+        space up to max_range.
+        """
+        self.insert_keys(*self.scan_keys(points, origin, max_range))
+
+    def scan_keys(self, points, origin=(0.0, 0.0, 0.0), max_range=None):
+        """Packed keys insert_scan would update, as (free, occupied) unique arrays"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        origin = np.asarray(origin, dtype=np.float64)
+        finite = np.all(np.isfinite(points), axis=1)
+        points = points[finite]
+        ranges = np.linalg.norm(points - origin, axis=1)
+
+        hits = points
+        ends = points
+        if max_range is not None:
+            in_range = ranges <= max_range
+            hits = points[in_range]
+            far = ~in_range
+            ends = points.copy()
+            ends[far] = origin + (points[far] - origin) / ranges[far, np.newaxis] * max_range
+
+        end_keys, end_valid = self.coord_keys(ends)
+        origin_keys, origin_valid = self.coord_keys(origin)
+        free = np.empty(0, dtype=np.int64)
+        if origin_valid[0]:
+            free = self._ray_keys(origin, origin_keys[0], ends[end_valid], end_keys[end_valid])
+        hit_keys, hit_valid = self.coord_keys(hits)
+        occupied = np.unique(pack_keys(hit_keys[hit_valid]))
+        free = np.setdiff1d(free, occupied, assume_unique=True)
+        return free, occupied
+
+    def insert_scans(self, scans, origins=None, max_range=None):
+        """Insert a stack of scans (e.g. project_scans output), one origin per scan"""
+        for index, points in enumerate(scans):
+            self.insert_scan(points, (0.0, 0.0, 0.0) if origins is None else origins[index], max_range)
+
+    def _ray_keys(self, origin, origin_key, ends, end_keys):
+        """Unique packed keys of the voxels the rays cross, excluding the end voxels (3D DDA)"""
+        moving = np.any(end_keys != origin_key, axis=1)
+        ends, end_keys = ends[moving], end_keys[moving]
+        if not len(ends):
+            return np.empty(0, dtype=np.int64)
+
+        direction = (ends - origin).astype(np.float32)
+        length = np.linalg.norm(direction, axis=1)
+        direction /= length[:, np.newaxis]
+        step = np.sign(direction).astype(np.int64)
+        border = self.key_centers(origin_key) + step * np.float32(self.resolution * 0.5)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_max = np.where(step != 0, (border - origin) / direction, np.inf)
+            t_delta = np.where(step != 0, self.resolution / np.abs(direction), np.inf)
+
+        # Walk packed keys directly: one step along x, y or z adds 1 << 32, 1 << 16 or 1 times the sign
+        axis_steps = step << np.array([32, 16, 0])
+        origin_packed = pack_keys(origin_key[np.newaxis])
+        current = np.repeat(origin_packed, len(ends))
+        end_packed = pack_keys(end_keys)
+        crossed = [origin_packed]
+        rows = np.arange(len(ends))
+        while len(current):
+            # Ties go to the higher axis, as in OctoMap
+            dim = np.where(t_max[:, 0] < t_max[:, 1],
+                           np.where(t_max[:, 0] < t_max[:, 2], 0, 2),
+                           np.where(t_max[:, 1] < t_max[:, 2], 1, 2))
+            rows_dim = (rows[:len(current)], dim)
+            current = current + axis_steps[rows_dim]
+            t_max[rows_dim] += t_delta[rows_dim]
+            going = (current != end_packed) & (t_max.min(axis=1) <= length)
+            current, end_packed, t_max = current[going], end_packed[going], t_max[going]
+            t_delta, axis_steps, length = t_delta[going], axis_steps[going], length[going]
+            crossed.append(current)
+        return np.unique(np.concatenate(crossed))
+
+    def log_odds_at(self, points):
+        """Log-odds of the voxels holding each point; NaN where unknown"""
+        keys, valid = self.coord_keys(points)
+        result = np.full(len(keys), np.nan, dtype=np.float32)
+        slots = self.table.find(pack_keys(keys[valid]))
+        found = slots >= 0
+        index = np.flatnonzero(valid)[found]
+        result[index] = self.table.values[slots[found]]
+        return result
+
+    def occupancy(self, points):
+        """Occupancy probability of each point's voxel; NaN where unknown"""
+        return 1.0 / (1.0 + np.exp(-self.log_odds_at(points)))
+
+    def lookup(self, points):
+        """OCCUPIED, FREE or UNKNOWN for each point"""
+        values = self.log_odds_at(points)
+        result = np.full(len(values), UNKNOWN, dtype=np.int8)
+        known = ~np.isnan(values)
+        result[known] = np.where(values[known] >= self.threshold, OCCUPIED, FREE)
+        return result
+
+    def voxels(self, state=OCCUPIED):
+        """(N, 3) centers of the voxels in the given state"""
+        packed, values = self.table.items()
+        selected = values >= self.threshold if state == OCCUPIED else values < self.threshold
+        return self.key_centers(unpack_keys(packed[selected]))
+
+    def save(self, path):
+        """Write the exact log-odds and sensor model to an .npz file, replacing it atomically"""
+        packed, values = self.table.items()
+        partial = path + ".partial"
+        with open(partial, "wb") as f:
+            np.savez(f, keys=packed, values=values, resolution=self.resolution,
+                     model=np.array([self.hit, self.miss, self.clamp_min, self.clamp_max, self.threshold]))
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a map written by save"""
+        with np.load(path) as data:
+            voxel_map = cls(float(data["resolution"]))
+            voxel_map.hit, voxel_map.miss, voxel_map.clamp_min, voxel_map.clamp_max, voxel_map.threshold = (
+                data["model"].astype(np.float32))
+            keys = data["keys"]
+            voxel_map.table = VoxelHashTable(2 * len(keys))
+            slots = voxel_map.table.insert(keys)
+            voxel_map.table.values[slots] = data["values"]
+        return voxel_map
+
+    def write_bt(self, path):
+        """Write the maximum-likelihood map as an OctoMap .bt file (readable by octovis and OcTree::readBinary)"""
+        packed, values = self.table.items()
+        data, node_count = _binary_tree_data(unpack_keys(packed), values >= self.threshold)
+        with open(path, "wb") as f:
+            f.write(b"# Octomap OcTree binary file\n"
+                    b"# (feel free to add / change comments, but leave the first line as it is!)\n#\n")
+            f.write(f"id OcTree\nsize {node_count}\nres {self.resolution!r}\ndata\n".encode("ascii"))
+            f.write(data)
+
+def _morton(keys):
+    """Interleave 16-bit x, y, z keys into 48-bit codes ordered like OctoMap child indices (x + 2y + 4z)"""
+    code = np.zeros(len(keys), dtype=np.int64)
+    for bit in range(TREE_DEPTH):
+        for axis in range(3):
+            code |= ((keys[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return code
+
+def _binary_tree_data(keys, occupied):
+    """Serialize leaf voxels the way OccupancyOcTreeBase::writeBinary does
+
+    Children with identical state are pruned into their parent, then each
+    inner node is written depth first as two bytes holding two bits per
+    child: the high bit for an occupied leaf, the low bit for a free leaf,
+    both for an inner node and neither for unknown space.
+    Returns the bytes and the number of nodes in the pruned tree.
+    """
+    # Node kinds: 0 free leaf, 1 occupied leaf, 2 inner node
+    order = np.argsort(_morton(keys))
+    codes = _morton(keys)[order]
+    kinds = occupied[order].astype(np.int64)
+    node_count = 0
+    inner_codes, inner_depths, inner_bits = [], [], []
+
+    for depth in range(TREE_DEPTH, 0, -1):
+        parents = codes >> 3
+        child = codes & 7
+        parent_codes, first, counts = np.unique(parents, return_index=True, return_counts=True)
+        group = np.repeat(np.arange(len(parent_codes)), counts)
+
+        # A parent whose eight children are equal leaves becomes a leaf itself
+        # (the root is never pruned)
+        leaf_kind = kinds[first]
+        uniform = counts == 8
+        uniform &= np.bincount(group, weights=kinds != leaf_kind[group], minlength=len(parent_codes)) == 0
+        uniform &= leaf_kind != 2
+        if depth == 1:
+            uniform[:] = False
+
+        keep = ~uniform[group]
+        node_count += int(keep.sum())
+        bits = np.zeros(len(parent_codes), dtype=np.int64)
+        pattern = np.array([1, 2, 3])[kinds[keep]]
+        np.add.at(bits, group[keep], pattern << (2 * child[keep]))
+
+        inner = ~uniform
+        inner_codes.append(parent_codes[inner] << (3 * (TREE_DEPTH - depth + 1)))
+        inner_depths.append(np.full(int(inner.sum()), depth - 1))
+        inner_bits.append(bits[inner])
+
+        codes = parent_codes
+        kinds = np.where(uniform, leaf_kind, 2)
+
+    node_count += 1  # root
+    if not len(keys):
+        return b"", 0
+
+    # Depth-first (pre-order) order is Morton order of the nodes' first
+    # descendants, parents before their children
+    inner_codes = np.concatenate(inner_codes)
+    inner_depths = np.concatenate(inner_depths)
+    inner_bits = np.concatenate(inner_bits)
+    order = np.lexsort((inner_depths, inner_codes))
+    bits = inner_bits[order]
+    data = np.empty((len(bits), 2), dtype=np.uint8)
+    data[:, 0] = bits & 0xFF
+    data[:, 1] = bits >> 8
+    return data.tobytes(), node_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a .bt occupancy map in-process, without my_point_cloud_reader")
+    parser.add_argument("points_file", help="Point file (csv, xyz.bin, pcd or npy)")
+    parser.add_argument("--out", required=True, help="Output .bt path")
+    parser.add_argument("--resolution", type=float, default=10.0, help="Leaf size")
+    parser.add_argument("--insert", choices=("points", "rays"), default="points",
+                        help="Insert bare endpoints or whole rays from each scan's pose (.xyz.bin only)")
+    parser.add_argument("--max-range", type=float, help="Truncate rays longer than this")
+    args = parser.parse_args()
+
+    fmt = point_format_for_path(args.points_file)
+    if fmt == "xyz.bin":
+        scans = read_xyz_bin(args.points_file)
+    else:
+        scans = [(IDENTITY_POSE, read_points(args.points_file, fmt))]
+    voxel_map = VoxelMap(args.resolution)
+    for pose, points in scans:
+        if args.insert == "rays":
+            voxel_map.insert_scan(points, pose[:3], args.max_range)
+        else:
+            voxel_map.insert_points(points)
+    voxel_map.write_bt(args.out)
+    print(f"{len(voxel_map)} voxels from {sum(len(points) for _, points in scans)} points "
+          f"in {len(scans)} scans -> {args.out}")
+
+if __name__ == "__main__":
+    main()